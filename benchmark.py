@@ -0,0 +1,384 @@
+#!/usr/bin/env python3
+
+# benchmark.py v1.0.0 - end to end benchmark of the getsolar poll to publish path
+
+"""
+Drives the getsolar poll and publish stages as fast as possible against local stand-ins:
+the Modbus simulator, a fake InfluxDB /write endpoint and an embedded MQTT broker.
+Each sample is timed through the stages of InverterData.update and the sinks:
+
+    read      - inverter, meter and battery register reads
+    scale     - scaling the registers and building the Sample
+    serialize - write_power and write_ha encoding line protocol into the InfluxBatcher
+    publish   - write_mqtt through the DeadbandPublisher to the broker
+
+The report is JSON: latency percentiles per stage in ms, samples/s, CPU ms per sample, RSS at
+start, end and peak in MB, and the lines and messages the stand-ins received, so results can
+be compared between runs to catch regressions. It also times the line protocol encoding of the
+W and Wh measurements by the LineEncoder against point dicts passed through make_lines.
+
+  options:
+      -n: samples to take (default: 2000)
+      -d: run for this many seconds instead, sampling RSS as it goes (default: 0)
+      -u: modbus units to poll on one session (default: 1)
+      -R: register profile: minimal or full (default: minimal)
+      -B: simulated battery capacity in Wh, 0 for no battery (default: 0)
+      -l: simulator response latency in ms (default: 0)
+      -o: file to write the JSON report to (default: stdout)
+
+  example:
+      ./benchmark.py -n 5000 -o before.json
+"""
+
+import argparse
+import http.server
+import json
+import logging
+import os
+import resource
+import socketserver
+import statistics
+import sys
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+from influxdb import InfluxDBClient
+from influxdb.line_protocol import make_lines
+
+import getsolar
+import simulator
+
+STAGES = ["read", "scale", "serialize", "publish", "total"]
+RSS_INTERVAL = 1.0
+SERIALIZER_SAMPLES = 2000
+
+
+class InfluxHandler(http.server.BaseHTTPRequestHandler):
+    """
+    This class is used to accept InfluxDB writes and count the lines received
+    """
+
+    def do_POST(self):
+        """
+        Counts the lines of a /write request
+        """
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.server.lock:
+            self.server.writes += 1
+            self.server.lines += body.count(b"\n") + (1 if body and not body.endswith(b"\n") else 0)
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        # pylint: disable=redefined-builtin
+        pass
+
+
+class InfluxServer(http.server.ThreadingHTTPServer):
+    """
+    This class is used to serve the fake InfluxDB endpoint
+    """
+    daemon_threads = True
+
+    def __init__(self):
+
+        super().__init__(("127.0.0.1", 0), InfluxHandler)
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.lines = 0
+
+
+class MQTTHandler(socketserver.BaseRequestHandler):
+    """
+    This class is used to speak just enough MQTT 3.1.1 to accept a client's publishes
+    """
+
+    def handle(self):
+        while True:
+            header = simulator.recv_exact(self.request, 1)
+            if header is None:
+                return
+            length, shift = 0, 0
+            while True:
+                byte = simulator.recv_exact(self.request, 1)
+                if byte is None:
+                    return
+                length += (byte[0] & 0x7f) << shift
+                shift += 7
+                if not byte[0] & 0x80:
+                    break
+            body = simulator.recv_exact(self.request, length) if length else b""
+            if body is None:
+                return
+            kind = header[0] >> 4
+            if kind == 1:
+                self.request.sendall(b"\x20\x02\x00\x00")
+            elif kind == 3:
+                with self.server.lock:
+                    self.server.messages += 1
+                if (header[0] >> 1) & 3:
+                    topic_length = int.from_bytes(body[:2], "big")
+                    self.request.sendall(b"\x40\x02" + body[2 + topic_length:4 + topic_length])
+            elif kind == 8:
+                granted = bytes(self.count_topics(body[2:]))
+                self.request.sendall(bytes([0x90, 2 + len(granted)]) + body[:2] + granted)
+            elif kind == 10:
+                self.request.sendall(b"\xb0\x02" + body[:2])
+            elif kind == 12:
+                self.request.sendall(b"\xd0\x00")
+            elif kind == 14:
+                return
+
+    @staticmethod
+    def count_topics(payload):
+        """
+        Returns the number of topic filters in a SUBSCRIBE payload
+        """
+        count, pos = 0, 0
+        while pos < len(payload):
+            pos += 2 + int.from_bytes(payload[pos:pos + 2], "big") + 1
+            count += 1
+        return count
+
+
+class MQTTServer(socketserver.ThreadingTCPServer):
+    """
+    This class is used to serve the embedded MQTT broker
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+
+        super().__init__(("127.0.0.1", 0), MQTTHandler)
+        self.lock = threading.Lock()
+        self.messages = 0
+
+
+def serve(server):
+    """
+    Serves a stand-in on a background thread and returns it
+    """
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def rss_mb():
+    """
+    Returns the resident set size of this process in MB
+    """
+    try:
+        with open("/proc/self/statm") as _f:
+            return int(_f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentiles(values):
+    """
+    Returns the p50, p90, p99 and max of a list of seconds, in ms
+    """
+    if len(values) < 2:
+        values = values * 2 or [0.0, 0.0]
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": cuts[49] * 1000, "p90": cuts[89] * 1000, "p99": cuts[98] * 1000,
+            "max": max(values) * 1000}
+
+
+def point_dicts(sample):
+    """
+    Returns the W and Wh points of a sample as the point dicts write_power and write_ha
+    passed to make_lines before the LineEncoder
+    """
+    time_value = getsolar.influx_time(sample.timestamp)
+    fields = {
+        'W': {'Production': getsolar.Field.power_prod, 'Import': getsolar.Field.power_imp,
+              'Export': getsolar.Field.power_exp, 'Load': getsolar.Field.power_load,
+              'Charge': getsolar.Field.power_charge,
+              'Discharge': getsolar.Field.power_discharge,
+              'PV': getsolar.Field.power_pv},
+        '%': {'State of Energy': getsolar.Field.battery_soe},
+        'Wh': {'Production': getsolar.Field.energy_prod, 'Import': getsolar.Field.energy_imp,
+               'Export': getsolar.Field.energy_exp, 'Consumption': getsolar.Field.energy_cons,
+               'Self-Consumption': getsolar.Field.energy_scons,
+               'Charge': getsolar.Field.energy_charge,
+               'Discharge': getsolar.Field.energy_discharge}
+    }
+    points = []
+    for measurement, columns in fields.items():
+        values = {key: sample[field] for key, field in columns.items()
+                  if sample[field] == sample[field]}
+        if values:
+            points.append({'measurement': measurement, 'time': time_value,
+                           'tags': sample.target.tags, 'fields': values})
+    return points
+
+
+def time_serializers(samples):
+    """
+    Times both line protocol encodings over the samples and checks they produce the same lines
+    """
+    started = time.perf_counter()
+    legacy = [make_lines({'points': point_dicts(sample)}, getsolar.TIME_PRECISION).splitlines()
+              for sample in samples]
+    legacy_time = time.perf_counter() - started
+    started = time.perf_counter()
+    fast = [getsolar.POWER_LINES.lines(sample) + getsolar.ENERGY_LINES.lines(sample)
+            for sample in samples]
+    fast_time = time.perf_counter() - started
+    count = max(1, len(samples))
+    return {
+        "samples": len(samples),
+        "make_lines_us": legacy_time * 1e6 / count,
+        "line_encoder_us": fast_time * 1e6 / count,
+        "speedup": legacy_time / fast_time if fast_time else 0.0,
+        "identical": legacy == fast
+    }
+
+
+def take_sample(inv_data, device, batcher, publisher, timings):
+    """
+    Takes one sample through every stage, following InverterData.update and the sinks
+    """
+    started = time.perf_counter()
+    inv_registers = inv_data.read_registers(device, getsolar.INVERTER_FIELDS, inv_data.inv_data)
+    meter = inv_data.topology.meter(device, inv_data.meter_name)
+    meter_registers = inv_data.read_registers(
+        meter, getsolar.METER_FIELDS, inv_data.topology.identity[inv_data.meter_name])
+    battery_registers = {}
+    for name, battery in inv_data.topology.storage(device).items():
+        battery_registers[name] = inv_data.read_registers(
+            battery, getsolar.BATTERY_FIELDS,
+            inv_data.battery_data.get(name) or inv_data.topology.identity[name])
+    read = time.perf_counter()
+    sample = inv_data.record(
+        time.time_ns(), inv_registers, meter_registers, battery_registers,
+        inv_data.scale(inv_registers, meter_registers, battery_registers))
+    scaled = time.perf_counter()
+    getsolar.write_power(batcher, sample)
+    getsolar.write_ha(batcher, sample)
+    serialized = time.perf_counter()
+    getsolar.write_mqtt(publisher, sample)
+    published = time.perf_counter()
+    if len(timings["samples"]) < SERIALIZER_SAMPLES:
+        timings["samples"].append(sample)
+    timings["read"].append(read - started)
+    timings["scale"].append(scaled - read)
+    timings["serialize"].append(serialized - scaled)
+    timings["publish"].append(published - serialized)
+    timings["total"].append(published - started)
+
+
+def parse_args():
+    """
+        configure valid arguments
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark the getsolar poll to publish path against local stand-ins')
+    parser.add_argument('-n', metavar=' ', type=int, default=2000,
+                        help='samples to take [default: 2000]')
+    parser.add_argument('-d', metavar=' ', type=float, default=0.0,
+                        help='run for this many seconds instead [default: 0]')
+    parser.add_argument('-u', metavar=' ', type=int, default=1,
+                        help='modbus units to poll on one session [default: 1]')
+    parser.add_argument('-R', metavar=' ', choices=['minimal', 'full'],
+                        default=getsolar.REGISTER_PROFILE,
+                        help='register profile: minimal or full [default: ' +
+                        getsolar.REGISTER_PROFILE + ']')
+    parser.add_argument('-B', metavar=' ', type=float, default=0.0,
+                        help='simulated battery capacity in Wh, 0 for no battery [default: 0]')
+    parser.add_argument('-l', metavar=' ', type=float, default=0.0,
+                        help='simulator response latency in ms [default: 0]')
+    parser.add_argument('-o', metavar=' ',
+                        help='file to write the JSON report to [default: stdout]')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Runs the benchmark and writes the report
+    """
+    # pylint: disable=too-many-locals
+    # the report gathers everything measured
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    units = {unit: simulator.UnitSimulator(unit, simulator.simulated_clock(12), capacity=args.B)
+             for unit in range(1, args.u + 1)}
+    modbus = serve(simulator.SimulatorServer(
+        ("127.0.0.1", 0), simulator.Simulator(units, latency=args.l / 1000)))
+    influx = serve(InfluxServer())
+    broker = serve(MQTTServer())
+
+    client = InfluxDBClient("127.0.0.1", influx.server_address[1], "", "", getsolar.INFLUX_DB_ALL)
+    batcher = getsolar.InfluxBatcher(client, getsolar.INFLUX_DB_ALL)
+    m_d = mqtt.Client("getsolar-benchmark")
+    mqtt_pub = getsolar.MQTTPublisher(m_d)
+    m_d.connect("127.0.0.1", broker.server_address[1])
+    m_d.loop_start()
+    while not mqtt_pub.connected:
+        time.sleep(0.01)
+    publisher = getsolar.DeadbandPublisher(mqtt_pub)
+
+    targets = [("127.0.0.1", modbus.server_address[1], unit, "unit%s" % unit) for unit in units]
+    session = getsolar.build_sessions(targets, 1, args.R, getsolar.METER_NAME)[0]
+    session.connect()
+    devices = [(session.devices[unit], inv_data) for unit, inv_data in session.targets]
+
+    # Warm up the topology cache and register blocks
+    timings = {stage: [] for stage in STAGES + ["samples"]}
+    for device, inv_data in devices:
+        take_sample(inv_data, device, batcher, publisher, timings)
+    timings = {stage: [] for stage in STAGES + ["samples"]}
+
+    rss = [rss_mb()]
+    samples = 0
+    rss_at = time.monotonic() + RSS_INTERVAL
+    cpu = time.process_time()
+    started = time.perf_counter()
+    while (time.perf_counter() - started < args.d) if args.d else samples < args.n:
+        for device, inv_data in devices:
+            take_sample(inv_data, device, batcher, publisher, timings)
+            samples += 1
+        if time.monotonic() >= rss_at:
+            rss.append(rss_mb())
+            rss_at += RSS_INTERVAL
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu
+    rss.append(rss_mb())
+    serializer = time_serializers(timings.pop("samples"))
+
+    batcher.close()
+    m_d.loop_stop()
+    m_d.disconnect()
+    time.sleep(0.2)
+
+    report = {
+        "version": getsolar.VERSION,
+        "python": sys.version.split()[0],
+        "profile": args.R,
+        "units": args.u,
+        "battery": args.B,
+        "samples": samples,
+        "seconds": elapsed,
+        "samples_per_second": samples / elapsed if elapsed else 0.0,
+        "cpu_ms_per_sample": cpu * 1000 / samples if samples else 0.0,
+        "latency_ms": {stage: percentiles(values) for stage, values in timings.items()},
+        "rss_mb": {"start": rss[0], "end": rss[-1], "max": max(rss)},
+        "serializer": serializer,
+        "influx": {"writes": influx.writes, "lines": influx.lines},
+        "mqtt": {"messages": broker.messages, "suppressed": publisher.suppressed}
+    }
+    output = json.dumps(report, indent=2)
+    if args.o:
+        with open(args.o, "w") as _f:
+            _f.write(output + "\n")
+    else:
+        print(output)
+    for server in (modbus, influx, broker):
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
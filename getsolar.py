@@ -5,16 +5,47 @@
 from keyrings.alt.file import PlaintextKeyring
 import keyring.backend
 from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError
+from influxdb.line_protocol import make_lines
 import paho.mqtt.client as mqtt
 import solaredge_modbus
 import argparse
+import array
+import asyncio
+import collections
+import concurrent.futures
+import enum
+import hashlib
+import http.server
 import json
+import queue
+import random
+import signal
+import struct
+import threading
+import urllib.parse
 import syslog
 import logging
 import time
-import datetime
 import os
 import sys
+import zlib
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
 
 VERSION = 'v1.3.1'
 
@@ -38,11 +69,30 @@ V1.3.0
 v1.2 - update code to comply with pylint coding standards
 
   options:
+      -C: configuration file, re-read on SIGHUP (default: /etc/getsolar/getsolar.toml)
       -t: transport type: tcp or rtu (default: tcp)
       -i: ip address to use for modbus tcp (default: localhost)
       -P: port number for modbus tcp (default: 502)
       -p: serial port for modbus rtu (default: /dev/ttyUSB0)
       -b: baud rate for modbus rtu (default: 9600)
+      -T: additional target host[:port[:unit[:name]]] (may be repeated)
+      -m: meter to read (default: Meter1)
+      -R: register profile: minimal or full (default: minimal)
+      -Q: sink queue full policy: drop-oldest, drop-newest or block (default: drop-oldest)
+      -S: directory for the influx write spool, empty to disable (default: /var/tmp/getsolar)
+      -B: influx points per write (default: 100)
+      -F: maximum seconds between influx writes (default: 10)
+      -I: poll interval in seconds, fractions allowed (default: 10)
+      -K: missed poll deadline policy: skip or catch-up (default: skip)
+      -H: local port for sample history queries and /metrics, 0 to disable (default: 8089)
+      -M: also write metrics to influx every minute
+      -E: integrate energy counters from power samples
+      -W: do not write min/max/mean/Wh rollups
+      -A: run the poll loop and sinks on an asyncio event loop (needs aiohttp)
+      -G: local port for health checks with -A, 0 to disable (default: 8090)
+      -Z: directory for the parquet sample archive, empty to disable (needs pyarrow)
+      -X: directory to capture raw registers to for replays, empty to disable (default: empty)
+      -Y: replay a capture file or directory into influx and exit (may be repeated)
       -D: debug mode (do not read any data)
 
 Solaredge Register Details
@@ -168,17 +218,270 @@ IMPORT_TOPIC = "house/solaredge/power/import"
 LOAD_TOPIC = "house/solaredge/power/load"
 INVERTER_TOPIC = "house/solaredge/inverter/state"
 METER_TOPIC = "house/solaredge/meter/state"
+BATTERY_TOPIC = "house/solaredge/battery/state"
+
+# MQTT delivery - state payloads are published with the QoS of the first MQTT_QOS topic filter
+# matching their topic, MQTT_QOS_DEFAULT otherwise. While the broker is unreachable only the latest
+# payload of each topic is kept (at most MQTT_MAX_TOPICS topics) and the latest state of every
+# topic is republished as soon as the client reconnects. MQTT_MAX_QUEUED bounds the QoS 1 and 2
+# messages held by paho until the broker acknowledges them
+
+MQTT_QOS_DEFAULT = 0
+MQTT_QOS = {
+    "house/solaredge/power/production": 1,
+    "house/solaredge/+/power/production": 1
+}
+MQTT_MAX_TOPICS = 256
+MQTT_MAX_QUEUED = 1000
+
+# Home Assistant discovery
+#   device, key, name, state, template, unit, icon, device_class, state_class, unique
+#   state selects the state topic: inverter, meter, battery or power
+#   battery sensors are only published when the inverter reports a battery
+#   unique overrides key in the unique_id where an earlier release used a different suffix
+
+DISCOVERY_WAIT = 2
+DISCOVERY_CACHE = '/var/tmp/getsolar/discovery.json'
+DiscoverySensor = collections.namedtuple("DiscoverySensor", [
+    "device", "key", "name", "state", "template", "unit", "icon", "device_class", "state_class",
+    "unique"], defaults=[None])
+DISCOVERY_SENSORS = [
+    DiscoverySensor("inverter", "_AC_cur_A", "Inverter AC Current A", "inverter",
+                    "{{ value_json.l1_current|round(2) }}",
+                    "A", "mdi:current-ac", "current", "measurement"),
+    DiscoverySensor("inverter", "_AC_cur_B", "Inverter AC Current B", "inverter",
+                    "{{ value_json.l2_current|round(2) }}",
+                    "A", "mdi:current-ac", "current", "measurement"),
+    DiscoverySensor("inverter", "_AC_cur_C", "Inverter AC Current C", "inverter",
+                    "{{ value_json.l3_current|round(2) }}",
+                    "A", "mdi:current-ac", "current", "measurement"),
+    DiscoverySensor("inverter", "_AC_cur", "Inverter AC Current", "inverter",
+                    "{{ value_json.current|round(2) }}",
+                    "A", "mdi:current-ac", "current", "measurement"),
+    DiscoverySensor("inverter", "_AC_Energy", "Inverter Lifetime Energy", "inverter",
+                    "{{ (value_json.energy_total / 1000000)|round(3) }}",
+                    "MWh", "mdi:electron-framework", "energy", "total_increasing"),
+    DiscoverySensor("inverter", "_AC_Freq", "Inverter Frequency", "inverter",
+                    "{{ value_json.frequency|round(2) }}",
+                    "Hz", "mdi:sine-wave", "frequency", "measurement"),
+    DiscoverySensor("inverter", "_AC_PF", "Inverter Power Factor", "inverter",
+                    "{{ value_json.power_factor|round(2) }}",
+                    "%", "mdi:percent", "power_factor", "measurement"),
+    DiscoverySensor("inverter", "_AC_Power", "Inverter Power", "inverter",
+                    "{{ (value_json.power_ac / 1000)|round(3) }}",
+                    "kW", "mdi:solar-power", "power", "measurement"),
+    DiscoverySensor("inverter", "_AC_VA", "Inverter Apparent Power", "inverter",
+                    "{{ (value_json.power_apparent / 1000)|round(3) }}",
+                    "kVA", "mdi:solar-power", "apparent_power", "measurement"),
+    DiscoverySensor("inverter", "_AC_VAR", "Inverter Reactive Power", "inverter",
+                    "{{ (value_json.power_reactive / 1000)|round(3) }}",
+                    "kvar", "mdi:solar-power", "reactive_power", "measurement"),
+    DiscoverySensor("inverter", "_AC_Voltage", "Inverter AC Voltage", "inverter",
+                    "{{ value_json.l1_voltage|round(2) }}",
+                    "V", "mdi:power-socket-au", "voltage", "measurement"),
+    DiscoverySensor("inverter", "_DC_Current", "Inverter DC Current", "inverter",
+                    "{{ value_json.current_dc|round(2) }}",
+                    "A", "mdi:current-dc", "current", "measurement"),
+    DiscoverySensor("inverter", "_DC_Power", "Inverter DC Power", "inverter",
+                    "{{ (value_json.power_dc / 1000)|round(2) }}",
+                    "kW", "mdi:solar-power", "power", "measurement"),
+    DiscoverySensor("inverter", "_DC_Voltage", "Inverter DC Voltage", "inverter",
+                    "{{ value_json.voltage_dc|round(2) }}",
+                    "V", "mdi:power-socket-au", "voltage", "measurement"),
+    DiscoverySensor("inverter", "_Temperature", "Inverter Temperature", "inverter",
+                    "{{ value_json.temperature|round(2) }}",
+                    "°C", "mdi:thermometer", "temperature", "measurement"),
+    DiscoverySensor("inverter", "_Inv_Status", "Inverter Status", "inverter",
+                    "{{ value_json.status }}",
+                    None, "mdi:star-three-points", None, None, "Inv_Status"),
+    DiscoverySensor("inverter", "_Vendor_Stat", "Inverter Vendor Status", "inverter",
+                    "{{ value_json.vendor_status }}",
+                    None, "mdi:star-three-points", None, None),
+    DiscoverySensor("meter", "_load", "Meter Load", "power",
+                    "{{ (value_json.load)|round(2) }}",
+                    "kW", "mdi:solar-power", "power", "measurement"),
+    DiscoverySensor("meter", "_production", "Meter Production", "power",
+                    "{{ (value_json.production)|round(2) }}",
+                    "kW", "mdi:solar-power", "power", "measurement"),
+    DiscoverySensor("meter", "_import", "Meter Import", "power",
+                    "{{ (value_json.import)|round(2) }}",
+                    "kW", "mdi:solar-power", "power", "measurement"),
+    DiscoverySensor("meter", "_export", "Meter Export", "power",
+                    "{{ (value_json.export)|round(2) }}",
+                    "kW", "mdi:solar-power", "power", "measurement"),
+    DiscoverySensor("meter", "_current", "Meter Current", "meter",
+                    "{{ value_json.current|round(2) }}",
+                    "A", "mdi:current-ac", "current", "measurement"),
+    DiscoverySensor("meter", "_line_voltage", "Meter Line Voltage", "meter",
+                    "{{ value_json.voltage_ln|round(2) }}",
+                    "V", "mdi:power-socket-au", "voltage", "measurement"),
+    DiscoverySensor("meter", "_frequency", "Meter Frequency", "meter",
+                    "{{ value_json.frequency|round(2) }}",
+                    "Hz", "mdi:sine-wave", "frequency", "measurement"),
+    DiscoverySensor("meter", "_real_power", "Meter Real Power", "meter",
+                    "{{ value_json.power|round(3) }}",
+                    "W", "mdi:solar-power", "power", "measurement"),
+    DiscoverySensor("meter", "_power_apparent", "Meter Apparent Power", "meter",
+                    "{{ value_json.power_apparent|round(3) }}",
+                    "VA", "mdi:solar-power", "apparent_power", "measurement"),
+    DiscoverySensor("meter", "_power_reactive", "Meter Reactive Power", "meter",
+                    "{{ value_json.power_reactive|round(3) }}",
+                    "VAR", "mdi:solar-power", "reactive_power", "measurement"),
+    DiscoverySensor("meter", "_power_factor", "Meter Power Factor", "meter",
+                    "{{ value_json.power_factor|round(2) }}",
+                    "%", "mdi:percent", "power_factor", "measurement"),
+    DiscoverySensor("meter", "_lifetime_energy_export", "Meter Lifetime Energy Export", "meter",
+                    "{{ (value_json.export_energy_active / 1000000)|round(3) }}",
+                    "MWh", "mdi:electron-framework", "energy", "total_increasing"),
+    DiscoverySensor("meter", "_lifetime_energy_import", "Meter Lifetime Energy Import", "meter",
+                    "{{ (value_json.import_energy_active / 1000000)|round(3) }}",
+                    "MWh", "mdi:electron-framework", "energy", "total_increasing"),
+    DiscoverySensor("battery", "_charge", "Battery Charge Power", "power",
+                    "{{ (value_json.charge)|round(2) }}",
+                    "kW", "mdi:battery-charging", "power", "measurement"),
+    DiscoverySensor("battery", "_discharge", "Battery Discharge Power", "power",
+                    "{{ (value_json.discharge)|round(2) }}",
+                    "kW", "mdi:battery-minus", "power", "measurement"),
+    DiscoverySensor("battery", "_pv", "PV Production", "power",
+                    "{{ (value_json.pv)|round(2) }}",
+                    "kW", "mdi:solar-power", "power", "measurement"),
+    DiscoverySensor("battery", "_soe", "Battery State of Energy", "battery",
+                    "{{ value_json.soe|round(1) }}",
+                    "%", "mdi:battery", "battery", "measurement"),
+    DiscoverySensor("battery", "_soh", "Battery State of Health", "battery",
+                    "{{ value_json.soh|round(1) }}",
+                    "%", "mdi:battery-heart-variant", None, None),
+    DiscoverySensor("battery", "_available_energy", "Battery Available Energy", "battery",
+                    "{{ (value_json.available_energy / 1000)|round(2) }}",
+                    "kWh", "mdi:battery", "energy_storage", "measurement"),
+    DiscoverySensor("battery", "_voltage", "Battery Voltage", "battery",
+                    "{{ value_json.instantaneous_voltage|round(1) }}",
+                    "V", "mdi:current-dc", "voltage", "measurement"),
+    DiscoverySensor("battery", "_temperature", "Battery Temperature", "battery",
+                    "{{ value_json.average_temperature|round(1) }}",
+                    "°C", "mdi:thermometer", "temperature", "measurement"),
+    DiscoverySensor("battery", "_lifetime_energy_charge", "Battery Lifetime Energy Charged",
+                    "battery",
+                    "{{ (value_json.lifetime_import_energy_counter / 1000000)|round(3) }}",
+                    "MWh", "mdi:electron-framework", "energy", "total_increasing"),
+    DiscoverySensor("battery", "_lifetime_energy_discharge", "Battery Lifetime Energy Discharged",
+                    "battery",
+                    "{{ (value_json.lifetime_export_energy_counter / 1000000)|round(3) }}",
+                    "MWh", "mdi:electron-framework", "energy", "total_increasing"),
+    DiscoverySensor("battery", "_status", "Battery Status", "battery",
+                    "{{ value_json.status }}",
+                    None, "mdi:star-three-points", None, None)
+]
+
+# MQTT state deadbands
+#   a state payload is only published when a field moves further than its deadband from the
+#   last published value, or when DEADBAND_MAX_SILENCE seconds have passed since the last publish
+#   ('abs', n) - absolute change in the published units
+#   ('rel', n) - change relative to the last published value
+#   non-numeric fields publish on any change
+
+DEADBAND_MAX_SILENCE = 60
+DEADBAND_DEFAULT = ('rel', 0.005)
+DEADBANDS = {
+    "status": ('abs', 0),
+    "vendor_status": ('abs', 0),
+    "production": ('abs', 0.01),
+    "export": ('abs', 0.01),
+    "import": ('abs', 0.01),
+    "load": ('abs', 0.01),
+    "charge": ('abs', 0.01),
+    "discharge": ('abs', 0.01),
+    "pv": ('abs', 0.01),
+    "soe": ('abs', 0.1),
+    "soh": ('abs', 0.1)
+}
+
+# Sample history - recent samples kept in memory and served on a local HTTP endpoint
+
+HISTORY_HOURS = 6
+HISTORY_HOST = '127.0.0.1'
+HISTORY_PORT = 8089
+
+# Sample archive - every sample written to Parquet files under ARCHIVE_DIR, partitioned as
+# device=<name>/date=<UTC day>/<period start>.parquet with one file per ARCHIVE_PERIOD ('hour' or
+# 'day'). Columns are time plus one float64 per Field (NaN where not read); ARCHIVE_ROWS samples
+# are buffered per row group. A file is readable once its period ends or getsolar stops
+
+ARCHIVE_DIR = ''
+ARCHIVE_PERIOD = 'hour'
+ARCHIVE_ROWS = 3600
+ARCHIVE_COMPRESSION = 'zstd'
+
+# Metrics - counters, gauges and latency histograms served on /metrics of the history port and
+# optionally written to Influx every METRICS_WRITE_TIME seconds
+
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_WRITE_TIME = 60
+METRICS_DB = 'solar'
+METRICS_RP = None
+METRICS_HELP = {
+    "getsolar_modbus_reads_total": ("counter", "Modbus unit reads"),
+    "getsolar_modbus_read_failures_total": ("counter", "Modbus unit reads that failed"),
+    "getsolar_modbus_timeouts_total": ("counter", "Modbus polls in which no unit gave a valid response"),
+    "getsolar_modbus_reconnects_total": ("counter", "Modbus sessions re-established"),
+    "getsolar_modbus_connected": ("gauge", "1 while the Modbus session is open"),
+    "getsolar_modbus_read_seconds": ("histogram", "Time to read one unit"),
+    "getsolar_poll_seconds": ("histogram", "Time to poll every session"),
+    "getsolar_poll_overruns_total": ("counter", "Polls that started after their deadline"),
+    "getsolar_poll_missed_total": ("counter", "Poll deadlines missed"),
+    "getsolar_sink_samples_total": ("counter", "Samples handled by each sink, by result"),
+    "getsolar_sink_queue_depth": ("gauge", "Samples waiting in each sink queue"),
+    "getsolar_influx_write_seconds": ("histogram", "Time to write one batch to InfluxDB"),
+    "getsolar_influx_points_total": ("counter", "Points accepted by InfluxDB"),
+    "getsolar_influx_points_spooled_total": ("counter",
+                                             "Points kept in the spool after a failed write"),
+    "getsolar_influx_write_failures_total": ("counter", "InfluxDB batch writes that failed"),
+    "getsolar_influx_points_rejected_total": ("counter",
+                                              "Points dropped because InfluxDB rejected them"),
+    "getsolar_mqtt_messages_total": ("counter", "MQTT state payloads, by result"),
+    "getsolar_mqtt_connected": ("gauge", "1 while the MQTT client is connected to the broker")
+}
+
+# Asyncio runtime - health endpoint served on the event loop
+
+HEALTH_HOST = '127.0.0.1'
+HEALTH_PORT = 8090
+HEALTH_TIMEOUT = 5
 
 # Initialise Influxdb data object
 INFLUX_USER = 'telegraf'
 INFLUX_DB_ALL = 'solar'
 INFLUX_DB_POWER = 'solar'
+INFLUX_RP_ALL = None
+INFLUX_RP_POWER = None
 INFLUX_HOST = 'ha.smcallister.org'
 INFLUX_PORT = "8086"
 INFLUX_DOMAIN = 'solaredge'
 INFLUX_ENTITY = 'meters'
 INFLUX_PASSWORD = ''
 
+# Rollups - min/max/mean and integrated Wh of each power field over tumbling windows,
+# written to their own measurement, database (None for INFLUX_DB_POWER) and retention policy.
+# Gaps between samples longer than ROLLUP_MAX_GAP seconds are not integrated
+
+RollupWindow = collections.namedtuple("RollupWindow", [
+    "seconds", "measurement", "database", "retention_policy"])
+ROLLUP_WINDOWS = [
+    RollupWindow(60, 'W_1m', None, None),
+    RollupWindow(900, 'W_15m', None, None),
+    RollupWindow(3600, 'W_1h', None, None)
+]
+ROLLUP_FIELDS = {
+    "Production": "power_prod",
+    "Import": "power_imp",
+    "Export": "power_exp",
+    "Load": "power_load",
+    "Charge": "power_charge",
+    "Discharge": "power_discharge",
+    "PV": "power_pv"
+}
+ROLLUP_MAX_GAP = 60
+
 # Initialise syslog settings
 
 _ID = 'getsolar ' + VERSION
@@ -186,13 +489,279 @@ LOG_FACILITY_LOCAL_N = 1
 
 # Initialise globals
 
-SLEEP_TIME = 10
+SLEEP_TIME = 10.0
+SCHEDULE_POLICY = 'skip'
+SCHEDULE_MAX_CATCHUP = 10
+TIME_PRECISION = 'ms'
+TIME_DIVISOR = {'s': 10**9, 'ms': 10**6, 'u': 10**3, 'n': 1}
 WAIT_TIME = 1
 MAX_RETRIES = 5
-MAX_COUNTER = 5
+RECONNECT_MAX_TIME = 300
+RECONNECT_JITTER = 0.2
+SESSION_REPORT_TIME = 3600
+METER_NAME = "Meter1"
+SINK_QUEUE_DEPTH = 360
+SINK_POLICY = 'drop-oldest'
+SINK_BLOCK_TIME = 1
+SINK_REPORT_TIME = 3600
+INFLUX_BATCH_SIZE = 100
+INFLUX_FLUSH_TIME = 10.0
+
+# Influx write spool - points are kept on disk until InfluxDB acknowledges them
+
+SPOOL_DIR = '/var/tmp/getsolar'
+SPOOL_MAX_BYTES = 64 * 1024 * 1024
+SPOOL_MAX_AGE = 7 * 24 * 3600
+SPOOL_BATCH = 5000
+SPOOL_RETRY_TIME = 30
+SPOOL_FSYNC = False
+TOPOLOGY_REFRESH = 3600
+
+# Register capture - the raw registers behind every sample are appended to one file per target and
+# UTC day in CAPTURE_DIR (empty to disable), so Influx can be rebuilt from them with -Y after an
+# outage or a scaling fix. Each file is a series of frames: an 'H' frame holding the JSON layout of
+# the devices and fields that follow, and 'R' frames holding a zlib compressed block of records
+# written every CAPTURE_FLUSH_TIME seconds. A record is an int64 ns timestamp and one float64 per
+# field (exact for every register type read), NaN where a field was not read. Replays write
+# REPLAY_BATCH points per request
+
+CAPTURE_DIR = ''
+CAPTURE_FLUSH_TIME = 60
+CAPTURE_VERSION = 1
+REPLAY_BATCH = 10000
+
+# Energy integration - derive energy counters from the power samples between readings of the
+# coarse hardware counters
+
+ENERGY_INTEGRATION = False
+ENERGY_MAX_GAP = 60
+ENERGY_ANCHOR_TIME = 900
+ENERGY_COUNTERS = {
+    "energy_prod": "power_prod",
+    "energy_imp": "power_imp",
+    "energy_exp": "power_exp"
+}
 # PID_FILE = '/var/run/getsolar/getsolar.pid'
 DEBUG = False
 
+# Register profiles
+#   'minimal' - read only the contiguous register blocks holding the fields listed below
+#   'full'    - read the complete register map with read_all() every cycle
+# The minimal profile falls back to read_all() whenever a block read is incomplete
+
+REGISTER_PROFILE = 'minimal'
+MAX_BLOCK_GAP = 8
+MAX_BLOCK_LENGTH = 125
+INVERTER_FIELDS = [
+    "current", "l1_current", "l2_current", "l3_current", "current_scale",
+    "l1_voltage", "voltage_scale",
+    "power_ac", "power_ac_scale",
+    "frequency", "frequency_scale",
+    "power_apparent", "power_apparent_scale",
+    "power_reactive", "power_reactive_scale",
+    "power_factor", "power_factor_scale",
+    "energy_total", "energy_total_scale",
+    "current_dc", "current_dc_scale",
+    "voltage_dc", "voltage_dc_scale",
+    "power_dc", "power_dc_scale",
+    "temperature", "temperature_scale",
+    "status", "vendor_status"
+]
+METER_FIELDS = [
+    "current", "current_scale",
+    "voltage_ln", "voltage_scale",
+    "frequency", "frequency_scale",
+    "power", "power_scale",
+    "power_apparent", "power_apparent_scale",
+    "power_reactive", "power_reactive_scale",
+    "power_factor", "power_factor_scale",
+    "export_energy_active", "import_energy_active", "energy_active_scale"
+]
+BATTERY_FIELDS = [
+    "average_temperature",
+    "instantaneous_voltage", "instantaneous_current", "instantaneous_power",
+    "lifetime_export_energy_counter", "lifetime_import_energy_counter",
+    "maximum_energy", "available_energy",
+    "soh", "soe",
+    "status"
+]
+
+# Engineering values - each published field and the scale factor register that applies to it
+#   fields mapped to None are published unscaled
+
+POWERS_OF_TEN = [10 ** n for n in range(16)]
+INVERTER_SCALES = {
+    "current": "current_scale",
+    "l1_current": "current_scale",
+    "l2_current": "current_scale",
+    "l3_current": "current_scale",
+    "l1_voltage": "voltage_scale",
+    "power_ac": "power_ac_scale",
+    "frequency": "frequency_scale",
+    "power_apparent": "power_apparent_scale",
+    "power_reactive": "power_reactive_scale",
+    "power_factor": "power_factor_scale",
+    "energy_total": "energy_total_scale",
+    "current_dc": "current_dc_scale",
+    "voltage_dc": "voltage_dc_scale",
+    "power_dc": "power_dc_scale",
+    "temperature": "temperature_scale",
+    "status": None,
+    "vendor_status": None
+}
+METER_SCALES = {
+    "current": "current_scale",
+    "voltage_ln": "voltage_scale",
+    "frequency": "frequency_scale",
+    "power": "power_scale",
+    "power_apparent": "power_apparent_scale",
+    "power_reactive": "power_reactive_scale",
+    "power_factor": "power_factor_scale",
+    "export_energy_active": "energy_active_scale",
+    "import_energy_active": "energy_active_scale"
+}
+BATTERY_SCALES = {field: None for field in BATTERY_FIELDS}
+CODE_FIELDS = ["status", "vendor_status"]
+
+# Registers a sample cannot be built without, and the identity registers HA discovery is built from.
+# read_all() leaves out every register of a batch that got no response, and a read missing any of
+# these counts as a failed poll. Captures hold no identity registers
+
+REQUIRED_REGISTERS = {
+    "inverter": ["power_ac", "power_ac_scale", "energy_total", "energy_total_scale"],
+    "meter": ["power", "power_scale",
+              "export_energy_active", "import_energy_active", "energy_active_scale"],
+    "battery": ["instantaneous_power",
+                "lifetime_export_energy_counter", "lifetime_import_energy_counter"]
+}
+IDENTITY_REGISTERS = ["c_manufacturer", "c_model", "c_version", "c_serialnumber"]
+
+# Battery flows - batteries report instantaneous_power positive while charging. StorEdge batteries
+# are DC coupled, so the inverter AC output already includes them: Production stays the AC output,
+# matching the inverter energy counter, and the house load is production - export + import. PV
+# production is the AC output plus charge less discharge and is published separately
+
+# Sample layout - every sample holds these values in a fixed array('d') indexed by Field
+#   power_* in W, energy_* in Wh, inverter_*, meter_* and battery_* as listed in the *_SCALES tables
+#   battery values are summed over all batteries and stay NaN without one
+
+SAMPLE_FIELDS = ["power_prod", "power_imp", "power_exp", "power_load",
+                 "power_charge", "power_discharge", "power_pv",
+                 "energy_prod", "energy_imp", "energy_exp", "energy_cons", "energy_scons",
+                 "energy_charge", "energy_discharge"] + \
+    ["inverter_" + field for field in INVERTER_SCALES] + \
+    ["meter_" + field for field in METER_SCALES] + \
+    ["battery_" + field for field in BATTERY_SCALES]
+Field = enum.IntEnum("Field", SAMPLE_FIELDS, start=0)
+EMPTY_SAMPLE = array.array('d', [float('nan')] * len(Field))
+DEVICE_FIELDS = {
+    "inverter": [(field, Field["inverter_" + field], field in CODE_FIELDS)
+                 for field in INVERTER_SCALES],
+    "meter": [(field, Field["meter_" + field], field in CODE_FIELDS)
+              for field in METER_SCALES],
+    "battery": [(field, Field["battery_" + field], field in CODE_FIELDS)
+                for field in BATTERY_SCALES]
+}
+SampleTarget = collections.namedtuple("SampleTarget", [
+    "name", "tags", "power_topic", "inverter_topic", "meter_topic", "battery_topic"])
+
+# Configuration file - TOML [section] keys that override the settings above. Command line options
+# still take precedence at startup. Live settings are applied to the running daemon on SIGHUP,
+# changes to the others wait for a restart. Kinds are str, int, float, bool, port, optional
+# (empty for None), deadband ([mode, band]), deadbands (a table of deadbands), qos (0, 1 or 2),
+# qos_table (a table of topic filters and QoS) or a tuple of choices
+
+CONFIG_FILE = '/etc/getsolar/getsolar.toml'
+ConfigKey = collections.namedtuple("ConfigKey", ["setting", "kind", "live"])
+CONFIG_KEYS = {
+    "mqtt": {
+        "host": ConfigKey("MQTT_HOST", "str", False),
+        "port": ConfigKey("MQTT_PORT", "port", False),
+        "user": ConfigKey("MQTT_USER", "str", False),
+        "client_name": ConfigKey("MQTT_CLIENT_NAME", "str", False),
+        "discovery_prefix": ConfigKey("AUTODISCOVERY_PREFIX", "str", False),
+        "qos_default": ConfigKey("MQTT_QOS_DEFAULT", "qos", False),
+        "qos": ConfigKey("MQTT_QOS", "qos_table", False),
+        "max_topics": ConfigKey("MQTT_MAX_TOPICS", "int", False),
+        "max_queued": ConfigKey("MQTT_MAX_QUEUED", "int", False)
+    },
+    "topics": {
+        "power": ConfigKey("POWER_TOPIC", "str", False),
+        "inverter": ConfigKey("INVERTER_TOPIC", "str", False),
+        "meter": ConfigKey("METER_TOPIC", "str", False),
+        "battery": ConfigKey("BATTERY_TOPIC", "str", False)
+    },
+    "influx": {
+        "host": ConfigKey("INFLUX_HOST", "str", False),
+        "port": ConfigKey("INFLUX_PORT", "port", False),
+        "user": ConfigKey("INFLUX_USER", "str", False),
+        "db_all": ConfigKey("INFLUX_DB_ALL", "str", False),
+        "db_power": ConfigKey("INFLUX_DB_POWER", "str", False),
+        "rp_all": ConfigKey("INFLUX_RP_ALL", "optional", False),
+        "rp_power": ConfigKey("INFLUX_RP_POWER", "optional", False),
+        "domain": ConfigKey("INFLUX_DOMAIN", "str", False),
+        "entity": ConfigKey("INFLUX_ENTITY", "str", False),
+        "batch_size": ConfigKey("INFLUX_BATCH_SIZE", "int", True),
+        "flush_time": ConfigKey("INFLUX_FLUSH_TIME", "float", True)
+    },
+    "poll": {
+        "interval": ConfigKey("SLEEP_TIME", "float", True),
+        "policy": ConfigKey("SCHEDULE_POLICY", ("skip", "catch-up"), True),
+        "max_catchup": ConfigKey("SCHEDULE_MAX_CATCHUP", "int", True),
+        "profile": ConfigKey("REGISTER_PROFILE", ("minimal", "full"), True),
+        "meter": ConfigKey("METER_NAME", "str", True),
+        "topology_refresh": ConfigKey("TOPOLOGY_REFRESH", "int", True)
+    },
+    "modbus": {
+        "wait_time": ConfigKey("WAIT_TIME", "float", True),
+        "reconnect_max_time": ConfigKey("RECONNECT_MAX_TIME", "float", True),
+        "reconnect_jitter": ConfigKey("RECONNECT_JITTER", "float", True),
+        "report_time": ConfigKey("SESSION_REPORT_TIME", "float", True)
+    },
+    "deadband": {
+        "max_silence": ConfigKey("DEADBAND_MAX_SILENCE", "float", True),
+        "default": ConfigKey("DEADBAND_DEFAULT", "deadband", True),
+        "fields": ConfigKey("DEADBANDS", "deadbands", True)
+    },
+    "sinks": {
+        "queue_depth": ConfigKey("SINK_QUEUE_DEPTH", "int", False),
+        "policy": ConfigKey("SINK_POLICY", ("drop-oldest", "drop-newest", "block"), True),
+        "block_time": ConfigKey("SINK_BLOCK_TIME", "float", True),
+        "report_time": ConfigKey("SINK_REPORT_TIME", "float", True)
+    },
+    "spool": {
+        "dir": ConfigKey("SPOOL_DIR", "str", False),
+        "max_bytes": ConfigKey("SPOOL_MAX_BYTES", "int", True),
+        "max_age": ConfigKey("SPOOL_MAX_AGE", "int", True),
+        "batch": ConfigKey("SPOOL_BATCH", "int", True),
+        "retry_time": ConfigKey("SPOOL_RETRY_TIME", "float", True),
+        "fsync": ConfigKey("SPOOL_FSYNC", "bool", True)
+    },
+    "capture": {
+        "dir": ConfigKey("CAPTURE_DIR", "str", False),
+        "flush_time": ConfigKey("CAPTURE_FLUSH_TIME", "float", True),
+        "replay_batch": ConfigKey("REPLAY_BATCH", "int", False)
+    },
+    "energy": {
+        "integrate": ConfigKey("ENERGY_INTEGRATION", "bool", False)
+    },
+    "history": {
+        "port": ConfigKey("HISTORY_PORT", "int", False),
+        "hours": ConfigKey("HISTORY_HOURS", "float", False)
+    },
+    "archive": {
+        "dir": ConfigKey("ARCHIVE_DIR", "str", False),
+        "period": ConfigKey("ARCHIVE_PERIOD", ("hour", "day"), False),
+        "rows": ConfigKey("ARCHIVE_ROWS", "int", False),
+        "compression": ConfigKey("ARCHIVE_COMPRESSION", ("zstd", "snappy", "gzip", "none"), False)
+    },
+    "metrics": {
+        "write_time": ConfigKey("METRICS_WRITE_TIME", "float", True),
+        "db": ConfigKey("METRICS_DB", "str", True),
+        "rp": ConfigKey("METRICS_RP", "optional", True)
+    }
+}
+
 
 class SysLogLibHandler(logging.Handler):
     """A logging handler that emits messages to syslog.syslog."""
@@ -229,947 +798,3218 @@ class SysLogLibHandler(logging.Handler):
         syslog.syslog(self.format(record))
 
 
-class InverterData():
+class Metrics():
     """
-    This class is used to hold data read from the inverter
+    This class is used to collect counters, gauges and latency histograms, described in
+    METRICS_HELP, and render them in the Prometheus text format. Labels are keyword arguments
     """
-    # pylint: disable=too-many-instance-attributes
-    # Eleven is reasonable in this case.
 
-    def __init__(self):
+    def __init__(self, buckets=METRICS_BUCKETS):
 
-        self.new = True
-        self.timestamp = ""
-        self.power = {
-            "prod": 0.0,
-            "imp": 0.0,
-            "exp": 0.0,
-            "load": 0.0
-        }
-#        self.power_prod = 0.0
-#        self.power_imp = 0.0
-#        self.power_exp = 0.0
-#        self.power_load = 0.0
-        self.energy = {
-            "prod": 0.0,
-            "imp": 0.0,
-            "exp": 0.0,
-            "cons": 0.0,
-            "s-cons": 0.0
-        }
-#        self.energy_prod_delta = 0.0
-#        self.energy_imp_delta = 0.0
-#        self.energy_exp_delta = 0.0
+        self.buckets = buckets
+        self.values = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
 
-        self.inv_data = {}
-        self.meter_data = {}
-        self.inverterUniqueIDPrefix = ""
-        self.meterUniqueIDPrefix = ""
-        self.inverterDiscoveryTopic = ""
-        self.meterDiscoveryTopic = ""
-        self.inverterPayload = {
-            "device": {
-                "identifiers": "",
-                "manufacturer": "",
-                "model": "",
-                "name": "Solaredge Inverter",
-                        "sw_version": ""
-            },
-            "icon": "",
-                    "name": "",
-                    "state_topic": "",
-                    "unique_id": "",
-                    "value_template": "",
-                    "unit_of_measurement": "",
-                    "platform": "mqtt"
-        }
-        self.meterPayload = {
-            "device": {
-                "identifiers": "",
-                "manufacturer": "",
-                "model": "",
-                "name": "Solaredge Meter",
-                        "sw_version": ""
-            },
-            "icon": "",
-                    "name": "",
-                    "state_topic": "",
-                    "unique_id": "",
-                    "value_template": "",
-                    "unit_of_measurement": "",
-                    "platform": "mqtt"
-        }
+    def inc(self, name, value=1, **labels):
+        """
+        Adds to a counter
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
 
-        d_d = InfluxDBClient(INFLUX_HOST, INFLUX_PORT,
-                             INFLUX_USER, INFLUX_PASSWORD, INFLUX_DB_ALL)
-        # Setup 'last' energy counters
-        # Energy data over an interval = current data - last recorded data
-
-#        result = d_d.query(
-#            'select sum(Production) as Production,sum(Export) as Export ,sum(Import) as Import from Wh')
-#        logging.debug("Result: %s", result.raw)
-#        points = result.get_points()
-#        for point in points:
-#            self.energy_prod = point['Production']
-#            self.energy_exp = point['Export']
-#            self.energy_imp = point['Import']
+    def set(self, name, value, **labels):
+        """
+        Sets a gauge
+        """
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
 
-    def update(self, s_d):
+    def observe(self, name, seconds, **labels):
         """
-        Read inverter registers
+        Adds an observation in seconds to a histogram
         """
-        # pylint: disable=broad-except
-        # broad exception is reasonable in this case as exceptions are not inherited from the class pymodbus
-        # by solaredge_modbus
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = [0] * len(self.buckets) + [0, 0.0]
+            histogram = self.histograms[key]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text format
+        """
+        with self.lock:
+            values = dict(self.values)
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+        lines = []
+        for name, (kind, text) in METRICS_HELP.items():
+            series = [(labels, value) for (metric, labels), value in values.items()
+                      if metric == name]
+            series += [(labels, value) for (metric, labels), value in histograms.items()
+                       if metric == name]
+            if not series:
+                continue
+            lines.append("# HELP %s %s" % (name, text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in sorted(series):
+                if kind != "histogram":
+                    lines.append("%s%s %s" % (name, metric_labels(labels), value))
+                    continue
+                for bound, count in zip(self.buckets, value):
+                    lines.append("%s_bucket%s %s" % (
+                        name, metric_labels(labels + (("le", repr(bound)),)), count))
+                lines.append("%s_bucket%s %s" % (
+                    name, metric_labels(labels + (("le", "+Inf"),)), value[-2]))
+                lines.append("%s_sum%s %s" % (name, metric_labels(labels), value[-1]))
+                lines.append("%s_count%s %s" % (name, metric_labels(labels), value[-2]))
+        return "\n".join(lines) + "\n"
+
+    def points(self, timestamp):
+        """
+        Returns every metric as Influx points, histograms as their count and sum
+        """
+        with self.lock:
+            values = dict(self.values)
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+        points = [{'measurement': name, 'time': influx_time(timestamp),
+                   'tags': {label: str(value) for label, value in labels},
+                   'fields': {'value': float(value)}}
+                  for (name, labels), value in values.items()]
+        points += [{'measurement': name, 'time': influx_time(timestamp),
+                    'tags': {label: str(value) for label, value in labels},
+                    'fields': {'count': float(value[-2]), 'sum': value[-1]}}
+                   for (name, labels), value in histograms.items()]
+        return points
+
+
+def metric_labels(labels):
+    """
+    Formats metric labels, escaping their values
+    """
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (label, str(value).replace("\\", "\\\\")
+                                       .replace('"', '\\"').replace("\n", "\\n"))
+                          for label, value in labels) + "}"
 
-        retry = MAX_RETRIES
 
-        while retry > 0:
-            logging.debug("Trying. Retry= %s", retry)
-            try:
-                self.inv_data = s_d.read_all()
-                meter1 = s_d.meters()["Meter1"]
-                self.meter_data = meter1.read_all()
+METRICS = Metrics()
 
-            except Exception:
-                # Retry on read exception
-                logging.warning("Register read error - retrying")
-                retry -= 1
-                time.sleep(WAIT_TIME)
-            else:
-                retry = 0
 
-                # Update power data
+def config_deadband(value):
+    """
+    Converts a [mode, band] configuration value to a deadband
+    """
+    if not isinstance(value, (list, tuple)) or len(value) != 2 or value[0] not in ('abs', 'rel') \
+            or isinstance(value[1], bool) or not isinstance(value[1], (int, float)) or value[1] < 0:
+        raise ValueError("must be [\"abs\" or \"rel\", band]")
+    return (value[0], value[1])
+
 
-                self.power["prod"] = float(
-                    self.inv_data['power_ac']*10**self.inv_data['power_ac_scale'])
-                if self.meter_data['power'] > 0:
-                    self.power["exp"] = float(
-                        self.meter_data['power']*10**self.meter_data['power_scale'])
-                    self.power["imp"] = 0.0
-                else:
-                    self.power["imp"] = float(
-                        -1.0*self.meter_data['power']*10**self.meter_data['power_scale'])
-                    self.power["exp"] = 0.0
-                self.power["load"] = float(
-                    self.power["prod"]-self.power["exp"]+self.power["imp"])
-                self.timestamp = time.strftime(
-                    '%Y-%m-%dT%H:%M:%SZ', time.gmtime())
-                logging.debug('Timestamp: %s', self.timestamp)
+def config_value(kind, value):
+    """
+    Converts a configuration value to the kind of its setting, raising ValueError if it does not fit
+    """
+    # pylint: disable=too-many-return-statements
+    # one return per kind reads best here
+    if isinstance(kind, tuple):
+        if value not in kind:
+            raise ValueError("must be one of " + ", ".join(kind))
+        return value
+    if kind == "bool":
+        if not isinstance(value, bool):
+            raise ValueError("must be true or false")
+        return value
+    if kind == "deadband":
+        return config_deadband(value)
+    if kind == "deadbands":
+        if not isinstance(value, dict):
+            raise ValueError("must be a table of deadbands")
+        return {field: config_deadband(band) for field, band in value.items()}
+    if kind == "qos":
+        if value not in (0, 1, 2) or isinstance(value, bool):
+            raise ValueError("must be 0, 1 or 2")
+        return value
+    if kind == "qos_table":
+        if not isinstance(value, dict):
+            raise ValueError("must be a table of topic filters")
+        return {topic: config_value("qos", qos) for topic, qos in value.items()}
+    if kind == "optional":
+        if not isinstance(value, str):
+            raise ValueError("must be a string")
+        return value or None
+    if kind == "str":
+        if not isinstance(value, str):
+            raise ValueError("must be a string")
+        return value
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or \
+            (kind in ("int", "port") and not isinstance(value, int)):
+        raise ValueError("must be a number" if kind == "float" else "must be an integer")
+    if kind == "port":
+        return str(value)
+    return float(value) if kind == "float" else value
+
+
+class Configuration():
+    """
+    This class is used to read the TOML configuration file over the module settings at startup
+    and to re-read it on SIGHUP. A reload applies the live settings that changed (see CONFIG_KEYS)
+    and logs the others, which wait for a restart. A missing file leaves the built-in settings
+    """
 
-                # Update energy data
+    def __init__(self, path=CONFIG_FILE):
 
-                self.energy["prod"] = \
-                    float(self.inv_data['energy_total']*10 **
-                          self.inv_data['energy_total_scale'])
-                self.energy["imp"] =  \
-                    float(self.meter_data['import_energy_active']
-                          * 10**self.meter_data['energy_active_scale'])
-                self.energy["exp"] =  \
-                    float(self.meter_data['export_energy_active']
-                          * 10**self.meter_data['energy_active_scale'])
+        self.path = path
+        self.values = {}
+        self.requested = threading.Event()
 
-    def ha_discovery(self, mqtt_ha):
+    def read(self):
         """
-        Sends sensor discovery data to HA
+        Reads and checks the file. Returns the settings it overrides
         """
+        if not os.path.exists(self.path):
+            return {}
+        if tomllib is None:
+            raise ValueError("reading " + self.path + " needs Python 3.11 or the tomli package")
+        with open(self.path, "rb") as _f:
+            try:
+                data = tomllib.load(_f)
+            except tomllib.TOMLDecodeError as err:
+                raise ValueError(str(err)) from err
+        values = {}
+        for section, keys in data.items():
+            if section not in CONFIG_KEYS or not isinstance(keys, dict):
+                raise ValueError("unknown section [" + section + "]")
+            for name, value in keys.items():
+                if name not in CONFIG_KEYS[section]:
+                    raise ValueError("unknown key " + section + "." + name)
+                key = CONFIG_KEYS[section][name]
+                try:
+                    values[key.setting] = config_value(key.kind, value)
+                except ValueError as err:
+                    raise ValueError(section + "." + name + " " + str(err)) from err
+        return values
 
-        # generate uniqueID prefix and populate device data
+    def load(self):
+        """
+        Applies the file over the built-in settings
+        """
+        values = self.read()
+        globals().update(values)
+        self.values = values
 
-        self.inverterUniqueIDPrefix = self.inv_data["c_model"] + \
-            "-" + self.inv_data["c_serialnumber"]
-        self.meterUniqueIDPrefix = self.meter_data["c_model"] + \
-            "-" + self.meter_data["c_serialnumber"]
-        self.inverterPayload["device"]["identifiers"] = [
-            self.inverterUniqueIDPrefix]
-        self.inverterPayload["device"]["manufacturer"] = self.inv_data["c_manufacturer"]
-        self.inverterPayload["device"]["model"] = self.inv_data["c_model"]
-        self.inverterPayload["device"]["sw_version"] = self.inv_data["c_version"]
-
-        self.meterPayload["device"]["identifiers"] = [self.meterUniqueIDPrefix]
-        self.meterPayload["device"]["manufacturer"] = self.meter_data["c_manufacturer"]
-        self.meterPayload["device"]["model"] = self.meter_data["c_model"]
-        self.meterPayload["device"]["sw_version"] = self.meter_data["c_version"]
-
-        # Sensor 1 - AC Current Phase A
-        self.inverterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.inverterUniqueIDPrefix + "_AC_cur_A" + "/" + "config"
-        self.inverterPayload["name"] = "Inverter AC Current A"
-        self.inverterPayload["state_topic"] = INVERTER_TOPIC
-        self.inverterPayload["unique_id"] = self.inverterUniqueIDPrefix + "_AC_cur_A"
-        self.inverterPayload["value_template"] = "{{ (value_json.l1_current * 10 ** value_json.current_scale)|round(2) }}"
-        self.inverterPayload["unit_of_measurement"] = "A"
-        self.inverterPayload["icon"] = "mdi:current-ac"
-        self.inverterPayload["device_class"] = "current"
-        self.inverterPayload["state_class"] = "measurement"
-        mqtt_ha.publish(self.inverterDiscoveryTopic,
-                        json.dumps(self.inverterPayload), retain=True)
-
-        # Sensor 2 - AC Current Phase B
-        self.inverterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.inverterUniqueIDPrefix + "_AC_cur_B" + "/" + "config"
-        self.inverterPayload["name"] = "Inverter AC Current B"
-        self.inverterPayload["state_topic"] = INVERTER_TOPIC
-        self.inverterPayload["unique_id"] = self.inverterUniqueIDPrefix + "_AC_cur_B"
-        self.inverterPayload["value_template"] = "{{ (value_json.l2_current * 10 ** value_json.current_scale)|round(2) }}"
-        self.inverterPayload["unit_of_measurement"] = "A"
-        self.inverterPayload["icon"] = "mdi:current-ac"
-        self.inverterPayload["device_class"] = "current"
-        self.inverterPayload["state_class"] = "measurement"
-        mqtt_ha.publish(self.inverterDiscoveryTopic,
-                        json.dumps(self.inverterPayload), retain=True)
-
-        # Sensor 3 - AC Current Phase C
-        self.inverterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.inverterUniqueIDPrefix + "_AC_cur_C" + "/" + "config"
-        self.inverterPayload["name"] = "Inverter AC Current C"
-        self.inverterPayload["state_topic"] = INVERTER_TOPIC
-        self.inverterPayload["unique_id"] = self.inverterUniqueIDPrefix + "_AC_cur_C"
-        self.inverterPayload["value_template"] = "{{ (value_json.l3_current * 10 ** value_json.current_scale)|round(2) }}"
-        self.inverterPayload["unit_of_measurement"] = "A"
-        self.inverterPayload["icon"] = "mdi:current-ac"
-        self.inverterPayload["device_class"] = "current"
-        self.inverterPayload["state_class"] = "measurement"
-        mqtt_ha.publish(self.inverterDiscoveryTopic,
-                        json.dumps(self.inverterPayload), retain=True)
-
-        # Sensor 4 - AC Current
-        self.inverterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.inverterUniqueIDPrefix + "_AC_cur" + "/" + "config"
-        self.inverterPayload["name"] = "Inverter AC Current"
-        self.inverterPayload["state_topic"] = INVERTER_TOPIC
-        self.inverterPayload["unique_id"] = self.inverterUniqueIDPrefix + "_AC_cur"
-        self.inverterPayload["value_template"] = "{{ (value_json.current * 10 ** value_json.current_scale)|round(2) }}"
-        self.inverterPayload["unit_of_measurement"] = "A"
-        self.inverterPayload["icon"] = "mdi:current-ac"
-        self.inverterPayload["device_class"] = "current"
-        self.inverterPayload["state_class"] = "measurement"
-        mqtt_ha.publish(self.inverterDiscoveryTopic,
-                        json.dumps(self.inverterPayload), retain=True)
-
-        # Sensor 5 - Lifetime Energy
-        self.inverterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.inverterUniqueIDPrefix + "_AC_Energy" + "/" + "config"
-        self.inverterPayload["name"] = "Inverter Lifetime Energy"
-        self.inverterPayload["state_topic"] = INVERTER_TOPIC
-        self.inverterPayload["unique_id"] = self.inverterUniqueIDPrefix + \
-            "_AC_Energy"
-        self.inverterPayload["value_template"] = "{{ (value_json.energy_total * 10 ** (value_json.energy_total_scale-6))|round(3) }}"
-        self.inverterPayload["unit_of_measurement"] = "MWh"
-        self.inverterPayload["icon"] = "mdi:electron-framework"
-        self.inverterPayload["device_class"] = "energy"
-        self.inverterPayload["state_class"] = "total_increasing"
-        mqtt_ha.publish(self.inverterDiscoveryTopic,
-                        json.dumps(self.inverterPayload), retain=True)
-
-        # Sensor 6 -
-        self.inverterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.inverterUniqueIDPrefix + "_AC_Freq" + "/" + "config"
-        self.inverterPayload["name"] = "Inverter Frequency"
-        self.inverterPayload["state_topic"] = INVERTER_TOPIC
-        self.inverterPayload["unique_id"] = self.inverterUniqueIDPrefix + \
-            "_AC_Freq"
-        self.inverterPayload["value_template"] = "{{ (value_json.frequency * 10 ** value_json.frequency_scale)|round(2) }}"
-        self.inverterPayload["unit_of_measurement"] = "Hz"
-        self.inverterPayload["icon"] = "mdi:sine-wave"
-        self.inverterPayload["device_class"] = "frequency"
-        self.inverterPayload["state_class"] = "measurement"
-        mqtt_ha.publish(self.inverterDiscoveryTopic,
-                        json.dumps(self.inverterPayload), retain=True)
-
-        # Sensor 7 - Power Factor
-        self.inverterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.inverterUniqueIDPrefix + "_AC_PF" + "/" + "config"
-        self.inverterPayload["name"] = "Inverter Power Factor"
-        self.inverterPayload["state_topic"] = INVERTER_TOPIC
-        self.inverterPayload["unique_id"] = self.inverterUniqueIDPrefix + \
-            "_AC_PF"
-        self.inverterPayload["value_template"] = "{{ (value_json.power_factor * 10 ** value_json.power_factor_scale)|round(2) }}"
-        self.inverterPayload["unit_of_measurement"] = "%"
-        self.inverterPayload["icon"] = "mdi:percent"
-        self.inverterPayload["device_class"] = "power_factor"
-        self.inverterPayload["state_class"] = "measurement"
-
-        mqtt_ha.publish(self.inverterDiscoveryTopic,
-                        json.dumps(self.inverterPayload), retain=True)
-
-        # Sensor 8 - AC Power
-        self.inverterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.inverterUniqueIDPrefix + "_AC_Power" + "/" + "config"
-        self.inverterPayload["name"] = "Inverter Power"
-        self.inverterPayload["state_topic"] = INVERTER_TOPIC
-        self.inverterPayload["unique_id"] = self.inverterUniqueIDPrefix + \
-            "_AC_Power"
-        self.inverterPayload["value_template"] = "{{ (value_json.power_ac * 10 ** (value_json.power_ac_scale-3))|round(3) }}"
-        self.inverterPayload["unit_of_measurement"] = "kW"
-        self.inverterPayload["icon"] = "mdi:solar-power"
-        self.inverterPayload["device_class"] = "power"
-        self.inverterPayload["state_class"] = "measurement"
-
-        mqtt_ha.publish(self.inverterDiscoveryTopic,
-                        json.dumps(self.inverterPayload), retain=True)
-
-        # Sensor 9 - Apparent Power
-        self.inverterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.inverterUniqueIDPrefix + "_AC_VA" + "/" + "config"
-        self.inverterPayload["name"] = "Inverter Apparent Power"
-        self.inverterPayload["state_topic"] = INVERTER_TOPIC
-        self.inverterPayload["unique_id"] = self.inverterUniqueIDPrefix + \
-            "_AC_VA"
-        self.inverterPayload["value_template"] = "{{ (value_json.power_apparent * 10 ** (value_json.power_apparent_scale-3))|round(3) }}"
-        self.inverterPayload["unit_of_measurement"] = "kVA"
-        self.inverterPayload["icon"] = "mdi:solar-power"
-        self.inverterPayload["device_class"] = "apparent_power"
-        self.inverterPayload["state_class"] = "measurement"
-
-        mqtt_ha.publish(self.inverterDiscoveryTopic,
-                        json.dumps(self.inverterPayload), retain=True)
-
-        # Sensor 10 Reactive Power
-        self.inverterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.inverterUniqueIDPrefix + "_AC_VAR" + "/" + "config"
-        self.inverterPayload["name"] = "Inverter Reactive Power"
-        self.inverterPayload["state_topic"] = INVERTER_TOPIC
-        self.inverterPayload["unique_id"] = self.inverterUniqueIDPrefix + \
-            "_AC_VAR"
-        self.inverterPayload["value_template"] = "{{ (value_json.power_reactive * 10 ** (value_json.power_reactive_scale-3))|round(3) }}"
-        self.inverterPayload["unit_of_measurement"] = "kvar"
-        self.inverterPayload["icon"] = "mdi:solar-power"
-        self.inverterPayload["device_class"] = "reactive_power"
-        self.inverterPayload["state_class"] = "measurement"
-
-        mqtt_ha.publish(self.inverterDiscoveryTopic,
-                        json.dumps(self.inverterPayload), retain=True)
-
-        # Sensor 11 - AC Voltage
-        self.inverterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.inverterUniqueIDPrefix + "_AC_Voltage" + "/" + "config"
-        self.inverterPayload["name"] = "Inverter AC Voltage"
-        self.inverterPayload["state_topic"] = INVERTER_TOPIC
-        self.inverterPayload["unique_id"] = self.inverterUniqueIDPrefix + \
-            "_AC_Voltage"
-        self.inverterPayload["value_template"] = "{{ (value_json.l1_voltage * 10 ** (value_json.voltage_scale))|round(2) }}"
-        self.inverterPayload["unit_of_measurement"] = "V"
-        self.inverterPayload["icon"] = "mdi:power-socket-au"
-        self.inverterPayload["device_class"] = "voltage"
-        self.inverterPayload["state_class"] = "measurement"
-
-        mqtt_ha.publish(self.inverterDiscoveryTopic,
-                        json.dumps(self.inverterPayload), retain=True)
-
-        # Sensor 12 - DC Current
-        self.inverterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.inverterUniqueIDPrefix + "_DC_Current" + "/" + "config"
-        self.inverterPayload["name"] = "Inverter DC Current"
-        self.inverterPayload["state_topic"] = INVERTER_TOPIC
-        self.inverterPayload["unique_id"] = self.inverterUniqueIDPrefix + \
-            "_DC_Current"
-        self.inverterPayload["value_template"] = "{{ (value_json.current_dc * 10 ** (value_json.current_dc_scale))|round(2) }}"
-        self.inverterPayload["unit_of_measurement"] = "A"
-        self.inverterPayload["icon"] = "mdi:current-dc"
-        self.inverterPayload["device_class"] = "current"
-        self.inverterPayload["state_class"] = "measurement"
-
-        mqtt_ha.publish(self.inverterDiscoveryTopic,
-                        json.dumps(self.inverterPayload), retain=True)
-
-        # Sensor 13 - DC Power
-        self.inverterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.inverterUniqueIDPrefix + "_DC_Power" + "/" + "config"
-        self.inverterPayload["name"] = "Inverter DC Power"
-        self.inverterPayload["state_topic"] = INVERTER_TOPIC
-        self.inverterPayload["unique_id"] = self.inverterUniqueIDPrefix + \
-            "_DC_Power"
-        self.inverterPayload["value_template"] = "{{ (value_json.power_dc * 10 ** (value_json.power_dc_scale-3))|round(2) }}"
-        self.inverterPayload["unit_of_measurement"] = "kW"
-        self.inverterPayload["icon"] = "mdi:solar-power"
-        self.inverterPayload["device_class"] = "power"
-        self.inverterPayload["state_class"] = "measurement"
-
-        mqtt_ha.publish(self.inverterDiscoveryTopic,
-                        json.dumps(self.inverterPayload), retain=True)
-
-        # Sensor 14 - DC Voltage
-        self.inverterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.inverterUniqueIDPrefix + "_DC_Voltage" + "/" + "config"
-        self.inverterPayload["name"] = "Inverter DC Voltage"
-        self.inverterPayload["state_topic"] = INVERTER_TOPIC
-        self.inverterPayload["unique_id"] = self.inverterUniqueIDPrefix + \
-            "_DC_Voltage"
-        self.inverterPayload["value_template"] = "{{ (value_json.voltage_dc * 10 ** (value_json.voltage_dc_scale))|round(2) }}"
-        self.inverterPayload["unit_of_measurement"] = "V"
-        self.inverterPayload["icon"] = "mdi:power-socket-au"
-        self.inverterPayload["device_class"] = "voltage"
-        self.inverterPayload["state_class"] = "measurement"
-
-        mqtt_ha.publish(self.inverterDiscoveryTopic,
-                        json.dumps(self.inverterPayload), retain=True)
-
-        # Sensor 15 - Inverter Temperature
-        self.inverterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.inverterUniqueIDPrefix + "_Temperature" + "/" + "config"
-        self.inverterPayload["name"] = "Inverter Temperature"
-        self.inverterPayload["state_topic"] = INVERTER_TOPIC
-        self.inverterPayload["unique_id"] = self.inverterUniqueIDPrefix + \
-            "_Temperature"
-        self.inverterPayload["value_template"] = "{{ (value_json.temperature * 10 ** (value_json.temperature_scale))|round(2) }}"
-        self.inverterPayload["unit_of_measurement"] = "°C"
-        self.inverterPayload["icon"] = "mdi:thermometer"
-        self.inverterPayload["device_class"] = "temperature"
-        self.inverterPayload["state_class"] = "measurement"
-
-        mqtt_ha.publish(self.inverterDiscoveryTopic,
-                        json.dumps(self.inverterPayload), retain=True)
-
-        # Last two sensors are status codes and do not have some attributes
-        self.inverterPayload.pop("unit_of_measurement")
-        self.inverterPayload.pop("device_class")
-        self.inverterPayload.pop("state_class")
-
-        # Sensor 16 - Inverter Status
-        self.inverterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.inverterUniqueIDPrefix + "_Inv_Status" + "/" + "config"
-        self.inverterPayload["name"] = "Inverter Status"
-        self.inverterPayload["state_topic"] = INVERTER_TOPIC
-        self.inverterPayload["unique_id"] = self.inverterUniqueIDPrefix + \
-            "Inv_Status"
-        self.inverterPayload["value_template"] = "{{ value_json.status }}"
-        # self.inverterPayload["unit_of_measurement"] = None
-        self.inverterPayload["icon"] = "mdi:star-three-points"
-        # self.inverterPayload["device_class"] = None
-        # self.inverterPayload["state_class"] = None
-
-        mqtt_ha.publish(self.inverterDiscoveryTopic,
-                        json.dumps(self.inverterPayload), retain=True)
-
-        # Sensor 17 - Inverter Vendor Status
-        self.inverterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.inverterUniqueIDPrefix + "_Vendor_Stat" + "/" + "config"
-        self.inverterPayload["name"] = "Inverter Vendor Status"
-        self.inverterPayload["state_topic"] = INVERTER_TOPIC
-        self.inverterPayload["unique_id"] = self.inverterUniqueIDPrefix + \
-            "_Vendor_Stat"
-        self.inverterPayload["value_template"] = "{{ value_json.vendor_status }}"
-        # self.inverterPayload["unit_of_measurement"] = None
-        self.inverterPayload["icon"] = "mdi:star-three-points"
-        # self.inverterPayload["device_class"] = None
-        # self.inverterPayload["state_class"] = None
-
-        mqtt_ha.publish(self.inverterDiscoveryTopic,
-                        json.dumps(self.inverterPayload), retain=True)
-
-        # Sensor 1 - Load
-        self.meterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.meterUniqueIDPrefix + "_load" + "/" + "config"
-        self.meterPayload["name"] = "Meter Load"
-        self.meterPayload["state_topic"] = POWER_TOPIC
-        self.meterPayload["unique_id"] = self.meterUniqueIDPrefix + "_load"
-        self.meterPayload["value_template"] = "{{ (value_json.load)|round(2) }}"
-        self.meterPayload["unit_of_measurement"] = "kW"
-        self.meterPayload["icon"] = "mdi:solar-power"
-        self.meterPayload["device_class"] = "power"
-        self.meterPayload["state_class"] = "measurement"
-
-        mqtt_ha.publish(self.meterDiscoveryTopic,
-                        json.dumps(self.meterPayload), retain=True)
-
-        # Sensor 2 Production
-        self.meterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.meterUniqueIDPrefix + "_production" + "/" + "config"
-        self.meterPayload["name"] = "Meter Production"
-        self.meterPayload["state_topic"] = POWER_TOPIC
-        self.meterPayload["unique_id"] = self.meterUniqueIDPrefix + \
-            "_production"
-        self.meterPayload["value_template"] = "{{ (value_json.production)|round(2) }}"
-        self.meterPayload["unit_of_measurement"] = "kW"
-        self.meterPayload["icon"] = "mdi:solar-power"
-        self.meterPayload["device_class"] = "power"
-        self.meterPayload["state_class"] = "measurement"
-
-        mqtt_ha.publish(self.meterDiscoveryTopic,
-                        json.dumps(self.meterPayload), retain=True)
-
-        # Sensor 3 - Import
-        self.meterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.meterUniqueIDPrefix + "_import" + "/" + "config"
-        self.meterPayload["name"] = "Meter Import"
-        self.meterPayload["state_topic"] = POWER_TOPIC
-        self.meterPayload["unique_id"] = self.meterUniqueIDPrefix + "_import"
-        self.meterPayload["value_template"] = "{{ (value_json.import)|round(2) }}"
-        self.meterPayload["unit_of_measurement"] = "kW"
-        self.meterPayload["icon"] = "mdi:solar-power"
-        self.meterPayload["device_class"] = "power"
-        self.meterPayload["state_class"] = "measurement"
-
-        mqtt_ha.publish(self.meterDiscoveryTopic,
-                        json.dumps(self.meterPayload), retain=True)
-
-        # Sensor 4 - Export
-        self.meterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.meterUniqueIDPrefix + "_export" + "/" + "config"
-        self.meterPayload["name"] = "Meter Export"
-        self.meterPayload["state_topic"] = POWER_TOPIC
-        self.meterPayload["unique_id"] = self.meterUniqueIDPrefix + "_export"
-        self.meterPayload["value_template"] = "{{ (value_json.export)|round(2) }}"
-        self.meterPayload["unit_of_measurement"] = "kW"
-        self.meterPayload["icon"] = "mdi:solar-power"
-        self.meterPayload["device_class"] = "power"
-        self.meterPayload["state_class"] = "measurement"
-
-        mqtt_ha.publish(self.meterDiscoveryTopic,
-                        json.dumps(self.meterPayload), retain=True)
-
-        # Sensor 5 - Current
-        self.meterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.meterUniqueIDPrefix + "_current" + "/" + "config"
-        self.meterPayload["name"] = "Meter Current"
-        self.meterPayload["state_topic"] = METER_TOPIC
-        self.meterPayload["unique_id"] = self.meterUniqueIDPrefix + "_current"
-        self.meterPayload["value_template"] = "{{ (value_json.current * 10 ** value_json.current_scale)|round(2) }}"
-        self.meterPayload["unit_of_measurement"] = "A"
-        self.meterPayload["icon"] = "mdi:current-ac"
-        self.meterPayload["device_class"] = "current"
-        self.meterPayload["state_class"] = "measurement"
-
-        mqtt_ha.publish(self.meterDiscoveryTopic,
-                        json.dumps(self.meterPayload), retain=True)
-
-        # Sensor 6 - Line Voltage
-        self.meterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.meterUniqueIDPrefix + "_line_voltage" + "/" + "config"
-        self.meterPayload["name"] = "Meter Line Voltage"
-        self.meterPayload["state_topic"] = METER_TOPIC
-        self.meterPayload["unique_id"] = self.meterUniqueIDPrefix + \
-            "_line_voltage"
-        self.meterPayload["value_template"] = "{{ (value_json.voltage_ln * 10 ** (value_json.voltage_scale))|round(2) }}"
-        self.meterPayload["unit_of_measurement"] = "V"
-        self.meterPayload["icon"] = "mdi:power-socket-au"
-        self.meterPayload["device_class"] = "voltage"
-        self.meterPayload["state_class"] = "measurement"
-
-        mqtt_ha.publish(self.meterDiscoveryTopic,
-                        json.dumps(self.meterPayload), retain=True)
-
-        # Sensor 7 - Line Frequency
-        self.meterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.meterUniqueIDPrefix + "_frequency" + "/" + "config"
-        self.meterPayload["name"] = "Meter Frequency"
-        self.meterPayload["state_topic"] = METER_TOPIC
-        self.meterPayload["unique_id"] = self.meterUniqueIDPrefix + \
-            "_frequency"
-        self.meterPayload["value_template"] = "{{ (value_json.frequency * 10 ** value_json.frequency_scale)|round(2) }}"
-        self.meterPayload["unit_of_measurement"] = "Hz"
-        self.meterPayload["icon"] = "mdi:sine-wave"
-        self.meterPayload["device_class"] = "frequency"
-        self.meterPayload["state_class"] = "measurement"
-
-        mqtt_ha.publish(self.meterDiscoveryTopic,
-                        json.dumps(self.meterPayload), retain=True)
-
-        # Sensor 8 - Real Power
-        self.meterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.meterUniqueIDPrefix + "_real_power" + "/" + "config"
-        self.meterPayload["name"] = "Meter Real Power"
-        self.meterPayload["state_topic"] = METER_TOPIC
-        self.meterPayload["unique_id"] = self.meterUniqueIDPrefix + \
-            "_real_power"
-        self.meterPayload["value_template"] = "{{ (value_json.power * 10 ** (value_json.power_scale))|round(3) }}"
-        self.meterPayload["unit_of_measurement"] = "W"
-        self.meterPayload["icon"] = "mdi:solar-power"
-        self.meterPayload["device_class"] = "power"
-        self.meterPayload["state_class"] = "measurement"
-
-        mqtt_ha.publish(self.meterDiscoveryTopic,
-                        json.dumps(self.meterPayload), retain=True)
-
-        # Sensor 9 - Apparent Power
-        self.meterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.meterUniqueIDPrefix + "_power_apparent" + "/" + "config"
-        self.meterPayload["name"] = "Meter Apparent Power"
-        self.meterPayload["state_topic"] = METER_TOPIC
-        self.meterPayload["unique_id"] = self.meterUniqueIDPrefix + \
-            "_power_apparent"
-        self.meterPayload["value_template"] = "{{ (value_json.power_apparent * 10 ** (value_json.power_apparent_scale))|round(3) }}"
-        self.meterPayload["unit_of_measurement"] = "VA"
-        self.meterPayload["icon"] = "mdi:solar-power"
-        self.meterPayload["device_class"] = "apparent_power"
-        self.meterPayload["state_class"] = "measurement"
-
-        mqtt_ha.publish(self.meterDiscoveryTopic,
-                        json.dumps(self.meterPayload), retain=True)
-
-        # Sensor 10 - Reactive Power
-        self.meterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.meterUniqueIDPrefix + "_power_reactive" + "/" + "config"
-        self.meterPayload["name"] = "Meter Reactive Power"
-        self.meterPayload["state_topic"] = METER_TOPIC
-        self.meterPayload["unique_id"] = self.meterUniqueIDPrefix + \
-            "_power_reactive"
-        self.meterPayload["value_template"] = "{{ (value_json.power_reactive * 10 ** (value_json.power_reactive_scale))|round(3) }}"
-        self.meterPayload["unit_of_measurement"] = "VAR"
-        self.meterPayload["icon"] = "mdi:solar-power"
-        self.meterPayload["device_class"] = "reactive_power"
-        self.meterPayload["state_class"] = "measurement"
-
-        mqtt_ha.publish(self.meterDiscoveryTopic,
-                        json.dumps(self.meterPayload), retain=True)
-
-        # Sensor 11 - Power Factor
-        self.meterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.meterUniqueIDPrefix + "_power_factor" + "/" + "config"
-        self.meterPayload["name"] = "Meter Power Factor"
-        self.meterPayload["state_topic"] = METER_TOPIC
-        self.meterPayload["unique_id"] = self.meterUniqueIDPrefix + \
-            "_power_factor"
-        self.meterPayload["value_template"] = "{{ (value_json.power_factor * 10 ** value_json.power_factor_scale)|round(2) }}"
-        self.meterPayload["unit_of_measurement"] = "%"
-        self.meterPayload["icon"] = "mdi:percent"
-        self.meterPayload["device_class"] = "power_factor"
-        self.meterPayload["state_class"] = "measurement"
-
-        mqtt_ha.publish(self.meterDiscoveryTopic,
-                        json.dumps(self.meterPayload), retain=True)
-
-        # Sensor 12 - Lifetime Energy Export
-        self.meterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.meterUniqueIDPrefix + \
-            "_lifetime_energy_export" + "/" + "config"
-        self.meterPayload["name"] = "Meter Lifetime Energy Export"
-        self.meterPayload["state_topic"] = METER_TOPIC
-        self.meterPayload["unique_id"] = self.meterUniqueIDPrefix + \
-            "_lifetime_energy_export"
-        self.meterPayload["value_template"] = "{{ (value_json.export_energy_active * 10 ** (value_json.energy_active_scale-6))|round(3) }}"
-        self.meterPayload["unit_of_measurement"] = "MWh"
-        self.meterPayload["icon"] = "mdi:electron-framework"
-        self.meterPayload["device_class"] = "energy"
-        self.meterPayload["state_class"] = "total_increasing"
-
-        mqtt_ha.publish(self.meterDiscoveryTopic,
-                        json.dumps(self.meterPayload), retain=True)
-
-        # Sensor 13 - Lifetime Energy Import
-        self.meterDiscoveryTopic = AUTODISCOVERY_PREFIX + "/" + \
-            "sensor" + "/" + self.meterUniqueIDPrefix + \
-            "_lifetime_energy_import" + "/" + "config"
-        self.meterPayload["name"] = "Meter Lifetime Energy Import"
-        self.meterPayload["state_topic"] = METER_TOPIC
-        self.meterPayload["unique_id"] = self.meterUniqueIDPrefix + \
-            "_lifetime_energy_import"
-        self.meterPayload["value_template"] = "{{ (value_json.import_energy_active * 10 ** (value_json.energy_active_scale-6))|round(3) }}"
-        self.meterPayload["unit_of_measurement"] = "MWh"
-        self.meterPayload["icon"] = "mdi:electron-framework"
-        self.meterPayload["device_class"] = "energy"
-        self.meterPayload["state_class"] = "total_increasing"
-
-        mqtt_ha.publish(self.meterDiscoveryTopic,
-                        json.dumps(self.meterPayload), retain=True)
-
-    def write_ha(self, mqtt_ha, influx_ha):
-        """
-        Writes power and energy utilisation data to the Home Assistant database
-        """
-        self.energy["cons"] = float(
-            self.energy["prod"]-self.energy["exp"]+self.energy["imp"])
-        self.energy["s-cons"] = float(
-            self.energy["prod"]-self.energy["exp"])
-        # Write energy values to influx
-        influx_measure = 'Wh'
-        influx_metric = [{
-            'measurement': influx_measure,
-            'time': self.timestamp,
-            'tags': {
-                'domain': INFLUX_DOMAIN,
-                'entity_id': INFLUX_ENTITY
-            },
-            'fields': {
-                'Production': self.energy["prod"],
-                'Import': self.energy["imp"],
-                'Export': self.energy["exp"],
-                'Consumption': self.energy["cons"],
-                'Self-Consumption': self.energy["s-cons"]
-            }
-        }]
-        # Decode inverter status
-        self.inv_data['status'] = solaredge_modbus.INVERTER_STATUS_MAP[self.inv_data['status']]
-        if not DEBUG:
-            logging.debug("Writing energy points")
-            power_data = {
-                "production": self.power["prod"]/1000,
-                "export": self.power["exp"]/1000,
-                "import": self.power["imp"]/1000,
-                "load": self.power["load"]/1000
-            }
-            mqtt_ha.publish(POWER_TOPIC, json.dumps(power_data))
-#            mqtt_ha.publish(POWER_TOPIC, self.power["prod"]/1000)
-#            mqtt_ha.publish(EXPORT_TOPIC, self.power["exp"]/1000)
-#            mqtt_ha.publish(IMPORT_TOPIC, self.power["imp"]/1000)
-#            mqtt_ha.publish(LOAD_TOPIC, self.power["load"]/1000)
-            mqtt_ha.publish(INVERTER_TOPIC, json.dumps(self.inv_data))
-            mqtt_ha.publish(METER_TOPIC, json.dumps(self.meter_data))
+    def reload(self):
+        """
+        Re-reads the file and applies the live settings that changed. Returns them
+        """
+        self.requested.clear()
+        try:
+            values = self.read()
+        except (OSError, ValueError) as err:
+            logging.error("Configuration %s not reloaded - %s", self.path, err)
+            return {}
+        live = {}
+        for section in CONFIG_KEYS.values():
+            for key in section.values():
+                if key.setting not in values or self.values.get(key.setting) == values[key.setting]:
+                    continue
+                if key.live:
+                    live[key.setting] = values[key.setting]
+                else:
+                    logging.warning("Setting %s changed - restart to apply it", key.setting)
+        globals().update(live)
+        self.values = values
+        logging.info("Reloaded %s - %s", self.path,
+                     "applied " + ", ".join(sorted(live)) if live else "no live changes")
+        return live
 
-            influx_ha.write_points(influx_metric, time_precision='s')
 
-        else:
-            logging.debug(
-                "Energy  - Production: %s, Export: %s, Import: %s, Consumption: %s, Self Consumption: %s",
-                self.energy["prod"],
-                self.energy["exp"],
-                self.energy["imp"],
-                self.energy["cons"],
-                self.energy["s-cons"])
-        # reset energy delta
-#        self.energy_prod = self.energy_prod+self.energy_prod_delta
-#        self.energy_imp = self.energy_imp+self.energy_imp_delta
-#        self.energy_exp = self.energy_exp+self.energy_exp_delta
-
-    def write_power(self, influx_pw):
-        """
-        Writes power utilisation data to the powerlogging database
-        """
-        # Write power values to influx
-        influx_measure = 'W'
-        influx_metric = [{
-            'measurement': influx_measure,
-            'time': self.timestamp,
-            'tags': {
-                'domain': INFLUX_DOMAIN,
-                'entity_id': INFLUX_ENTITY
-            },
-            'fields': {
-                'Production': self.power["prod"],
-                'Import': self.power["imp"],
-                'Export': self.power["exp"],
-                'Load': self.power["load"]
-            }
-        }]
-        if not DEBUG:
-            logging.debug("Writing power points")
-            influx_pw.write_points(influx_metric, time_precision='s')
-        else:
-            # Print published values to log
-            logging.debug("Power - Production: %s, Export: %s, Import: %s, Load: %s",
-                          self.power["prod"], self.power["exp"], self.power["imp"], self.power["load"])
+def apply_settings(changed, scheduler, sessions, sinks, batcher):
+    """
+    Applies reloaded settings held by the running scheduler, pollers and sinks.
+    Modbus and MQTT sessions are kept
+    """
+    if "SLEEP_TIME" in changed:
+        scheduler.interval = SLEEP_TIME
+        scheduler.deadline = time.monotonic() + SLEEP_TIME - (time.time() % SLEEP_TIME)
+    if "SCHEDULE_POLICY" in changed:
+        scheduler.policy = SCHEDULE_POLICY
+    for session in sessions:
+        for unit, inv_data in session.targets:
+            if "REGISTER_PROFILE" in changed:
+                inv_data.profile = REGISTER_PROFILE
+            if "METER_NAME" in changed:
+                inv_data.meter_name = METER_NAME
+                inv_data.topology.invalidate()
+            if "TOPOLOGY_REFRESH" in changed:
+                inv_data.topology.refresh = TOPOLOGY_REFRESH
+    for sink in sinks:
+        if "SINK_POLICY" in changed:
+            sink.policy = SINK_POLICY
+        if isinstance(sink.target, DeadbandPublisher):
+            if "DEADBANDS" in changed:
+                sink.target.deadbands = DEADBANDS
+            if "DEADBAND_DEFAULT" in changed:
+                sink.target.default = DEADBAND_DEFAULT
+            if "DEADBAND_MAX_SILENCE" in changed:
+                sink.target.silence = DEADBAND_MAX_SILENCE
+    if "INFLUX_BATCH_SIZE" in changed:
+        batcher.size = INFLUX_BATCH_SIZE
+    if "INFLUX_FLUSH_TIME" in changed:
+        batcher.interval = INFLUX_FLUSH_TIME
+
+
+def scale_values(data, scales):
+    """
+    Returns the engineering value of every field in scales that is present in the register data.
+    Negative scale factors divide by an exact power of ten so values such as 230.7 stay exact
+    """
+    values = {}
+    for field, scale_field in scales.items():
+        if field not in data:
+            continue
+        value = data[field]
+        if scale_field is not None:
+            scale = data.get(scale_field) or 0
+            if scale >= 0:
+                value = float(value * POWERS_OF_TEN[scale])
+            else:
+                value = value / POWERS_OF_TEN[-scale]
+        values[field] = value
+    return values
 
 
-def write_pid_file(pid_f):
+def missing_registers(inv_data, meter_data, battery_data, identity=True):
     """
-    Writes a file containing the current process id
+    Returns the REQUIRED_REGISTERS (and IDENTITY_REGISTERS) absent from a read of the inverter,
+    meter and batteries
     """
-    pid = str(os.getpid())
-    _f = open(pid_f, 'w')
-    _f.write(pid)
-    _f.close()
+    extra = IDENTITY_REGISTERS if identity else []
+    missing = ["inverter " + field for field in REQUIRED_REGISTERS["inverter"] + extra
+               if field not in inv_data]
+    missing += ["meter " + field for field in REQUIRED_REGISTERS["meter"] + extra
+                if field not in meter_data]
+    for name, data in battery_data.items():
+        missing += [name + " " + field for field in REQUIRED_REGISTERS["battery"] + extra
+                    if field not in data]
+    return missing
+
+
+def combine_batteries(batteries):
+    """
+    Combines the engineering values of several batteries into one bank: powers, currents and
+    energies are summed, the state of energy is recomputed from the summed energies and the other
+    values are averaged. The status is the first battery's
+    """
+    if len(batteries) < 2:
+        return batteries[0] if batteries else {}
+    values = {}
+    for field in BATTERY_FIELDS:
+        readings = [battery[field] for battery in batteries if field in battery]
+        if not readings:
+            continue
+        if field == "status":
+            values[field] = readings[0]
+        elif field.startswith(("instantaneous_current", "instantaneous_power", "lifetime_")) or \
+                field.endswith("_energy"):
+            values[field] = sum(readings)
+        else:
+            values[field] = sum(readings) / len(readings)
+    if values.get("maximum_energy"):
+        values["soe"] = 100.0 * values.get("available_energy", 0.0) / values["maximum_energy"]
+    return values
 
 
-def rm_pid_file(pid_f):
+def register_blocks(device, fields):
     """
-    Deletes the file containing the current process id
+    Groups the registers holding the requested fields into contiguous blocks
+    that can each be fetched with a single Modbus read.
+    Returns None if the device does not implement all of the fields
     """
-    if not DEBUG:
-        if os.path.exists(pid_f):
-            os.remove(pid_f)
+    if any(field not in device.registers for field in fields):
+        return None
+
+    specs = sorted(((field, device.registers[field]) for field in fields),
+                   key=lambda item: item[1][0])
+    blocks = []
+    block = {}
+    start = end = 0
+    for field, spec in specs:
+        address, length = spec[0], spec[1]
+        if block and (address - end > MAX_BLOCK_GAP or
+                      address + length - start > MAX_BLOCK_LENGTH):
+            blocks.append(block)
+            block = {}
+        if not block:
+            start = address
+            end = address
+        block[field] = spec
+        end = max(end, address + length)
+    if block:
+        blocks.append(block)
+    return blocks
+
+
+def read_blocks(device, blocks):
+    """
+    Reads each register block from the device.
+    Returns None if any block could not be read completely
+    """
+    # pylint: disable=protected-access
+    # solaredge_modbus only exposes contiguous block decoding through _read_all
 
+    data = {}
+    for block in blocks:
+        values = device._read_all(block, solaredge_modbus.registerType.HOLDING)
+        if len(values) != len(block):
+            return None
+        data.update(values)
+    return data
 
-def parse_args():
+
+def target_topic(topic, name):
     """
-        configure valid arguments
+    Inserts the target name after the topic prefix, e.g.
+    house/solaredge/inverter/state -> house/solaredge/<name>/inverter/state
     """
+    if not name:
+        return topic
+    levels = topic.split("/")
+    levels.insert(2, name)
+    return "/".join(levels)
 
-    parser = argparse.ArgumentParser(
-        description='Get solar performance data from a solaredge inverter')
-    parser.add_argument('-i', metavar=' ',
-                        default='localhost',
-                        help='ip address to use for modbus tcp [default: localhost]')
-    parser.add_argument('-p', metavar=' ', type=int,
-                        default=502,
-                        help='port number for modbus tcp [default: 502]')
-    parser.add_argument('-t', metavar=' ', type=int,
-                        default=1,
-                        help='connection timeout [default: 1]')
-    parser.add_argument('-u', metavar=' ', type=int,
-                        default=1,
-                        help='modbus unit [default: 1]')
-    parser.add_argument('-D', action="store_true",
-                        help='run in debug mode')
-    return parser.parse_args()
+
+def payload_hash(payload):
+    """
+    Returns a digest of an MQTT payload
+    """
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    return hashlib.sha1(payload).hexdigest()
 
 
-def set_logging(log_str):
+def retained_hashes(mqtt_ha, topics, wait=DISCOVERY_WAIT):
     """
-    Configures the log level, and log format and sets up the logging handlers
+    Subscribes to the topics and returns the hash of each retained message the broker holds,
+    waiting at most wait seconds for them to arrive
+    """
+    hashes = {}
+    received = threading.Event()
+
+    def on_retained(client, userdata, message):
+        if message.retain:
+            hashes[message.topic] = payload_hash(message.payload)
+        if len(hashes) == len(topics):
+            received.set()
+
+    for topic in topics:
+        mqtt_ha.message_callback_add(topic, on_retained)
+    mqtt_ha.subscribe([(topic, 0) for topic in topics])
+    received.wait(wait)
+    mqtt_ha.unsubscribe(topics)
+    for topic in topics:
+        mqtt_ha.message_callback_remove(topic)
+    return hashes
+
+
+class DiscoveryCache():
     """
+    This class is used to remember the hash of every discovery config published to HA,
+    so unchanged configs are not republished when getsolar restarts
+    """
+    # pylint: disable=broad-except
+    # a missing or damaged cache only causes the configs to be republished
 
-    # Defines a logging level and logging format based on a given string key.
-    log_attr = {'debug': (logging.DEBUG,
-                          _ID + ' %(levelname)-9s %(name)-15s %(threadName)-14s +%(lineno)-4d %(message)s'),
-                'info': (logging.INFO,
-                         _ID + ' %(levelname)-9s %(message)s'),
-                'warning': (logging.WARNING,
-                            _ID + ' %(levelname)-9s %(message)s'),
-                'error': (logging.ERROR,
-                          _ID + ' %(levelname)-9s %(message)s'),
-                'critical': (logging.CRITICAL,
-                             _ID + ' %(levelname)-9s %(message)s')}
-    loglevel, logformat = log_attr[log_str]
+    def __init__(self, path=DISCOVERY_CACHE):
 
-    # Configuring the logger
-    logger = logging.getLogger()
-    logger.setLevel(loglevel)
+        self.path = path
+        self.hashes = {}
+        try:
+            with open(path) as _f:
+                self.hashes = json.load(_f)
+        except Exception:
+            logging.debug("No discovery cache at %s", path)
 
-    # Clearing previous logs
-    logger.handlers = []
+    def get(self, topic):
+        """
+        Returns the hash last published to a topic
+        """
+        return self.hashes.get(topic)
 
-    # Setting formaters and adding handlers.
-    formatter = logging.Formatter(logformat)
-    handlers = []
-    if not DEBUG:
-        handlers.append(SysLogLibHandler(LOG_FACILITY_LOCAL_N))
-        for handle in handlers:
-            handle.setFormatter(formatter)
-            logger.addHandler(handle)
+    def update(self, hashes):
+        """
+        Records published hashes and saves the cache
+        """
+        if all(self.hashes.get(topic) == digest for topic, digest in hashes.items()):
+            return
+        self.hashes.update(hashes)
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'w') as _f:
+                json.dump(self.hashes, _f)
+        except Exception:
+            logging.warning("Unable to save discovery cache %s", self.path)
 
 
-def on_connect(client, userdata, flags, rc):
-    # client.error_code = rc
-    if rc == 0:
-        client.connected_flag = True  # set flag
-    else:
-        client.connected_flag = False
+class DeviceTopology():
+    """
+    This class is used to cache the meters and batteries attached to an inverter
+    together with their static c_* identity fields.
+    The cache is rebuilt after a read failure, a reconnect or every TOPOLOGY_REFRESH seconds;
+    changed is set when a rebuild finds a different set of devices
+    """
 
+    def __init__(self, refresh=None):
 
-def on_disconnect(client, userdata, rc):
-    logging.info("disconnecting reason  " + str(rc))
-    client.connected_flag = False
-    client.disconnect_flag = True
+        self.refresh = TOPOLOGY_REFRESH if refresh is None else refresh
+        self.meters = {}
+        self.batteries = {}
+        self.identity = {}
+        self.discovered = None
+        self.changed = False
 
+    def invalidate(self):
+        """
+        Forces the topology to be rediscovered on next use
+        """
+        self.discovered = None
 
-def on_log(client, userdata, level, buf):
-    logging.debug("log: " + buf)
+    def stale(self):
+        """
+        Returns True if the topology needs to be rediscovered
+        """
+        return self.discovered is None or \
+            time.monotonic() - self.discovered > self.refresh
 
+    def discover(self, s_d):
+        """
+        Probes the meter and battery slots of the inverter and reads their identity registers
+        """
+        logging.debug("Discovering meters and batteries")
+        previous = self.identity
+        self.meters = {}
+        self.batteries = {}
+        self.identity = {}
+        for devices, found in ((self.meters, s_d.meters()),
+                               (self.batteries, s_d.batteries())):
+            for name, device in found.items():
+                # solaredge_modbus gives meters and batteries the default unit, not their inverter's
+                device.unit = s_d.unit
+                fields = [k for k in device.registers if k.startswith("c_")]
+                identity = read_blocks(device, register_blocks(device, fields))
+                if identity is None:
+                    logging.warning("Unable to read identity of %s - ignoring", name)
+                    continue
+                devices[name] = device
+                self.identity[name] = identity
+        self.discovered = time.monotonic()
+        logging.debug("Found meters %s, batteries %s",
+                      list(self.meters), list(self.batteries))
+        if self.identity != previous:
+            self.changed = True
+
+    def meter(self, s_d, name):
+        """
+        Returns the named meter, rediscovering the topology if it is stale
+        """
+        if self.stale():
+            self.discover(s_d)
+        return self.meters[name]
 
-def main():
+    def storage(self, s_d):
+        """
+        Returns the batteries found, rediscovering the topology if it is stale
+        """
+        if self.stale():
+            self.discover(s_d)
+        return self.batteries
+
+
+class RegisterCapture():
     """
-    Main processing loop
+    This class is used to append the raw registers of one target to its daily capture files in
+    CAPTURE_DIR. Records are kept in memory and written as one compressed frame every
+    CAPTURE_FLUSH_TIME seconds, so a crash loses at most that many seconds of capture
     """
 
-    # pylint: disable=global-statement
-    # use of global statement here is required to allow main() to set the value based on passed arguments to the program
+    def __init__(self, name, capture_dir=CAPTURE_DIR):
 
-    global DEBUG, INFLUX_PASSWORD
+        self.name = name or "solaredge"
+        self.capture_dir = capture_dir
+        self.layout = None
+        self.day = None
+        self.times = array.array('q')
+        self.values = array.array('d')
+        self.flushed = time.monotonic()
+        os.makedirs(capture_dir, exist_ok=True)
 
-    # Get the passwords from the plain text keyring
-    keyring.set_keyring(PlaintextKeyring())
-    mqtt_password = keyring.get_password(MQTT_HOST, MQTT_USER)
-    INFLUX_PASSWORD = keyring.get_password(INFLUX_HOST, INFLUX_USER)
+    def path(self):
+        """
+        Returns the capture file for the current day
+        """
+        return os.path.join(self.capture_dir, self.name + "-" + self.day + ".cap")
 
-    try:
-        pid_file = os.environ['PIDFILE']
-    except:
-        pid_file = "UNDEFINED"
+    def append(self, timestamp, devices):
+        """
+        Adds a record of the (kind, name, fields, registers) of each device read at timestamp
+        """
+        layout = [[kind, name, fields] for kind, name, fields, data in devices]
+        day = time.strftime("%Y-%m-%d", time.gmtime(timestamp // 10**9))
+        if layout != self.layout or day != self.day:
+            self.flush()
+            self.layout = layout
+            self.day = day
+            self.write(b"H", json.dumps({"version": CAPTURE_VERSION, "name": self.name,
+                                         "devices": layout}).encode("utf-8"))
+        self.times.append(timestamp)
+        for kind, name, fields, data in devices:
+            self.values.extend(float(data[field]) if field in data else float('nan')
+                               for field in fields)
+        if time.monotonic() - self.flushed >= CAPTURE_FLUSH_TIME:
+            self.flush()
+
+    def write(self, kind, payload):
+        """
+        Appends a frame to the capture file, dropping it if the file cannot be written
+        """
+        try:
+            with open(self.path(), "ab") as _f:
+                _f.write(struct.pack("<cI", kind, len(payload)) + payload)
+        except OSError as err:
+            logging.warning("Unable to write capture %s - %s", self.path(), err)
 
-    args = parse_args()
+    def flush(self):
+        """
+        Writes the records held in memory as one compressed frame
+        """
+        self.flushed = time.monotonic()
+        if not self.times:
+            return
+        if sys.byteorder == "big":
+            self.times.byteswap()
+            self.values.byteswap()
+        self.write(b"R", zlib.compress(struct.pack("<I", len(self.times)) +
+                                       self.times.tobytes() + self.values.tobytes()))
+        self.times = array.array('q')
+        self.values = array.array('d')
+
+
+def read_capture(path):
+    """
+    Yields the layout, timestamps and values of each record frame in a capture file.
+    A frame cut short by a crash ends the file
+    """
+    layout = None
+    with open(path, "rb") as _f:
+        while True:
+            header = _f.read(5)
+            if len(header) < 5:
+                return
+            kind, length = struct.unpack("<cI", header)
+            payload = _f.read(length)
+            if len(payload) < length:
+                logging.warning("Capture %s ends with a partial frame", path)
+                return
+            if kind == b"H":
+                layout = json.loads(payload)
+                if layout["version"] != CAPTURE_VERSION:
+                    raise ValueError("unsupported capture version %s" % layout["version"])
+                continue
+            data = zlib.decompress(payload)
+            count = struct.unpack("<I", data[:4])[0]
+            times = array.array('q', data[4:4 + 8 * count])
+            values = array.array('d', data[4 + 8 * count:])
+            if sys.byteorder == "big":
+                times.byteswap()
+                values.byteswap()
+            yield layout, times, values
+
+
+def capture_registers(fields, values):
+    """
+    Rebuilds the register dict of one device from captured values. Scale factors and codes are
+    integers on the device, other fields are used as captured
+    """
+    data = {}
+    for field, value in zip(fields, values):
+        if value != value:
+            continue
+        if field.endswith("_scale") or field in CODE_FIELDS:
+            value = int(value)
+        data[field] = value
+    return data
 
-    # Setup logging
 
-    if args.D:
-        DEBUG = True
-        set_logging('debug')
-        logging.debug("Running in debug mode, not writing data")
-    else:
-        DEBUG = False
-        set_logging('info')
-        if pid_file != "UNDEFINED":
-            if os.path.exists(pid_file):
-                logging.error(
-                    "PID already exists. Is getsolar already running?")
-                logging.error(
-                    "Either, stop the running process or remove %s or run with the debug flag set (-D)", pid_file)
-                sys.exit(2)
-            else:
-                write_pid_file(pid_file)
+def capture_files(paths):
+    """
+    Expands directories to the capture files they hold and returns every file in name order,
+    which is time order for each target
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in os.listdir(path)
+                         if name.endswith(".cap"))
+        else:
+            files.append(path)
+    return sorted(files)
 
-    # Connect to MQTT
 
-    m_d = mqtt.Client(MQTT_CLIENT_NAME)
-    m_d.connected_flag = False
-    m_d.error_code = 0
-    m_d.on_connect = on_connect  # bind call back function
-    m_d.on_disconnect = on_disconnect
-    m_d.on_log = on_log
-    m_d.username_pw_set(MQTT_USER, mqtt_password)
-    m_d.connect(MQTT_HOST, int(MQTT_PORT))
-    m_d.loop_start()
+def replay(paths, batcher, rollups=None, integrate=ENERGY_INTEGRATION):
+    """
+    Runs captured registers through the same scaling and sample building as InverterData.update
+    and writes the samples with write_power and write_ha (and the rollups, whose open windows are
+    written at the end), flushing the batcher every REPLAY_BATCH samples. Records missing
+    REQUIRED_REGISTERS are skipped. Returns the number of samples replayed; raises OSError once
+    any batch could not be written
+    """
+    targets = {}
+    samples = 0
+    for path in capture_files(paths):
+        started = time.monotonic()
+        replayed = 0
+        skipped = 0
+        for layout, times, values in read_capture(path):
+            if layout["name"] not in targets:
+                name = "" if layout["name"] == "solaredge" else layout["name"]
+                targets[layout["name"]] = InverterData(name)
+                if integrate:
+                    targets[layout["name"]].integrator = EnergyIntegrator()
+            inv_data = targets[layout["name"]]
+            width = sum(len(fields) for kind, name, fields in layout["devices"])
+            for i, timestamp in enumerate(times):
+                row = i * width
+                devices = {"inverter": {}, "meter": {}, "battery": {}}
+                for kind, name, fields in layout["devices"]:
+                    devices[kind][name] = capture_registers(fields, values[row:row + len(fields)])
+                    row += len(fields)
+                inv_regs = next(iter(devices["inverter"].values()))
+                meter_regs = next(iter(devices["meter"].values()))
+                if missing_registers(inv_regs, meter_regs, devices["battery"], identity=False):
+                    skipped += 1
+                    continue
+                sample = inv_data.record(
+                    timestamp, inv_regs, meter_regs, devices["battery"],
+                    inv_data.scale(inv_regs, meter_regs, devices["battery"]))
+                write_power(batcher, sample)
+                write_ha(batcher, sample)
+                if rollups is not None:
+                    write_rollup(rollups, sample)
+                replayed += 1
+                if (samples + replayed) % REPLAY_BATCH == 0:
+                    replay_flush(batcher)
+        replay_flush(batcher)
+        samples += replayed
+        logging.info("Replayed %s samples from %s in %.1fs",
+                     replayed, path, time.monotonic() - started)
+        if skipped:
+            logging.warning("Skipped %s incomplete records in %s", skipped, path)
+    if rollups is not None:
+        rollups.flush()
+        replay_flush(batcher)
+    return samples
+
+
+def replay_flush(batcher):
+    """
+    Writes every waiting batch of a replay. Raises OSError if any write has failed, so a replay
+    never reports points as written that InfluxDB did not accept
+    """
+    batcher.close()
+    if batcher.failed:
+        raise OSError("InfluxDB did not accept %s points" % batcher.failed)
 
-    retry = MAX_RETRIES
-    while not m_d.connected_flag:
-        if retry == 0:
-            # wait in loop for MAX_RETRIES
-            sys.exit("Connect failed with error", m_d.error_code)
+
+class EnergyIntegrator():
+    """
+    This class is used to derive smooth energy counters from the power samples. Each counter is
+    the hardware counter value it was last anchored to plus the trapezoidal integral of its power
+    field since. It re-anchors once the hardware counter has moved and ENERGY_ANCHOR_TIME seconds
+    have passed, and after any gap longer than ENERGY_MAX_GAP seconds, whose energy is left to the
+    hardware counter. Published counters never decrease: an overestimate is held until the
+    hardware counter catches up
+    """
+
+    def __init__(self, max_gap=ENERGY_MAX_GAP, anchor_time=ENERGY_ANCHOR_TIME):
+
+        self.max_gap = max_gap * 10**9
+        self.anchor_time = anchor_time * 10**9
+        self.counters = [(Field[energy], Field[power]) for energy, power in ENERGY_COUNTERS.items()]
+        self.previous = None
+        self.anchored = 0
+        self.anchors = [float('nan')] * len(self.counters)
+        self.energy = [0.0] * len(self.counters)
+        self.published = [float('-inf')] * len(self.counters)
+
+    def anchor(self, timestamp, hardware):
+        """
+        Restarts integration from the hardware counters
+        """
+        for i, value in enumerate(hardware):
+            if value < self.anchors[i]:
+                logging.info("Energy counter %s went backwards - restarting",
+                             self.counters[i][0].name)
+                self.published[i] = float('-inf')
+        self.anchors = hardware
+        self.energy = [0.0] * len(self.counters)
+        self.anchored = timestamp
+
+    def update(self, timestamp, values):
+        """
+        Replaces the hardware energy counters in a sample's values with the integrated counters
+        """
+        hardware = [values[energy] for energy, power in self.counters]
+        powers = [values[power] for energy, power in self.counters]
+        previous = self.previous
+        if previous is None or not 0 < timestamp - previous[0] <= self.max_gap:
+            if previous is not None:
+                logging.info("Energy integration gap of %.1fs - anchoring to hardware counters",
+                             (timestamp - previous[0]) / 1e9)
+            self.anchor(timestamp, hardware)
+        elif timestamp - self.anchored >= self.anchor_time and hardware != self.anchors:
+            self.anchor(timestamp, hardware)
         else:
-            if m_d.error_code == 5:
-                sys.exit("Authorisation Failure" + mqtt_password)
-            time.sleep(1)
-            retry -= 1
+            hours = (timestamp - previous[0]) / 3.6e12
+            for i, (first, last) in enumerate(zip(previous[1], powers)):
+                if first == first and last == last:
+                    self.energy[i] += (first + last) / 2 * hours
+        for i, (energy, power) in enumerate(self.counters):
+            estimate = self.anchors[i] + self.energy[i]
+            if estimate == estimate:
+                self.published[i] = max(self.published[i], estimate)
+                values[energy] = self.published[i]
+        self.previous = (timestamp, powers)
 
-    # Connect to two InfluxDB databases
-    #   DB 1 = Home Assistant database for one minute logging of power and energy data
-    #   DB 2 = Powerlogging for 10s logging of power only
 
-    d_d = InfluxDBClient(INFLUX_HOST, INFLUX_PORT,
-                         INFLUX_USER, INFLUX_PASSWORD, INFLUX_DB_ALL)
-    d_p = InfluxDBClient(INFLUX_HOST, INFLUX_PORT,
-                         INFLUX_USER, INFLUX_PASSWORD, INFLUX_DB_POWER)
+class InverterData():
+    """
+    This class is used to hold data read from the inverter
+    """
+    # pylint: disable=too-many-instance-attributes
+    # Eleven is reasonable in this case.
+
+    def __init__(self, name=""):
 
-    inv_data = InverterData()
+        self.new = True
+        self.name = name
+        self.timestamp = 0
+        self.latest = None
 
-    # Initialise cycle counter and number of retries
+        self.inv_data = {}
+        self.meter_data = {}
+        self.inv_values = {}
+        self.meter_values = {}
+        self.battery_data = {}
+        self.battery_values = {}
+        self.profile = REGISTER_PROFILE
+        self.blocks = {}
+        self.meter_name = METER_NAME
+        self.topology = DeviceTopology()
+        self.integrator = EnergyIntegrator() if ENERGY_INTEGRATION else None
+        self.capture = None
+        self.power_topic = target_topic(POWER_TOPIC, name)
+        self.inverter_topic = target_topic(INVERTER_TOPIC, name)
+        self.meter_topic = target_topic(METER_TOPIC, name)
+        self.battery_topic = target_topic(BATTERY_TOPIC, name)
+        self.tags = {
+            'domain': INFLUX_DOMAIN,
+            'entity_id': INFLUX_ENTITY
+        }
+        if name:
+            self.tags['device'] = name
+        self.target = SampleTarget(name, self.tags, self.power_topic,
+                                   self.inverter_topic, self.meter_topic, self.battery_topic)
+        self.inverterUniqueIDPrefix = ""
+        self.meterUniqueIDPrefix = ""
+        self.discovery = {}
+        self.discovering = False
 
-    counter = MAX_COUNTER
-    retry = MAX_RETRIES
-    firstRun = True
-
-    # Connect to solaredge modbus inverter
-
-    logging.debug("Connect to device. Host " + args.i + " Port " +
-                  str(args.p) + " Timeout " + str(args.t) + " Unit " + str(args.u))
-    s_d = solaredge_modbus.Inverter(
-        host=args.i, port=args.p, timeout=args.t, unit=args.u)
-    # s_d.connect()
-
-    # Try up to MAX_RETRIES times to read data from the inverter
-
-    while retry != 0:
-        if not s_d.connect():
-            retry -= 1
-            time.sleep(WAIT_TIME)
-            logging.debug("Retry. Connect to device. Host " +
-                          args.i + " Port " + str(args.p) + " Timeout " + str(args.t) + " Unit " + str(args.u))
-            s_d = solaredge_modbus.Inverter(
-                host=args.i, port=args.p, timeout=args.t, unit=args.u)
-        else:
-            waitSeconds = SLEEP_TIME - \
-                (datetime.datetime.now().second % SLEEP_TIME)
-            energyTime = int(datetime.datetime.now().second / SLEEP_TIME) + 1
-            # logging.info("Sleeping for " + str(waitSeconds))
-            time.sleep(waitSeconds)
-
-            retry = MAX_RETRIES
-            # Read registers
-            logging.debug("Reading data - cycle %s", counter)
-            inv_data.update(s_d)
-            if firstRun:
-
-                # Once the first read of the inverter registers has been completed - send discovery data to HA
-
-                inv_data.ha_discovery(m_d)
-                firstRun = False
-            inv_data.write_power(d_p)
-            inv_data.write_ha(m_d, d_d)
+    def update(self, s_d):
+        """
+        Reads the inverter, meter and battery registers once.
+        Returns True if a new sample was built; retrying is left to the ModbusSession
+        """
+        # pylint: disable=broad-except
+        # broad exception is reasonable in this case as exceptions are not inherited from the class pymodbus
+        # by solaredge_modbus
+
+        try:
+            read_time = time.time_ns()
+            inv_data = self.read_registers(
+                s_d, INVERTER_FIELDS, self.inv_data)
+            meter1 = self.topology.meter(s_d, self.meter_name)
+            meter_data = self.read_registers(
+                meter1, METER_FIELDS, self.topology.identity[self.meter_name])
+            battery_data = {}
+            for name, battery in self.topology.storage(s_d).items():
+                battery_data[name] = self.read_registers(
+                    battery, BATTERY_FIELDS,
+                    self.battery_data.get(name) or self.topology.identity[name])
+            missing = missing_registers(inv_data, meter_data, battery_data)
+            if missing:
+                logging.warning("Incomplete register read - missing %s", ", ".join(missing))
+                return False
+            self.record(read_time, inv_data, meter_data, battery_data,
+                        self.scale(inv_data, meter_data, battery_data))
+
+        except Exception:
+            logging.warning("Register read error", exc_info=True)
+            self.topology.invalidate()
+            return False
+
+        if self.capture:
+            self.capture.append(read_time, [
+                ("inverter", "Inverter", INVERTER_FIELDS, inv_data),
+                ("meter", self.meter_name, METER_FIELDS, meter_data)] + [
+                ("battery", name, BATTERY_FIELDS, data) for name, data in battery_data.items()])
+        logging.debug('Timestamp: %s', self.timestamp)
+        return True
+
+    @staticmethod
+    def scale(inv_data, meter_data, battery_data):
+        """
+        Returns the engineering values of the inverter, meter and (combined) battery registers
+        """
+        return (scale_values(inv_data, INVERTER_SCALES),
+                scale_values(meter_data, METER_SCALES),
+                combine_batteries(
+                    [scale_values(data, BATTERY_SCALES) for data in battery_data.values()]))
+
+    def record(self, read_time, inv_data, meter_data, battery_data, scaled):
+        """
+        Keeps the registers read at read_time with their engineering values and returns the new Sample.
+        Nothing is kept if the sample cannot be built
+        """
+        sample = self.build_sample(read_time, *scaled)
+        self.inv_data = inv_data
+        self.meter_data = meter_data
+        self.battery_data = battery_data
+        self.inv_values, self.meter_values, self.battery_values = scaled
+        self.timestamp = read_time
+        self.latest = sample
+        return sample
+
+    def build_sample(self, timestamp, inv_values, meter_values, battery_values):
+        """
+        Packs engineering values, power flows and energy counters into a Sample
+        """
+        values = array.array('d', EMPTY_SAMPLE)
+        for field, value in inv_values.items():
+            values[Field["inverter_" + field]] = value
+        for field, value in meter_values.items():
+            values[Field["meter_" + field]] = value
+        for field, value in battery_values.items():
+            values[Field["battery_" + field]] = value
+
+        # Update power data
+
+        meter_power = meter_values['power']
+        values[Field.power_prod] = inv_values['power_ac']
+        if meter_power > 0:
+            values[Field.power_exp] = meter_power
+            values[Field.power_imp] = 0.0
+        else:
+            values[Field.power_imp] = -1.0*meter_power
+            values[Field.power_exp] = 0.0
+        battery_power = battery_values.get('instantaneous_power', float('nan'))
+        if battery_power == battery_power:
+            values[Field.power_charge] = max(battery_power, 0.0)
+            values[Field.power_discharge] = max(-battery_power, 0.0)
+            values[Field.power_pv] = max(values[Field.power_prod] + battery_power, 0.0)
+        values[Field.power_load] = \
+            values[Field.power_prod]-values[Field.power_exp]+values[Field.power_imp]
+
+        # Update energy data
+
+        values[Field.energy_prod] = inv_values['energy_total']
+        values[Field.energy_imp] = meter_values['import_energy_active']
+        values[Field.energy_exp] = meter_values['export_energy_active']
+        if battery_values:
+            values[Field.energy_charge] = battery_values['lifetime_import_energy_counter']
+            values[Field.energy_discharge] = battery_values['lifetime_export_energy_counter']
+        if self.integrator:
+            self.integrator.update(timestamp, values)
+        values[Field.energy_cons] = \
+            values[Field.energy_prod]-values[Field.energy_exp]+values[Field.energy_imp]
+        values[Field.energy_scons] = values[Field.energy_prod]-values[Field.energy_exp]
+        return Sample(self.target, timestamp, values)
+
+    def read_registers(self, device, fields, data):
+        """
+        Reads device registers according to the register profile.
+        A full read is made until the static c_* identity fields are known (from
+        a previous read or the topology cache); later reads only fetch the blocks
+        holding the profile fields
+        """
+        if self.profile == 'minimal' and data:
+            if device.model not in self.blocks:
+                self.blocks[device.model] = register_blocks(device, fields)
+            blocks = self.blocks[device.model]
+            if blocks:
+                values = read_blocks(device, blocks)
+                if values is not None:
+                    result = {k: v for k, v in data.items() if k.startswith("c_")}
+                    result.update(values)
+                    return result
+            logging.debug(
+                "Register profile incomplete for %s - reading all registers", device.model)
+        return device.read_all()
+
+    def discovery_payloads(self):
+        """
+        Builds the serialised HA discovery config for every sensor in DISCOVERY_SENSORS,
+        keyed by config topic
+        """
+
+        # generate uniqueID prefix and populate device data
+
+        self.inverterUniqueIDPrefix = self.inv_data["c_model"] + \
+            "-" + self.inv_data["c_serialnumber"]
+        self.meterUniqueIDPrefix = self.meter_data["c_model"] + \
+            "-" + self.meter_data["c_serialnumber"]
+        prefixes = {
+            "inverter": self.inverterUniqueIDPrefix,
+            "meter": self.meterUniqueIDPrefix
+        }
+        identities = [("inverter", self.inv_data, "Solaredge Inverter"),
+                      ("meter", self.meter_data, "Solaredge Meter")]
+        if self.battery_data:
+            battery = self.battery_data[min(self.battery_data)]
+            prefixes["battery"] = battery["c_model"] + "-" + battery["c_serialnumber"]
+            identities.append(("battery", battery, "Solaredge Battery"))
+        devices = {}
+        for device, data, name in identities:
+            devices[device] = {
+                "identifiers": [prefixes[device]],
+                "manufacturer": data["c_manufacturer"],
+                "model": data["c_model"],
+                "name": name,
+                "sw_version": data["c_version"]
+            }
+        state_topics = {
+            "inverter": self.inverter_topic,
+            "meter": self.meter_topic,
+            "battery": self.battery_topic,
+            "power": self.power_topic
+        }
+
+        payloads = {}
+        for sensor in DISCOVERY_SENSORS:
+            if sensor.device not in prefixes:
+                continue
+            prefix = prefixes[sensor.device]
+            payload = {
+                "device": devices[sensor.device],
+                "icon": sensor.icon,
+                "name": sensor.name,
+                "state_topic": state_topics[sensor.state],
+                "unique_id": prefix + (sensor.unique or sensor.key),
+                "value_template": sensor.template
+            }
+            if sensor.unit:
+                payload["unit_of_measurement"] = sensor.unit
+            payload["platform"] = "mqtt"
+            if sensor.device_class:
+                payload["device_class"] = sensor.device_class
+                payload["state_class"] = sensor.state_class
+            topic = AUTODISCOVERY_PREFIX + "/" + "sensor" + "/" + prefix + sensor.key + "/" + "config"
+            payloads[topic] = json.dumps(payload)
+        return payloads
+
+    def ha_discovery(self, mqtt_ha, cache):
+        """
+        Sends sensor discovery data to HA.
+        Payloads are built once and again whenever the topology changes; a config is only
+        republished if its hash differs from the one last published (cache) or from the retained
+        copy held by the broker
+        """
+        if not self.discovery or self.topology.changed:
+            self.topology.changed = False
+            self.discovery = self.discovery_payloads()
+        hashes = {topic: payload_hash(payload) for topic, payload in self.discovery.items()}
+        retained = retained_hashes(mqtt_ha, list(self.discovery))
+
+        published = 0
+        for topic, payload in self.discovery.items():
+            if cache.get(topic) == hashes[topic] and retained.get(topic) == hashes[topic]:
+                continue
+            mqtt_ha.publish(topic, payload, retain=True)
+            published += 1
+        cache.update(hashes)
+        logging.info("HA discovery - published %s of %s configs", published, len(self.discovery))
+
+    def queue_discovery(self, executor, mqtt_ha, cache):
+        """
+        Queues ha_discovery in the executor after the first read and again whenever the topology
+        changes, so waiting for the retained configs never holds up a poll
+        """
+        if self.discovering or not (self.new or self.topology.changed):
+            return
+        self.discovering = True
+        executor.submit(self.run_discovery, mqtt_ha, cache)
+
+    def run_discovery(self, mqtt_ha, cache):
+        """
+        Sends discovery data to HA from the executor. A failed attempt is retried after the
+        next poll
+        """
+        # pylint: disable=broad-except
+        # the executor would otherwise drop the exception silently
+        try:
+            self.ha_discovery(mqtt_ha, cache)
+            self.new = False
+        except Exception:
+            logging.warning("HA discovery failed", exc_info=True)
+        finally:
+            self.discovering = False
+
+    def sample(self):
+        """
+        Returns the immutable snapshot of the latest readings for the publish pipeline
+        """
+        return self.latest
+
+
+class Sample():
+    """
+    This class is used to hold one immutable sample: the target it was read from, the read time
+    in nanoseconds and every engineering value in a read-only view of an array('d') indexed by
+    Field. Values that were not read are NaN
+    """
+
+    __slots__ = ("target", "timestamp", "values")
+
+    def __init__(self, target, timestamp, values):
+        object.__setattr__(self, "target", target)
+        object.__setattr__(self, "timestamp", timestamp)
+        object.__setattr__(self, "values", memoryview(values).toreadonly())
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Sample is immutable")
+
+    def __reduce__(self):
+        return (Sample, (self.target, self.timestamp, array.array('d', self.values)))
+
+    def __getitem__(self, field):
+        return self.values[field]
+
+    def state(self, device):
+        """
+        Returns the published state of the inverter, meter or battery as a dict,
+        omitting values not read
+        """
+        state = {}
+        for name, index, code in DEVICE_FIELDS[device]:
+            value = self.values[index]
+            if value != value:
+                continue
+            state[name] = int(value) if code else value
+        if device == "inverter" and "status" in state:
+            # Decode inverter status
+            status = state["status"]
+            if 0 <= status < len(solaredge_modbus.INVERTER_STATUS_MAP):
+                state["status"] = solaredge_modbus.INVERTER_STATUS_MAP[status]
+        elif device == "battery" and "status" in state:
+            # Decode battery status
+            status = state["status"]
+            if 0 <= status < len(solaredge_modbus.BATTERY_STATUS_MAP):
+                state["status"] = solaredge_modbus.BATTERY_STATUS_MAP[status]
+        return state
+
+    def battery(self):
+        """
+        Returns True if the sample includes battery flows
+        """
+        return self.values[Field.power_charge] == self.values[Field.power_charge]
+
+
+def influx_time(timestamp):
+    """
+    Converts a nanosecond timestamp to an integer in TIME_PRECISION units
+    """
+    return timestamp // TIME_DIVISOR[TIME_PRECISION]
+
+
+def escape_line(value):
+    """
+    Escapes a measurement, tag or field key for line protocol as make_lines does
+    """
+    return str(value).replace("\\", "\\\\").replace(" ", "\\ ").replace(",", "\\,") \
+        .replace("=", "\\=").replace("\n", "\\n")
+
+
+class LineEncoder():
+    """
+    This class is used to encode the measurements written for each sample straight to line
+    protocol, producing the same lines as make_lines without building point dicts. The
+    measurement and tag prefix is computed once per target, the field keys are escaped and sorted
+    once, and values are read from the sample array with an integer timestamp. Fields that were
+    not read (NaN) are left out, as is a measurement with no fields
+    """
+
+    def __init__(self, measurements):
+
+        self.measurements = []
+        for measurement, fields in measurements.items():
+            keys = sorted(fields)
+            self.measurements.append((escape_line(measurement),
+                                      [escape_line(key) + "=" for key in keys],
+                                      [fields[key] for key in keys]))
+        self.prefixes = {}
+
+    def prefix(self, target):
+        """
+        Returns the escaped, sorted tag set of a target
+        """
+        tags = self.prefixes.get(target.name)
+        if tags is None:
+            tags = "".join("," + escape_line(key) + "=" + escape_line(value)
+                           for key, value in sorted(target.tags.items())
+                           if key != "" and str(value) != "")
+            self.prefixes[target.name] = tags
+        return tags
+
+    def lines(self, sample):
+        """
+        Returns the line protocol strings for a sample
+        """
+        values = sample.values
+        suffix = " " + str(influx_time(sample.timestamp))
+        tags = self.prefix(sample.target)
+        lines = []
+        for measurement, keys, fields in self.measurements:
+            encoded = [key + repr(values[field]) for key, field in zip(keys, fields)
+                       if values[field] == values[field]]
+            if encoded:
+                lines.append(measurement + tags + " " + ",".join(encoded) + suffix)
+        return lines
+
+
+POWER_LINES = LineEncoder({
+    'W': {
+        'Production': Field.power_prod,
+        'Import': Field.power_imp,
+        'Export': Field.power_exp,
+        'Load': Field.power_load,
+        'Charge': Field.power_charge,
+        'Discharge': Field.power_discharge,
+        'PV': Field.power_pv
+    },
+    '%': {
+        'State of Energy': Field.battery_soe
+    }
+})
+ENERGY_LINES = LineEncoder({
+    'Wh': {
+        'Production': Field.energy_prod,
+        'Import': Field.energy_imp,
+        'Export': Field.energy_exp,
+        'Consumption': Field.energy_cons,
+        'Self-Consumption': Field.energy_scons,
+        'Charge': Field.energy_charge,
+        'Discharge': Field.energy_discharge
+    }
+})
+
+
+def write_ha(influx_ha, sample):
+    """
+    Writes energy utilisation data to the Home Assistant database
+    """
+    # Write energy values to influx
+    if not DEBUG:
+        logging.debug("Writing energy points")
+        influx_ha.write_lines(ENERGY_LINES.lines(sample), time_precision=TIME_PRECISION,
+                              database=INFLUX_DB_ALL, retention_policy=INFLUX_RP_ALL)
+    else:
+        logging.debug(
+            "Energy  - Production: %s, Export: %s, Import: %s, Consumption: %s, Self Consumption: %s",
+            sample[Field.energy_prod],
+            sample[Field.energy_exp],
+            sample[Field.energy_imp],
+            sample[Field.energy_cons],
+            sample[Field.energy_scons])
+
+
+def write_mqtt(mqtt_ha, sample):
+    """
+    Publishes power, inverter and meter state to Home Assistant through a DeadbandPublisher
+    """
+    if not DEBUG:
+        logging.debug("Publishing state")
+        power_data = {
+            "production": sample[Field.power_prod]/1000,
+            "export": sample[Field.power_exp]/1000,
+            "import": sample[Field.power_imp]/1000,
+            "load": sample[Field.power_load]/1000
+        }
+        if sample.battery():
+            power_data["charge"] = sample[Field.power_charge]/1000
+            power_data["discharge"] = sample[Field.power_discharge]/1000
+            power_data["pv"] = sample[Field.power_pv]/1000
+        mqtt_ha.publish(sample.target.power_topic, power_data)
+        mqtt_ha.publish(sample.target.inverter_topic, sample.state("inverter"))
+        mqtt_ha.publish(sample.target.meter_topic, sample.state("meter"))
+        if sample.battery():
+            mqtt_ha.publish(sample.target.battery_topic, sample.state("battery"))
+
+
+def write_power(influx_pw, sample):
+    """
+    Writes power utilisation data to the powerlogging database
+    """
+    # Write power values to influx
+    if not DEBUG:
+        logging.debug("Writing power points")
+        influx_pw.write_lines(POWER_LINES.lines(sample), time_precision=TIME_PRECISION,
+                              database=INFLUX_DB_POWER, retention_policy=INFLUX_RP_POWER)
+    else:
+        # Print published values to log
+        logging.debug("Power - Production: %s, Export: %s, Import: %s, Load: %s",
+                      sample[Field.power_prod], sample[Field.power_exp], sample[Field.power_imp], sample[Field.power_load])
+
+
+class Rollup():
+    """
+    This class is used to aggregate the power fields of one target over a tumbling window.
+    Windows are aligned to multiples of their length; each keeps the running min, max, mean and
+    the trapezoidal integral in Wh. A segment that crosses a window boundary is split at the
+    boundary by linear interpolation so energy is never lost between windows
+    """
+
+    def __init__(self, window, fields=ROLLUP_FIELDS, max_gap=ROLLUP_MAX_GAP):
+
+        self.window = window
+        self.length = window.seconds * 10**9
+        self.max_gap = max_gap * 10**9
+        self.names = list(fields)
+        self.fields = [Field[field] for field in fields.values()]
+        self.start = None
+        self.previous = None
+        self.target = None
+        self.reset(0)
+
+    def reset(self, start):
+        """
+        Starts a new window
+        """
+        self.start = start
+        self.first = None
+        size = len(self.fields)
+        self.mins = [float('inf')] * size
+        self.maxs = [float('-inf')] * size
+        self.sums = [0.0] * size
+        self.counts = [0] * size
+        self.energy = [0.0] * size
+
+    def integrate(self, start, start_values, end, end_values):
+        """
+        Adds the trapezoidal Wh between two points to the window
+        """
+        hours = (end - start) / 3.6e12
+        for i, (first, last) in enumerate(zip(start_values, end_values)):
+            if first == first and last == last:
+                self.energy[i] += (first + last) / 2 * hours
+
+    def add(self, sample):
+        """
+        Adds a sample and returns the point for the window it closed, or None
+        """
+        timestamp = sample.timestamp
+        values = [sample[field] for field in self.fields]
+        point = None
+        start = timestamp - timestamp % self.length
+        previous = self.previous
+        if previous is not None and timestamp <= previous[0]:
+            return None
+        joined = previous is not None and timestamp - previous[0] <= self.max_gap
+        if previous is None:
+            self.reset(start)
+        elif start != self.start:
+            boundary = self.start + self.length
+            if joined:
+                fraction = (boundary - previous[0]) / (timestamp - previous[0])
+                middle = [first + (last - first) * fraction
+                          for first, last in zip(previous[1], values)]
+                self.integrate(previous[0], previous[1], boundary, middle)
+            point = self.point(sample.target)
+            self.reset(start)
+            if joined and start == boundary:
+                self.integrate(boundary, middle, timestamp, values)
+        elif joined:
+            self.integrate(previous[0], previous[1], timestamp, values)
+        for i, value in enumerate(values):
+            if value == value:
+                self.mins[i] = min(self.mins[i], value)
+                self.maxs[i] = max(self.maxs[i], value)
+                self.sums[i] += value
+                self.counts[i] += 1
+        if self.first is None:
+            self.first = timestamp
+        self.previous = (timestamp, values)
+        self.target = sample.target
+        return point
+
+    def point(self, target, partial=False):
+        """
+        Returns the Influx point for the current window, or None if it holds no values. A partial
+        point is tagged partial=true and timestamped at the window's first sample, so it is kept
+        alongside the point written once the window closes and the two add up to the whole window
+        """
+        fields = {}
+        for i, name in enumerate(self.names):
+            if self.counts[i]:
+                fields[name + "_min"] = self.mins[i]
+                fields[name + "_max"] = self.maxs[i]
+                fields[name + "_mean"] = self.sums[i] / self.counts[i]
+                fields[name + "_Wh"] = self.energy[i]
+        if not fields:
+            return None
+        fields["samples"] = max(self.counts)
+        if partial:
+            return {
+                'measurement': self.window.measurement,
+                'time': influx_time(self.first),
+                'tags': dict(target.tags, partial="true"),
+                'fields': fields
+            }
+        return {
+            'measurement': self.window.measurement,
+            'time': influx_time(self.start),
+            'tags': target.tags,
+            'fields': fields
+        }
+
+
+class Rollups():
+    """
+    This class is used to feed samples through one Rollup per target and window and write each
+    closed window to its database and retention policy. The windows still open are written by
+    flush, at shutdown and at the end of a replay
+    """
+
+    def __init__(self, client, windows=None):
+
+        self.client = client
+        self.windows = ROLLUP_WINDOWS if windows is None else windows
+        self.rollups = {}
+        self.lock = threading.Lock()
+
+    def add(self, sample):
+        """
+        Adds a sample to every window of its target and writes any closed windows
+        """
+        name = sample.target.name
+        with self.lock:
+            if name not in self.rollups:
+                self.rollups[name] = [Rollup(window) for window in self.windows]
+            for rollup in self.rollups[name]:
+                self.write(rollup, rollup.add(sample))
+
+    def flush(self):
+        """
+        Writes the partial point of every open window. After a restart the window is started
+        again from the first new sample, so the partial point keeps the samples before it
+        """
+        with self.lock:
+            for rollups in self.rollups.values():
+                for rollup in rollups:
+                    if rollup.target is not None:
+                        self.write(rollup, rollup.point(rollup.target, partial=True))
+
+    def write(self, rollup, point):
+        """
+        Writes a window's point, if any, to the database and retention policy of its window
+        """
+        if point is None:
+            return
+        if not DEBUG:
+            logging.debug("Writing %s rollup", rollup.window.measurement)
+            self.client.write_points([point], time_precision=TIME_PRECISION,
+                                     database=rollup.window.database or INFLUX_DB_POWER,
+                                     retention_policy=rollup.window.retention_policy)
+        else:
+            logging.debug("Rollup  - %s: %s", rollup.window.measurement, point['fields'])
+
+
+def write_rollup(rollups, sample):
+    """
+    Adds a sample to the rollups of its target
+    """
+    rollups.add(sample)
+
+
+class SampleHistory():
+    """
+    This class is used to keep the most recent samples of one target in a fixed size ring buffer.
+    Each field is stored in its own array('d') column so queries only touch the fields they need
+    """
+
+    def __init__(self, capacity):
+
+        self.capacity = capacity
+        self.count = 0
+        self.head = 0
+        self.times = array.array('q', [0]) * capacity
+        self.columns = [array.array('d', [float('nan')]) * capacity for field in Field]
+        self.lock = threading.Lock()
+
+    def append(self, sample):
+        """
+        Stores a sample, overwriting the oldest once the buffer is full
+        """
+        with self.lock:
+            pos = self.head
+            self.times[pos] = sample.timestamp
+            for column, value in zip(self.columns, sample.values):
+                column[pos] = value
+            self.head = (pos + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    def position(self, age):
+        """
+        Returns the buffer position of the sample at index age, oldest first
+        """
+        return (self.head - self.count + age) % self.capacity
+
+    def find(self, timestamp):
+        """
+        Returns the index (oldest first) of the first sample at or after timestamp
+        """
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            if self.times[self.position(mid)] < timestamp:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def row(self, pos, fields):
+        """
+        Returns the sample at a buffer position as a dict, with NaN values as None
+        """
+        row = {"time": self.times[pos] / 1e9}
+        for field in fields:
+            value = self.columns[field][pos]
+            row[field.name] = None if value != value else value
+        return row
+
+    def last(self, fields):
+        """
+        Returns the most recent sample
+        """
+        with self.lock:
+            if not self.count:
+                return None
+            return self.row(self.position(self.count - 1), fields)
+
+    def range(self, start, end, fields):
+        """
+        Returns every sample from start to end (nanoseconds)
+        """
+        with self.lock:
+            return [self.row(self.position(age), fields)
+                    for age in range(self.find(start), self.find(end + 1))]
+
+    def downsample(self, start, end, step, fields):
+        """
+        Returns the mean of each field over consecutive step nanosecond buckets from start to end.
+        Buckets are aligned to multiples of step and NaN values are ignored
+        """
+        rows = []
+        with self.lock:
+            bucket = None
+            for age in range(self.find(start), self.find(end + 1)):
+                pos = self.position(age)
+                time_ns = self.times[pos]
+                if bucket is None or time_ns - bucket >= step:
+                    if bucket is not None:
+                        rows.append(mean_row(bucket, fields, sums, counts))
+                    bucket = time_ns - time_ns % step
+                    sums = [0.0] * len(fields)
+                    counts = [0] * len(fields)
+                for i, field in enumerate(fields):
+                    value = self.columns[field][pos]
+                    if value == value:
+                        sums[i] += value
+                        counts[i] += 1
+            if bucket is not None:
+                rows.append(mean_row(bucket, fields, sums, counts))
+        return rows
+
+
+def mean_row(bucket, fields, sums, counts):
+    """
+    Returns a downsampled row for a bucket
+    """
+    row = {"time": bucket / 1e9, "samples": max(counts) if counts else 0}
+    for field, total, count in zip(fields, sums, counts):
+        row[field.name] = total / count if count else None
+    return row
+
+
+def write_history(histories, sample):
+    """
+    Adds a sample to the history of its target
+    """
+    histories[sample.target.name].append(sample)
+
+
+class HistoryHandler(http.server.BaseHTTPRequestHandler):
+    """
+    This class is used to answer local HTTP queries against the sample history and /metrics
+        /last?target=<name>&fields=<field,...>
+        /range?target=<name>&start=<time>&end=<time>&fields=<field,...>
+        /downsample?target=<name>&start=<time>&end=<time>&step=<seconds>&fields=<field,...>
+    Times are unix seconds; zero or negative times are relative to now. The default target is
+    the unnamed -i target and fields defaults to every field in the Sample layout
+    """
+
+    def do_GET(self):
+        """
+        Answers a query as JSON
+        """
+        url = urllib.parse.urlsplit(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if url.path == "/metrics":
+            body = METRICS.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        try:
+            history = self.server.histories[query.get("target", "")]
+            fields = [Field[name] for name in query["fields"].split(",")] \
+                if "fields" in query else list(Field)
+            now = time.time()
+            start = query_time(query.get("start", "-3600"), now)
+            end = query_time(query.get("end", "0"), now)
+            if url.path == "/last":
+                result = history.last(fields)
+            elif url.path == "/range":
+                result = history.range(start, end, fields)
+            elif url.path == "/downsample":
+                step = int(float(query.get("step", "60")) * 1e9)
+                if step <= 0:
+                    raise ValueError("step must be positive")
+                result = history.downsample(start, end, step, fields)
+            else:
+                self.reply(404, {"error": "unknown query " + url.path})
+                return
+        except (KeyError, ValueError) as err:
+            self.reply(400, {"error": "invalid query: " + str(err)})
+            return
+        self.reply(200, result)
+
+    def reply(self, code, result):
+        """
+        Sends a JSON response
+        """
+        body = json.dumps(result).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # pylint: disable=redefined-builtin
+        logging.debug("History query: " + format, *args)
+
+
+def query_time(value, now):
+    """
+    Converts a query time in unix seconds, or seconds relative to now if zero or negative,
+    to nanoseconds
+    """
+    seconds = float(value)
+    if seconds <= 0:
+        seconds += now
+    return int(seconds * 1e9)
+
+
+def start_history_server(histories, host=HISTORY_HOST, port=HISTORY_PORT):
+    """
+    Serves history queries on a background thread
+    """
+    server = http.server.ThreadingHTTPServer((host, port), HistoryHandler)
+    server.daemon_threads = True
+    server.histories = histories
+    threading.Thread(target=server.serve_forever, name="history", daemon=True).start()
+    logging.info("Serving sample history on %s:%s", host, port)
+    return server
+
+
+class SampleArchive():
+    """
+    This class is used to write the samples of each target to columnar Parquet files. Samples are
+    buffered in one array('d') per field and written as a compressed row group every ARCHIVE_ROWS
+    samples; each target's file is closed when its period ends so readers can memory map it
+    """
+
+    def __init__(self, archive_dir, period=None, rows=None, compression=None):
+
+        period = ARCHIVE_PERIOD if period is None else period
+        self.archive_dir = archive_dir
+        self.length = (3600 if period == 'hour' else 86400) * 10**9
+        self.rows = ARCHIVE_ROWS if rows is None else rows
+        self.compression = ARCHIVE_COMPRESSION if compression is None else compression
+        self.schema = pyarrow.schema(
+            [pyarrow.field("time", pyarrow.timestamp("ns", tz="UTC"), nullable=False)] +
+            [pyarrow.field(field.name, pyarrow.float64()) for field in Field],
+            metadata={"getsolar": VERSION})
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def add(self, sample):
+        """
+        Buffers a sample, writing a row group or starting the next file as needed
+        """
+        with self.lock:
+            self.append(sample)
+
+    def append(self, sample):
+        """
+        Buffers a sample under the lock
+        """
+        name = sample.target.name or "solaredge"
+        start = sample.timestamp - sample.timestamp % self.length
+        current = self.files.get(name)
+        if current is not None and current["start"] != start:
+            self.close_file(name)
+            current = None
+        if current is None:
+            current = self.files[name] = {
+                "start": start, "writer": None,
+                "times": array.array('q'), "columns": [array.array('d') for field in Field]}
+        current["times"].append(sample.timestamp)
+        for column, value in zip(current["columns"], sample.values):
+            column.append(value)
+        if len(current["times"]) >= self.rows:
+            self.write(name)
+
+    def path(self, name, start):
+        """
+        Returns the partitioned file for a target and period
+        """
+        seconds = start // 10**9
+        return os.path.join(self.archive_dir, "device=" + name,
+                            time.strftime("date=%Y-%m-%d", time.gmtime(seconds)),
+                            time.strftime("%H%M%S", time.gmtime(seconds)) + ".parquet")
+
+    def write(self, name):
+        """
+        Writes the buffered samples of a target as one row group
+        """
+        current = self.files[name]
+        count = len(current["times"])
+        if not count:
+            return
+        if current["writer"] is None:
+            path = self.path(name, current["start"])
+            if os.path.exists(path):
+                # A restart part way through the period - keep the earlier file
+                path = path[:-len(".parquet")] + "-%s.parquet" % (current["times"][0] // 10**9)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            current["writer"] = pyarrow.parquet.ParquetWriter(
+                path, self.schema, compression=self.compression)
+        # The arrays share their buffers with Arrow rather than being copied value by value
+        arrays = [pyarrow.Array.from_buffers(self.schema.field(0).type, count,
+                                             [None, pyarrow.py_buffer(current["times"])])]
+        arrays += [pyarrow.Array.from_buffers(pyarrow.float64(), count,
+                                              [None, pyarrow.py_buffer(column)])
+                   for column in current["columns"]]
+        current["writer"].write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+        current["times"] = array.array('q')
+        current["columns"] = [array.array('d') for field in Field]
+
+    def close_file(self, name):
+        """
+        Writes what is buffered for a target and closes its file
+        """
+        self.write(name)
+        writer = self.files.pop(name)["writer"]
+        if writer is not None:
+            writer.close()
+
+    def close(self):
+        """
+        Closes every open file
+        """
+        with self.lock:
+            for name in list(self.files):
+                try:
+                    self.close_file(name)
+                except OSError as err:
+                    logging.warning("Unable to close archive of %s - %s", name, err)
+
+
+def write_archive(archive, sample):
+    """
+    Adds a sample to the columnar archive
+    """
+    if not DEBUG:
+        archive.add(sample)
+
+
+class MQTTPublisher():
+    """
+    This class is used to manage delivery of state payloads to the broker. Each payload is sent
+    with the QoS for its topic while the client is connected; otherwise only the latest payload of
+    each topic is kept, so memory stays bounded however long the broker is away. paho reconnects
+    with the Modbus backoff settings and the latest state of every topic is republished as soon
+    as the connection is back
+    """
+    # pylint: disable=too-many-instance-attributes
+    # the delivery state is reasonable in this case
+
+    def __init__(self, client, qos=None, default_qos=None, max_topics=None):
+
+        self.client = client
+        self.qos = MQTT_QOS if qos is None else qos
+        self.default_qos = MQTT_QOS_DEFAULT if default_qos is None else default_qos
+        self.max_topics = MQTT_MAX_TOPICS if max_topics is None else max_topics
+        self.levels = {}
+        self.latest = collections.OrderedDict()
+        self.waiting = set()
+        self.lock = threading.Lock()
+        self.connected = False
+        self.disconnected = None
+        self.callbacks = (client.on_connect, client.on_disconnect)
+        client.on_connect = self.on_connect
+        client.on_disconnect = self.on_disconnect
+        client.max_queued_messages_set(MQTT_MAX_QUEUED)
+        client.reconnect_delay_set(WAIT_TIME, RECONNECT_MAX_TIME)
+
+    def level(self, topic):
+        """
+        Returns the QoS for a topic
+        """
+        qos = self.levels.get(topic)
+        if qos is None:
+            qos = next((level for pattern, level in self.qos.items()
+                        if mqtt.topic_matches_sub(pattern, topic)), self.default_qos)
+            self.levels[topic] = qos
+        return qos
+
+    def publish(self, topic, payload):
+        """
+        Publishes a payload, or keeps it as the latest for its topic until the broker is back.
+        Returns False if it was kept
+        """
+        with self.lock:
+            self.latest[topic] = payload
+            self.latest.move_to_end(topic)
+            if len(self.latest) > self.max_topics:
+                dropped = self.latest.popitem(last=False)[0]
+                self.waiting.discard(dropped)
+                METRICS.inc("getsolar_mqtt_messages_total", result="dropped")
+            # paho 1.x still reports is_connected() after the broker drops, so track it here
+            if self.connected and \
+                    self.client.publish(topic, payload, self.level(topic)).rc == mqtt.MQTT_ERR_SUCCESS:
+                self.waiting.discard(topic)
+                return True
+            METRICS.inc("getsolar_mqtt_messages_total",
+                        result="coalesced" if topic in self.waiting else "buffered")
+            self.waiting.add(topic)
+            return False
+
+    def on_connect(self, client, userdata, flags, rc):
+        """
+        Republishes the latest state of every topic once connected
+        """
+        if self.callbacks[0]:
+            self.callbacks[0](client, userdata, flags, rc)
+        if rc != 0:
+            logging.warning("MQTT connection refused - %s", mqtt.connack_string(rc))
+            return
+        METRICS.set("getsolar_mqtt_connected", 1)
+        with self.lock:
+            self.connected = True
+            latest = list(self.latest.items())
+            waiting = len(self.waiting)
+            self.waiting = set()
+        for topic, payload in latest:
+            if client.publish(topic, payload, self.level(topic)).rc != mqtt.MQTT_ERR_SUCCESS:
+                with self.lock:
+                    self.waiting.add(topic)
+        METRICS.inc("getsolar_mqtt_messages_total", len(latest), result="republished")
+        if self.disconnected is not None:
+            logging.info("MQTT reconnected after %.0fs - republished %s topics, %s held back",
+                         time.monotonic() - self.disconnected, len(latest), waiting)
+        self.disconnected = None
+
+    def on_disconnect(self, client, userdata, rc):
+        """
+        Notes when the connection was lost; paho reconnects by itself
+        """
+        if self.callbacks[1]:
+            self.callbacks[1](client, userdata, rc)
+        METRICS.set("getsolar_mqtt_connected", 0)
+        with self.lock:
+            self.connected = False
+        if self.disconnected is None:
+            self.disconnected = time.monotonic()
+
+
+class DeadbandPublisher():
+    """
+    This class is used to publish MQTT state payloads only when they change meaningfully.
+    A payload is sent when any field moves outside its deadband (DEADBANDS, DEADBAND_DEFAULT)
+    from the last published payload on that topic, or when DEADBAND_MAX_SILENCE seconds
+    have passed since it was sent
+    """
+
+    def __init__(self, client, deadbands=None, default=None, silence=None):
+
+        self.client = client
+        self.deadbands = DEADBANDS if deadbands is None else deadbands
+        self.default = DEADBAND_DEFAULT if default is None else default
+        self.silence = DEADBAND_MAX_SILENCE if silence is None else silence
+        self.last = {}
+        self.sent = {}
+        self.published = 0
+        self.suppressed = 0
+
+    def changed(self, last, data):
+        """
+        Returns True if any field has moved outside its deadband
+        """
+        if last.keys() != data.keys():
+            return True
+        for field, value in data.items():
+            previous = last[field]
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or \
+                    isinstance(previous, bool) or not isinstance(previous, (int, float)):
+                if value != previous:
+                    return True
+                continue
+            mode, band = self.deadbands.get(field, self.default)
+            if mode == 'rel':
+                band = band * abs(previous)
+            if abs(value - previous) > band:
+                return True
+        return False
+
+    def publish(self, topic, data):
+        """
+        Publishes a state payload as JSON unless it is within the deadbands of the last one
+        """
+        now = time.monotonic()
+        last = self.last.get(topic)
+        if last is not None and now - self.sent[topic] < self.silence and \
+                not self.changed(last, data):
+            self.suppressed += 1
+            METRICS.inc("getsolar_mqtt_messages_total", result="suppressed")
+            return False
+        self.client.publish(topic, json.dumps(data))
+        self.last[topic] = data
+        self.sent[topic] = now
+        self.published += 1
+        METRICS.inc("getsolar_mqtt_messages_total", result="published")
+        return True
+
+
+class SinkWorker():
+    """
+    This class is used to drain samples from a bounded queue into a single sink on its own thread,
+    so that a slow sink never delays the Modbus poll.
+    When the queue is full the policy decides what happens to a new sample:
+        'drop-oldest' - discard the oldest queued sample
+        'drop-newest' - discard the new sample
+        'block'       - wait up to SINK_BLOCK_TIME seconds for space, then discard the new sample
+    """
+    # pylint: disable=broad-except
+    # a failing sink must not stop the worker thread
+
+    def __init__(self, name, write, target, depth=None, policy=None):
+
+        self.name = name
+        self.write = write
+        self.target = target
+        self.policy = SINK_POLICY if policy is None else policy
+        self.depth = SINK_QUEUE_DEPTH if depth is None else depth
+        self.queue = queue.Queue(maxsize=self.depth)
+        self.lock = threading.Lock()
+        self.stats = {
+            "queued": 0,
+            "written": 0,
+            "dropped": 0,
+            "failed": 0,
+            "max_depth": 0
+        }
+        self.start()
+
+    def start(self):
+        """
+        Starts the worker thread
+        """
+        self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def count(self, stat, value=1):
+        """
+        Updates a backpressure counter
+        """
+        with self.lock:
+            self.stats[stat] += value
+        METRICS.inc("getsolar_sink_samples_total", value, sink=self.name, result=stat)
+
+    def put(self, sample):
+        """
+        Queues a sample for this sink, applying the queue full policy
+        """
+        try:
+            if self.policy == 'block':
+                self.queue.put(sample, timeout=SINK_BLOCK_TIME)
+            else:
+                self.queue.put_nowait(sample)
+        except queue.Full:
+            if self.policy == 'drop-oldest':
+                try:
+                    self.queue.get_nowait()
+                    self.queue.task_done()
+                except queue.Empty:
+                    pass
+                self.queue.put_nowait(sample)
+            logging.debug("Sink %s queue full - dropping sample", self.name)
+            self.count("dropped")
+        self.count("queued")
+        with self.lock:
+            self.stats["max_depth"] = max(self.stats["max_depth"], self.queue.qsize())
+        METRICS.set("getsolar_sink_queue_depth", self.queue.qsize(), sink=self.name)
+
+    def run(self):
+        """
+        Writes queued samples to the sink until the process exits
+        """
+        while True:
+            sample = self.queue.get()
+            try:
+                self.write(self.target, sample)
+            except Exception:
+                logging.warning("Sink %s write failed", self.name, exc_info=True)
+                self.count("failed")
+            else:
+                self.count("written")
+            self.queue.task_done()
+
+    def report(self):
+        """
+        Logs and resets the backpressure counters
+        """
+        with self.lock:
+            stats = dict(self.stats)
+            for stat in self.stats:
+                self.stats[stat] = 0
+        logging.info("Sink %s - queued %s, written %s, dropped %s, failed %s, depth %s, max depth %s",
+                     self.name, stats["queued"], stats["written"], stats["dropped"],
+                     stats["failed"], self.queue.qsize(), stats["max_depth"])
+
+
+class InfluxWriter():
+    """
+    This class is used to write line protocol to one database and retention policy
+    through a shared InfluxDB client
+    """
+
+    def __init__(self, client, database, retention_policy):
+
+        self.client = client
+        self.database = database
+        self.retention_policy = retention_policy
+
+    def write_points(self, lines, time_precision=None):
+        """
+        Writes a list of line protocol strings, counting them once InfluxDB has accepted them
+        """
+        result = self.client.write_points(lines, time_precision=time_precision,
+                                          database=self.database,
+                                          retention_policy=self.retention_policy,
+                                          protocol='line')
+        METRICS.inc("getsolar_influx_points_total", len(lines), database=self.database)
+        return result
+
+
+class InfluxBatcher():
+    """
+    This class is used to batch InfluxDB writes. It accepts the same write_points calls as the
+    client, encodes the points to line protocol and collects them per database, retention policy
+    and precision. A background thread flushes each batch through one pooled client once
+    INFLUX_BATCH_SIZE points are waiting or INFLUX_FLUSH_TIME seconds after its first point.
+    With a spool directory each batch passes through an InfluxSpool
+    """
+    # pylint: disable=broad-except
+    # a failed flush is logged and counted, the spool (if any) keeps the points
+
+    def __init__(self, client, database, spool_dir="", size=None, interval=None):
+
+        self.client = client
+        self.database = database
+        self.spool_dir = spool_dir
+        self.size = INFLUX_BATCH_SIZE if size is None else size
+        self.interval = INFLUX_FLUSH_TIME if interval is None else interval
+        self.failed = 0
+        self.buffers = {}
+        self.started = {}
+        self.writers = {}
+        self.condition = threading.Condition()
+        self.start()
+
+    def start(self):
+        """
+        Starts the flush thread
+        """
+        self.thread = threading.Thread(target=self.run, name="influx-batch", daemon=True)
+        self.thread.start()
+
+    def write_points(self, points, time_precision=None, database=None, retention_policy=None):
+        """
+        Adds points to the batch for their database, retention policy and precision
+        """
+        return self.write_lines(make_lines({'points': points}, time_precision).splitlines(),
+                                time_precision, database, retention_policy)
+
+    def write_lines(self, lines, time_precision=None, database=None, retention_policy=None):
+        """
+        Adds encoded line protocol strings to the batch for their database, retention policy and
+        precision
+        """
+        key = (database or self.database, retention_policy, time_precision)
+        with self.condition:
+            if key not in self.buffers:
+                self.buffers[key] = []
+                self.started[key] = time.monotonic()
+            self.buffers[key].extend(lines)
+            if len(self.buffers[key]) >= self.size:
+                self.condition.notify()
+        return True
+
+    def take(self, everything=False):
+        """
+        Removes and returns the batches that are full or have waited INFLUX_FLUSH_TIME seconds
+        """
+        now = time.monotonic()
+        due = [key for key, lines in self.buffers.items()
+               if everything or len(lines) >= self.size or now - self.started[key] >= self.interval]
+        return [(key, self.buffers.pop(key), self.started.pop(key)) for key in due]
+
+    def run(self):
+        """
+        Flushes batches as they become due
+        """
+        while True:
+            with self.condition:
+                if self.started:
+                    timeout = max(0.0, min(self.started.values()) + self.interval - time.monotonic())
+                else:
+                    timeout = self.interval
+                self.condition.wait(timeout)
+                due = self.take()
+            for key, lines, started in due:
+                self.flush(key, lines)
+
+    def close(self):
+        """
+        Flushes every waiting batch
+        """
+        with self.condition:
+            due = self.take(everything=True)
+        for key, lines, started in due:
+            self.flush(key, lines)
+
+    def flush(self, key, lines):
+        """
+        Writes a batch of lines with the writer for its database and retention policy.
+        Returns False if the lines were not written: lines left in the spool are counted as
+        spooled, lines lost to a failed write are added to the failed count
+        """
+        database, retention_policy, precision = key
+        if (database, retention_policy) not in self.writers:
+            writer = InfluxWriter(self.client, database, retention_policy)
+            if self.spool_dir:
+                name = database + ("-" + retention_policy if retention_policy else "")
+                writer = InfluxSpool(writer, name, self.spool_dir)
+            self.writers[(database, retention_policy)] = writer
+        logging.debug("Flushing %s points to %s", len(lines), database)
+        started = time.monotonic()
+        try:
+            written = self.writers[(database, retention_policy)].write_points(
+                lines, time_precision=precision)
+        except Exception:
+            logging.warning("InfluxDB write of %s points failed", len(lines), exc_info=True)
+            METRICS.inc("getsolar_influx_write_failures_total", database=database)
+            with self.condition:
+                self.failed += len(lines)
+            return False
+        finally:
+            METRICS.observe("getsolar_influx_write_seconds", time.monotonic() - started,
+                            database=database)
+        if written is False:
+            METRICS.inc("getsolar_influx_write_failures_total", database=database)
+            METRICS.inc("getsolar_influx_points_spooled_total", len(lines), database=database)
+            return False
+        return True
+
+
+class InfluxSpool():
+    """
+    This class is used to make InfluxDB writes durable. It stands in for the client's write_points:
+    points are appended to a spool file before each write and the file is truncated once InfluxDB
+    acknowledges them. While InfluxDB is unavailable points accumulate in the spool (bounded by
+    SPOOL_MAX_BYTES and SPOOL_MAX_AGE) and are replayed in SPOOL_BATCH sized writes when it returns
+    """
+    # pylint: disable=broad-except
+    # any failure to write to InfluxDB leaves the points in the spool
+
+    def __init__(self, client, name, spool_dir=SPOOL_DIR):
+
+        self.client = client
+        self.path = os.path.join(spool_dir, name + ".spool")
+        self.pending = 0
+        self.retry_at = 0.0
+        os.makedirs(spool_dir, exist_ok=True)
+        if os.path.exists(self.path):
+            with open(self.path) as _f:
+                self.pending = sum(1 for line in _f)
+            if self.pending:
+                logging.info("Spool %s holds %s unsent points", self.path, self.pending)
+
+    def write_points(self, points, time_precision=None):
+        """
+        Spools the points and writes them, together with any backlog, to InfluxDB.
+        Returns False if the points were left in the spool
+        """
+        self.append(points, time_precision)
+        if time.monotonic() < self.retry_at:
+            return False
+        if self.pending == len(points):
+            # No backlog - write the new points directly
+            records = [[time.time(), time_precision, point] for point in points]
+        else:
+            records = self.load()
+        if not self.replay(records):
+            return False
+        if len(records) > len(points):
+            logging.info("Spool %s - replayed %s spooled points",
+                         self.path, len(records) - len(points))
+        return True
+
+    def append(self, points, precision):
+        """
+        Appends points to the spool file
+        """
+        now = time.time()
+        with open(self.path, 'a') as _f:
+            for point in points:
+                _f.write(json.dumps([now, precision, point]) + "\n")
+            _f.flush()
+            if SPOOL_FSYNC:
+                os.fsync(_f.fileno())
+        self.pending += len(points)
+        if os.path.getsize(self.path) > SPOOL_MAX_BYTES:
+            self.trim()
+
+    def load(self):
+        """
+        Reads the spooled records, discarding any older than SPOOL_MAX_AGE
+        """
+        records = []
+        cutoff = time.time() - SPOOL_MAX_AGE
+        with open(self.path) as _f:
+            for line in _f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Partial line left by a crash part way through an append
+                    continue
+                if record[0] >= cutoff:
+                    records.append(record)
+        if len(records) < self.pending:
+            logging.warning("Spool %s - discarded %s expired or damaged points",
+                            self.path, self.pending - len(records))
+        return records
+
+    def save(self, records):
+        """
+        Replaces the spool file with the given records
+        """
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as _f:
+            for record in records:
+                _f.write(json.dumps(record) + "\n")
+        os.replace(tmp_path, self.path)
+        self.pending = len(records)
+
+    def trim(self):
+        """
+        Drops the oldest quarter of the spool once it exceeds SPOOL_MAX_BYTES
+        """
+        records = self.load()
+        drop = max(1, len(records) // 4)
+        logging.warning("Spool %s exceeds %s bytes - dropping %s oldest points",
+                        self.path, SPOOL_MAX_BYTES, drop)
+        self.save(records[drop:])
+
+    def replay(self, records):
+        """
+        Writes records to InfluxDB in batches, keeping any that were not acknowledged in the spool
+        """
+        sent = 0
+        while sent < len(records):
+            precision = records[sent][1]
+            batch = []
+            for record in records[sent:sent + SPOOL_BATCH]:
+                if record[1] != precision:
+                    break
+                batch.append(record[2])
+            try:
+                self.client.write_points(batch, time_precision=precision)
+            except InfluxDBClientError as err:
+                if err.code != 400:
+                    return self.defer(records[sent:])
+                # InfluxDB will never accept these points - discard rather than block the spool
+                logging.warning("Spool %s - InfluxDB rejected %s points: %s",
+                                self.path, len(batch), err)
+            except Exception:
+                return self.defer(records[sent:])
+            sent += len(batch)
+        self.retry_at = 0.0
+        open(self.path, 'w').close()
+        self.pending = 0
+        return True
+
+    def defer(self, records):
+        """
+        Keeps unsent records in the spool and waits SPOOL_RETRY_TIME seconds before the next attempt
+        """
+        if not self.retry_at:
+            logging.warning("InfluxDB unavailable - spooling points to %s", self.path)
+        self.retry_at = time.monotonic() + SPOOL_RETRY_TIME
+        if len(records) != self.pending:
+            self.save(records)
+        return False
+
+
+class AsyncSinkWorker(SinkWorker):
+    """
+    This class is used to drain samples into a single sink as a task on the asyncio event loop.
+    Writes run in an executor, one at a time and in order, so file and network IO in a sink never
+    stalls the loop. The 'block' policy cannot wait on the event loop and behaves as 'drop-newest'
+    """
+    # pylint: disable=broad-except
+    # a failing sink must not stop the worker task
+
+    def __init__(self, name, write, target, depth=None, policy=None):
+
+        super().__init__(name, write, target, depth, policy)
+        self.queue = asyncio.Queue(maxsize=self.depth)
+
+    def start(self):
+        """
+        The worker runs as a task started by run_async
+        """
+
+    def put(self, sample):
+        """
+        Queues a sample for this sink, applying the queue full policy
+        """
+        try:
+            self.queue.put_nowait(sample)
+        except asyncio.QueueFull:
+            if self.policy == 'drop-oldest':
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self.queue.put_nowait(sample)
+            logging.debug("Sink %s queue full - dropping sample", self.name)
+            self.count("dropped")
+        self.count("queued")
+        with self.lock:
+            self.stats["max_depth"] = max(self.stats["max_depth"], self.queue.qsize())
+        METRICS.set("getsolar_sink_queue_depth", self.queue.qsize(), sink=self.name)
+
+    async def run(self, executor=None):
+        """
+        Writes queued samples to the sink in the executor until cancelled
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            sample = await self.queue.get()
+            try:
+                await loop.run_in_executor(executor, self.write, self.target, sample)
+            except Exception:
+                logging.warning("Sink %s write failed", self.name, exc_info=True)
+                self.count("failed")
+            else:
+                self.count("written")
+            self.queue.task_done()
+
+
+class AsyncInfluxBatcher(InfluxBatcher):
+    """
+    This class is used to batch InfluxDB writes on the asyncio event loop. Points are collected as
+    by InfluxBatcher and each due batch is posted to the InfluxDB /write endpoint with aiohttp.
+    A batch that cannot be written is kept for the next flush, up to SPOOL_BATCH lines per
+    database, retention policy and precision; a batch InfluxDB rejects with a 4xx status is dropped.
+    The spool is not used
+    """
+
+    def __init__(self, url, username, password, database, size=None, interval=None):
+
+        self.url = url
+        self.auth = aiohttp.BasicAuth(username, password or "")
+        self.due = None
+        self.loop = None
+        super().__init__(None, database, "", size, interval)
+
+    def start(self):
+        """
+        Batches are flushed by run on the event loop
+        """
+
+    def write_lines(self, lines, time_precision=None, database=None, retention_policy=None):
+        """
+        Adds lines to their batch and wakes the flush task once a batch is full. Sinks call this
+        from the sink executor
+        """
+        super().write_lines(lines, time_precision, database, retention_policy)
+        with self.condition:
+            full = any(len(lines) >= self.size for lines in self.buffers.values())
+        if full and self.due is not None:
+            self.loop.call_soon_threadsafe(self.due.set)
+        return True
+
+    async def run(self):
+        """
+        Posts batches as they become due and the remaining batches when cancelled
+        """
+        self.loop = asyncio.get_running_loop()
+        self.due = asyncio.Event()
+        async with aiohttp.ClientSession(auth=self.auth) as session:
+            try:
+                while True:
+                    with self.condition:
+                        if self.started:
+                            timeout = max(0.0, min(self.started.values()) + self.interval -
+                                          time.monotonic())
+                        else:
+                            timeout = self.interval
+                    try:
+                        await asyncio.wait_for(self.due.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    self.due.clear()
+                    with self.condition:
+                        due = self.take()
+                    for key, lines, started in due:
+                        await self.post(session, key, lines)
+            finally:
+                with self.condition:
+                    due = self.take(everything=True)
+                for key, lines, started in due:
+                    await self.post(session, key, lines)
+
+    async def post(self, session, key, lines):
+        """
+        Writes a batch of lines, keeping it for the next flush if the write fails
+        """
+        database, retention_policy, precision = key
+        params = {"db": database}
+        if retention_policy:
+            params["rp"] = retention_policy
+        if precision:
+            params["precision"] = precision
+        logging.debug("Flushing %s points to %s", len(lines), database)
+        started = time.monotonic()
+        try:
+            async with session.post(self.url, params=params,
+                                    data="\n".join(lines).encode("utf-8")) as response:
+                response.raise_for_status()
+        except aiohttp.ClientResponseError as err:
+            if not 400 <= err.status < 500:
+                self.requeue(key, lines, database)
+            else:
+                # InfluxDB will never accept these points - drop them rather than retry forever
+                logging.warning("InfluxDB rejected %s points: %s %s", len(lines), err.status,
+                                err.message)
+                METRICS.inc("getsolar_influx_points_rejected_total", len(lines),
+                            database=database)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.requeue(key, lines, database)
+        else:
+            METRICS.inc("getsolar_influx_points_total", len(lines), database=database)
+        METRICS.observe("getsolar_influx_write_seconds", time.monotonic() - started,
+                        database=database)
+
+    def requeue(self, key, lines, database):
+        """
+        Keeps a failed batch for the next flush, ahead of any lines buffered since
+        """
+        logging.warning("InfluxDB write of %s points failed", len(lines), exc_info=True)
+        METRICS.inc("getsolar_influx_write_failures_total", database=database)
+        with self.condition:
+            self.buffers[key] = (lines + self.buffers.get(key, []))[-SPOOL_BATCH:]
+            self.started.setdefault(key, time.monotonic())
+
+    def close(self):
+        """
+        Batches are flushed when run is cancelled
+        """
+
+
+class HealthServer():
+    """
+    This class is used to answer health checks on the asyncio event loop. Any request returns the
+    Modbus session states, sink queue depths and the age of the last sample as JSON, with status
+    200 when every session is connected and 503 otherwise
+    """
+
+    def __init__(self, sessions, sinks):
+
+        self.sessions = sessions
+        self.sinks = sinks
+        self.last_sample = None
+
+    def status(self):
+        """
+        Returns the health status code and report
+        """
+        healthy = all(session.state == "connected" for session in self.sessions)
+        report = {
+            "healthy": healthy,
+            "sessions": [{"host": session.host, "port": session.port, "state": session.state,
+                          "failures": session.failures} for session in self.sessions],
+            "sinks": {sink.name: sink.queue.qsize() for sink in self.sinks},
+            "last_sample_age": None if self.last_sample is None else
+            round(time.monotonic() - self.last_sample, 3)
+        }
+        return (200 if healthy else 503), report
+
+    async def handle(self, reader, writer):
+        """
+        Reads one HTTP request and writes the health report
+        """
+        try:
+            await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), HEALTH_TIMEOUT)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+            writer.close()
+            return
+        code, report = self.status()
+        body = json.dumps(report).encode("utf-8")
+        writer.write(b"HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n"
+                     b"Content-Length: %d\r\nConnection: close\r\n\r\n" %
+                     (code, b"OK" if code == 200 else b"Service Unavailable", len(body)) + body)
+        await writer.drain()
+        writer.close()
+
+
+async def run_async(sessions, pipeline, influx, mqtt_ha, discovery_cache, scheduler,
+                    executor, config, health_port=HEALTH_PORT):
+    """
+    Runs the poll timer, sink workers, Influx writer and health endpoint on one event loop.
+    solaredge_modbus is synchronous, so each session's reads run in the executor; sink writes and
+    HA discovery run in pools of their own
+    """
+    # pylint: disable=too-many-arguments
+    # the event loop takes over everything main() built
+
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    loop.add_signal_handler(signal.SIGHUP, config.requested.set)
+    sink_executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=len(pipeline.sinks), thread_name_prefix="sink")
+    discovery = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="discovery")
+    sinks = [asyncio.create_task(sink.run(sink_executor), name=sink.name)
+             for sink in pipeline.sinks]
+    writer = asyncio.create_task(influx.run(), name="influx-batch")
+    health = HealthServer(sessions, pipeline.sinks)
+    server = None
+    if health_port:
+        server = await asyncio.start_server(health.handle, HEALTH_HOST, health_port)
+        logging.info("Serving health checks on %s:%s", HEALTH_HOST, health_port)
+    try:
+        while True:
+            if config.requested.is_set():
+                apply_settings(config.reload(), scheduler, sessions, pipeline.sinks, influx)
+            deadline, delay = scheduler.next()
+            await asyncio.sleep(delay)
+            logging.debug("Reading data - deadline %s", deadline)
+            started = time.monotonic()
+            results = await asyncio.gather(
+                *(loop.run_in_executor(executor, session.poll) for session in sessions))
+            METRICS.observe("getsolar_poll_seconds", time.monotonic() - started)
+            for polled in results:
+                for inv_data in polled:
+                    if mqtt_ha.connected_flag:
+                        inv_data.queue_discovery(discovery, mqtt_ha, discovery_cache)
+                    pipeline.publish(inv_data.sample())
+                    health.last_sample = time.monotonic()
+    except asyncio.CancelledError:
+        pass
+    finally:
+        if server is not None:
+            server.close()
+        for task in sinks:
+            task.cancel()
+        await asyncio.gather(*sinks, return_exceptions=True)
+        sink_executor.shutdown(wait=True)
+        discovery.shutdown(wait=False)
+        pipeline.close()
+        writer.cancel()
+        await asyncio.gather(writer, return_exceptions=True)
+
+
+class Pipeline():
+    """
+    This class is used to fan each sample out to the sink workers
+    """
+
+    def __init__(self, sinks, metrics_client=None):
+
+        self.sinks = sinks
+        self.metrics_client = metrics_client
+        self.reported = time.monotonic()
+        self.metrics_written = time.monotonic()
+
+    def close(self):
+        """
+        Writes the state the sinks still hold: the open rollup windows
+        """
+        for sink in self.sinks:
+            if isinstance(sink.target, Rollups):
+                sink.target.flush()
+
+    def publish(self, sample):
+        """
+        Queues a sample on every sink and periodically reports sink backpressure
+        """
+        for sink in self.sinks:
+            sink.put(sample)
+        if time.monotonic() - self.reported > SINK_REPORT_TIME:
+            self.reported = time.monotonic()
+            for sink in self.sinks:
+                sink.report()
+        if self.metrics_client and time.monotonic() - self.metrics_written > METRICS_WRITE_TIME:
+            self.metrics_written = time.monotonic()
+            self.metrics_client.write_points(METRICS.points(time.time_ns()),
+                                             time_precision=TIME_PRECISION,
+                                             database=METRICS_DB, retention_policy=METRICS_RP)
+
+
+class Scheduler():
+    """
+    This class is used to pace the poll loop on the monotonic clock.
+    Deadlines fall on multiples of the interval on the wall clock (a 10 s interval polls at :00, :10,
+    ...) and the time spent reading is never added to the cadence. Fractional intervals are allowed.
+    When the loop overruns one or more deadlines the policy decides what happens:
+        'skip'     - drop the missed deadlines and wait for the next slot on the grid
+        'catch-up' - poll back to back until the loop is on time again (at most SCHEDULE_MAX_CATCHUP,
+                     beyond which it skips)
+    """
+
+    def __init__(self, interval=SLEEP_TIME, policy=SCHEDULE_POLICY):
+
+        self.interval = interval
+        self.policy = policy
+        self.deadline = time.monotonic() + interval - (time.time() % interval)
+        self.missed = 0
+        self.overruns = 0
+
+    def wait(self):
+        """
+        Sleeps until the next deadline and returns it
+        """
+        deadline, delay = self.next()
+        if delay:
+            time.sleep(delay)
+        return deadline
+
+    def next(self):
+        """
+        Advances to the next deadline and returns it with the seconds left until it
+        """
+        now = time.monotonic()
+        if now >= self.deadline:
+            missed = int((now - self.deadline) // self.interval)
+            if missed:
+                if self.policy == 'skip' or missed > SCHEDULE_MAX_CATCHUP:
+                    # the slot the loop is in has started too, the next poll is on the one after
+                    missed += 1
+                    self.deadline += missed * self.interval
+                self.overruns += 1
+                self.missed += missed
+                METRICS.inc("getsolar_poll_overruns_total")
+                METRICS.inc("getsolar_poll_missed_total", missed)
+                logging.debug("Poll loop overran %s deadlines", missed)
+        deadline = self.deadline
+        self.deadline += self.interval
+        return deadline, max(0.0, deadline - now)
+
+
+class ModbusSession():
+    """
+    This class is used to poll one or more inverter units that share a single Modbus TCP session.
+    Units behind a leader inverter are read one after another over the leader's connection.
+    The session is kept open between polls. A unit that fails a read only fails that poll of the
+    unit. After a failed connect, or a poll in which no unit answered, the session is closed and
+    reconnected with exponential backoff from WAIT_TIME to RECONNECT_MAX_TIME seconds (with
+    RECONNECT_JITTER), skipping polls while it waits, so transient faults never end the process
+    """
+    # pylint: disable=too-many-instance-attributes
+    # the connection state and health counters belong together
+
+    def __init__(self, host, port, timeout, targets):
+
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.targets = targets
+        self.state = "connecting"
+        self.failures = 0
+        self.retry_at = 0.0
+        self.devices = {}
+        self.stats = {
+            "reads": 0,
+            "failed": 0,
+            "timeouts": 0,
+            "reconnects": 0,
+            "latency": 0.0,
+            "max_latency": 0.0
+        }
+        self.reported = time.monotonic()
+        self.label = "%s:%s" % (host, port)
+        self.build()
+
+    def build(self):
+        """
+        Creates the leader inverter and the inverters chained to its session
+        """
+        self.devices = {}
+        leader = None
+        for unit, inv_data in self.targets:
+            logging.debug("Connect to device. Host %s Port %s Timeout %s Unit %s",
+                          self.host, self.port, self.timeout, unit)
+            if leader is None:
+                leader = solaredge_modbus.Inverter(
+                    host=self.host, port=self.port, timeout=self.timeout, unit=unit)
+                self.devices[unit] = leader
+            else:
+                self.devices[unit] = solaredge_modbus.Inverter(
+                    parent=leader, unit=unit)
+            # Cached meters hold a reference to the old Modbus client
+            inv_data.topology.invalidate()
+
+    def leader(self):
+        """
+        Returns the inverter that owns the Modbus connection
+        """
+        return self.devices[self.targets[0][0]]
+
+    def connect(self):
+        """
+        Returns True once the session is open, connecting if the backoff delay has passed
+        """
+        if self.state == "connected":
+            return True
+        if time.monotonic() < self.retry_at:
+            return False
+        logging.debug("Connect to device. Host %s Port %s", self.host, self.port)
+        if not self.leader().connect():
+            self.backoff("connect failed")
+            return False
+        if self.state == "disconnected":
+            logging.info("Reconnected to %s:%s after %s attempts",
+                         self.host, self.port, self.failures)
+            self.stats["reconnects"] += 1
+            METRICS.inc("getsolar_modbus_reconnects_total", session=self.label)
+        METRICS.set("getsolar_modbus_connected", 1, session=self.label)
+        self.state = "connected"
+        self.failures = 0
+        return True
+
+    def backoff(self, reason):
+        """
+        Closes the session and schedules the next connect attempt
+        """
+        self.leader().disconnect()
+        self.failures += 1
+        delay = min(RECONNECT_MAX_TIME, WAIT_TIME * 2 ** min(self.failures - 1, 16))
+        delay *= 1 + random.uniform(-RECONNECT_JITTER, RECONNECT_JITTER)
+        self.retry_at = time.monotonic() + delay
+        if self.state == "connected":
+            logging.warning("Modbus session to %s:%s lost (%s)", self.host, self.port, reason)
+        logging.info("Modbus %s:%s %s - retrying in %.1fs", self.host, self.port, reason, delay)
+        METRICS.set("getsolar_modbus_connected", 0, session=self.label)
+        self.state = "disconnected"
+
+    def poll(self):
+        """
+        Reads every unit on this session.
+        Returns the list of InverterData objects that were updated
+        """
+        polled = []
+        if self.connect():
+            for unit, inv_data in self.targets:
+                started = time.monotonic()
+                updated = inv_data.update(self.devices[unit])
+                latency = time.monotonic() - started
+                self.stats["reads"] += 1
+                self.stats["latency"] += latency
+                self.stats["max_latency"] = max(self.stats["max_latency"], latency)
+                METRICS.inc("getsolar_modbus_reads_total", session=self.label, unit=unit)
+                METRICS.observe("getsolar_modbus_read_seconds", latency,
+                                session=self.label, unit=unit)
+                if updated:
+                    polled.append(inv_data)
+                    continue
+                logging.warning("Modbus %s:%s unit %s read failed", self.host, self.port, unit)
+                self.stats["failed"] += 1
+                METRICS.inc("getsolar_modbus_read_failures_total", session=self.label, unit=unit)
+            # The transport is only suspect once no unit answered at all. A read that fails on an
+            # open socket had no valid response in time
+            if not polled:
+                if self.leader().connected():
+                    self.stats["timeouts"] += 1
+                    METRICS.inc("getsolar_modbus_timeouts_total", session=self.label)
+                    self.backoff("read timed out")
+                else:
+                    self.backoff("connection closed")
+        if time.monotonic() - self.reported > SESSION_REPORT_TIME:
+            self.report()
+        return polled
+
+    def report(self):
+        """
+        Logs and resets the session health counters
+        """
+        stats = dict(self.stats)
+        for stat in self.stats:
+            self.stats[stat] = 0
+        self.reported = time.monotonic()
+        logging.info("Modbus %s:%s %s - reads %s, failed %s, timeouts %s, reconnects %s, "
+                     "mean latency %.3fs, max latency %.3fs",
+                     self.host, self.port, self.state, stats["reads"], stats["failed"],
+                     stats["timeouts"], stats["reconnects"],
+                     stats["latency"] / stats["reads"] if stats["reads"] else 0.0,
+                     stats["max_latency"])
+
+
+def parse_target(target):
+    """
+    Converts a host[:port[:unit[:name]]] target string to a (host, port, unit, name) tuple. The
+    name solaredge is rejected as it would share files with the default target
+    """
+    fields = target.split(":")
+    if len(fields) > 4:
+        raise argparse.ArgumentTypeError("invalid target " + target)
+    try:
+        host = fields[0]
+        port = int(fields[1]) if len(fields) > 1 and fields[1] else 502
+        unit = int(fields[2]) if len(fields) > 2 and fields[2] else 1
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid target " + target)
+    name = fields[3] if len(fields) > 3 else ""
+    if name == "solaredge":
+        # captures and archives of the unnamed default target are already filed as solaredge
+        raise argparse.ArgumentTypeError("target name solaredge is reserved")
+    return (host, port, unit, name)
+
+
+def build_sessions(targets, timeout, profile, meter_name, integrate=ENERGY_INTEGRATION,
+                   capture_dir=""):
+    """
+    Creates an InverterData object for each target and groups targets that share a host and port
+    into a single ModbusSession
+    """
+    groups = {}
+    for host, port, unit, name in targets:
+        inv_data = InverterData(name)
+        inv_data.profile = profile
+        inv_data.meter_name = meter_name
+        if integrate:
+            inv_data.integrator = EnergyIntegrator()
+        if capture_dir:
+            inv_data.capture = RegisterCapture(name, capture_dir)
+        groups.setdefault((host, port), []).append((unit, inv_data))
+    return [ModbusSession(host, port, timeout, units)
+            for (host, port), units in groups.items()]
+
+
+def write_pid_file(pid_f):
+    """
+    Writes a file containing the current process id
+    """
+    pid = str(os.getpid())
+    _f = open(pid_f, 'w')
+    _f.write(pid)
+    _f.close()
+
+
+def rm_pid_file(pid_f):
+    """
+    Deletes the file containing the current process id
+    """
+    if not DEBUG:
+        if os.path.exists(pid_f):
+            os.remove(pid_f)
+
+
+def parse_args():
+    """
+        configure valid arguments
+    """
+
+    parser = argparse.ArgumentParser(
+        description='Get solar performance data from a solaredge inverter')
+    parser.add_argument('-C', metavar=' ',
+                        default=CONFIG_FILE,
+                        help='configuration file, re-read on SIGHUP [default: ' + CONFIG_FILE + ']')
+    parser.add_argument('-i', metavar=' ',
+                        help='ip address to use for modbus tcp [default: localhost, '
+                        'not polled with -T unless given]')
+    parser.add_argument('-p', metavar=' ', type=int,
+                        default=502,
+                        help='port number for modbus tcp [default: 502]')
+    parser.add_argument('-t', metavar=' ', type=int,
+                        default=1,
+                        help='connection timeout [default: 1]')
+    parser.add_argument('-u', metavar=' ', type=int,
+                        default=1,
+                        help='modbus unit [default: 1]')
+    parser.add_argument('-T', metavar=' ', type=parse_target,
+                        action='append',
+                        help='additional target host[:port[:unit[:name]]], may be repeated; '
+                        'units on the same host and port share one session')
+    parser.add_argument('-m', metavar=' ',
+                        default=METER_NAME,
+                        help='meter to read [default: ' + METER_NAME + ']')
+    parser.add_argument('-R', metavar=' ',
+                        choices=['minimal', 'full'],
+                        default=REGISTER_PROFILE,
+                        help='register profile: minimal or full [default: ' + REGISTER_PROFILE + ']')
+    parser.add_argument('-Q', metavar=' ',
+                        choices=['drop-oldest', 'drop-newest', 'block'],
+                        default=SINK_POLICY,
+                        help='sink queue full policy: drop-oldest, drop-newest or block [default: ' +
+                        SINK_POLICY + ']')
+    parser.add_argument('-S', metavar=' ',
+                        default=SPOOL_DIR,
+                        help='directory for the influx write spool, empty to disable, not used '
+                        'with -A [default: ' + SPOOL_DIR + ']')
+    parser.add_argument('-B', metavar=' ', type=int,
+                        default=INFLUX_BATCH_SIZE,
+                        help='influx points per write [default: ' + str(INFLUX_BATCH_SIZE) + ']')
+    parser.add_argument('-F', metavar=' ', type=float,
+                        default=INFLUX_FLUSH_TIME,
+                        help='maximum seconds between influx writes [default: ' +
+                        str(INFLUX_FLUSH_TIME) + ']')
+    parser.add_argument('-I', metavar=' ', type=float,
+                        default=SLEEP_TIME,
+                        help='poll interval in seconds, fractions allowed [default: ' +
+                        str(SLEEP_TIME) + ']')
+    parser.add_argument('-K', metavar=' ',
+                        choices=['skip', 'catch-up'],
+                        default=SCHEDULE_POLICY,
+                        help='missed poll deadline policy: skip or catch-up [default: ' +
+                        SCHEDULE_POLICY + ']')
+    parser.add_argument('-H', metavar=' ', type=int,
+                        default=HISTORY_PORT,
+                        help='local port for sample history queries and /metrics, 0 to disable '
+                        '[default: ' +
+                        str(HISTORY_PORT) + ']')
+    parser.add_argument('-M', action="store_true",
+                        help='also write metrics to influx every minute')
+    parser.add_argument('-E', action="store_true",
+                        help='integrate energy counters from power samples')
+    parser.add_argument('-W', action="store_true",
+                        help='do not write min/max/mean/Wh rollups')
+    parser.add_argument('-A', action="store_true",
+                        help='run the poll loop and sinks on an asyncio event loop (needs aiohttp)')
+    parser.add_argument('-G', metavar=' ', type=int,
+                        default=HEALTH_PORT,
+                        help='local port for health checks with -A, 0 to disable [default: ' +
+                        str(HEALTH_PORT) + ']')
+    parser.add_argument('-Z', metavar=' ',
+                        default=ARCHIVE_DIR,
+                        help='directory for the parquet sample archive, empty to disable '
+                        '(needs pyarrow) [default: empty]')
+    parser.add_argument('-X', metavar=' ',
+                        default=CAPTURE_DIR,
+                        help='directory to capture raw registers to for replays, empty to disable '
+                        '[default: empty]')
+    parser.add_argument('-Y', metavar=' ',
+                        action='append',
+                        help='replay a capture file or directory into influx and exit, '
+                        'may be repeated')
+    parser.add_argument('-D', action="store_true",
+                        help='run in debug mode')
+    return parser.parse_args()
+
+
+def set_logging(log_str):
+    """
+    Configures the log level, and log format and sets up the logging handlers
+    """
+
+    # Defines a logging level and logging format based on a given string key.
+    log_attr = {'debug': (logging.DEBUG,
+                          _ID + ' %(levelname)-9s %(name)-15s %(threadName)-14s +%(lineno)-4d %(message)s'),
+                'info': (logging.INFO,
+                         _ID + ' %(levelname)-9s %(message)s'),
+                'warning': (logging.WARNING,
+                            _ID + ' %(levelname)-9s %(message)s'),
+                'error': (logging.ERROR,
+                          _ID + ' %(levelname)-9s %(message)s'),
+                'critical': (logging.CRITICAL,
+                             _ID + ' %(levelname)-9s %(message)s')}
+    loglevel, logformat = log_attr[log_str]
+
+    # Configuring the logger
+    logger = logging.getLogger()
+    logger.setLevel(loglevel)
+
+    # Clearing previous logs
+    logger.handlers = []
+
+    # Setting formaters and adding handlers.
+    formatter = logging.Formatter(logformat)
+    handlers = []
+    if not DEBUG:
+        handlers.append(SysLogLibHandler(LOG_FACILITY_LOCAL_N))
+        for handle in handlers:
+            handle.setFormatter(formatter)
+            logger.addHandler(handle)
+
+
+def on_connect(client, userdata, flags, rc):
+    # client.error_code = rc
+    if rc == 0:
+        client.connected_flag = True  # set flag
+    else:
+        client.connected_flag = False
+
+
+def on_disconnect(client, userdata, rc):
+    logging.info("disconnecting reason  " + str(rc))
+    client.connected_flag = False
+    client.disconnect_flag = True
+
+
+def on_log(client, userdata, level, buf):
+    logging.debug("log: " + buf)
+
+
+def main():
+    """
+    Main processing loop
+    """
+
+    # pylint: disable=global-statement
+    # use of global statement here is required to allow main() to set the value based on passed arguments to the program
+
+    global DEBUG, INFLUX_PASSWORD
+
+    try:
+        pid_file = os.environ['PIDFILE']
+    except:
+        pid_file = "UNDEFINED"
+
+    # Read the configuration file, then the command line whose defaults it sets
+
+    config = Configuration(parse_args().C)
+    try:
+        config.load()
+    except (OSError, ValueError) as err:
+        sys.exit("Invalid configuration " + config.path + " - " + str(err))
+    args = parse_args()
+
+    # Get the passwords for the configured hosts and users from the plain text keyring
+    keyring.set_keyring(PlaintextKeyring())
+    mqtt_password = keyring.get_password(MQTT_HOST, MQTT_USER)
+    INFLUX_PASSWORD = keyring.get_password(INFLUX_HOST, INFLUX_USER)
+
+    # Setup logging
+
+    if args.D:
+        DEBUG = True
+        set_logging('debug')
+        logging.debug("Running in debug mode, not writing data")
+    else:
+        DEBUG = False
+        set_logging('info')
+        if pid_file != "UNDEFINED":
+            if os.path.exists(pid_file):
+                logging.error(
+                    "PID already exists. Is getsolar already running?")
+                logging.error(
+                    "Either, stop the running process or remove %s or run with the debug flag set (-D)", pid_file)
+                sys.exit(2)
+            else:
+                write_pid_file(pid_file)
+
+    if config.values:
+        logging.info("Read %s settings from %s", len(config.values), config.path)
+
+    # Rebuild Influx from captured registers instead of polling
+
+    if args.Y:
+        d_c = InfluxDBClient(INFLUX_HOST, INFLUX_PORT,
+                             INFLUX_USER, INFLUX_PASSWORD, INFLUX_DB_ALL)
+        d_b = InfluxBatcher(d_c, INFLUX_DB_ALL, "", REPLAY_BATCH, INFLUX_FLUSH_TIME)
+        try:
+            samples = replay(args.Y, d_b, None if args.W else Rollups(d_b), args.E)
+        except (OSError, ValueError, zlib.error) as err:
+            logging.error("Replay failed - %s", err)
+            sys.exit(2)
+        finally:
+            rm_pid_file(pid_file)
+        logging.info("Replayed %s samples", samples)
+        sys.exit(0)
+
+    # Connect to MQTT
+
+    m_d = mqtt.Client(MQTT_CLIENT_NAME)
+    m_d.connected_flag = False
+    m_d.error_code = 0
+    m_d.on_connect = on_connect  # bind call back function
+    m_d.on_disconnect = on_disconnect
+    m_d.on_log = on_log
+    m_d.username_pw_set(MQTT_USER, mqtt_password)
+    mqtt_pub = MQTTPublisher(m_d)
+    m_d.connect_async(MQTT_HOST, int(MQTT_PORT))
+    m_d.loop_start()
+
+    retry = MAX_RETRIES
+    while not m_d.connected_flag and retry:
+        # wait in loop for MAX_RETRIES, then carry on - state is held until the broker connects
+        if m_d.error_code == 5:
+            sys.exit("Authorisation Failure")
+        time.sleep(1)
+        retry -= 1
+    if not m_d.connected_flag:
+        logging.warning("MQTT broker %s unavailable - publishing once it connects", MQTT_HOST)
+
+    # Connect to InfluxDB - one pooled client writes batches to both databases
+    #   DB 1 = Home Assistant database for one minute logging of power and energy data
+    #   DB 2 = Powerlogging for 10s logging of power only
+
+    if args.A:
+        if aiohttp is None:
+            logging.error("The asyncio runtime (-A) needs the aiohttp package")
+            rm_pid_file(pid_file)
+            sys.exit(2)
+        if args.S:
+            logging.warning("The asyncio runtime (-A) keeps failed influx batches in memory - "
+                            "the write spool (-S %s) is not used", args.S)
+        d_b = AsyncInfluxBatcher("http://%s:%s/write" % (INFLUX_HOST, INFLUX_PORT),
+                                 INFLUX_USER, INFLUX_PASSWORD, INFLUX_DB_ALL, args.B, args.F)
+        worker = AsyncSinkWorker
+    else:
+        d_c = InfluxDBClient(INFLUX_HOST, INFLUX_PORT,
+                             INFLUX_USER, INFLUX_PASSWORD, INFLUX_DB_ALL)
+        d_b = InfluxBatcher(d_c, INFLUX_DB_ALL, args.S, args.B, args.F)
+        worker = SinkWorker
+
+    # Build one session per inverter host and port
+    #   the default target keeps the original topics and tags, named targets get their own
+    #   the default target is only polled alongside -T targets when -i is given
+
+    targets = args.T or []
+    if args.i is not None or not targets:
+        targets = [(args.i or 'localhost', args.p, args.u, "")] + targets
+    sessions = build_sessions(targets, args.t, args.R, args.m, args.E, args.X)
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=len(sessions), thread_name_prefix="poll")
+
+    # Start one worker per sink so a slow database or broker never delays the next poll
+
+    sinks = [worker("influx-power", write_power, d_b, policy=args.Q),
+             worker("influx-ha", write_ha, d_b, policy=args.Q),
+             worker("mqtt", write_mqtt, DeadbandPublisher(mqtt_pub), policy=args.Q)]
+
+    # Aggregate power into ROLLUP_WINDOWS at the edge
+
+    if not args.W:
+        sinks.append(worker("rollup", write_rollup, Rollups(d_b), policy=args.Q))
+
+    # Keep HISTORY_HOURS of samples per target in memory for local queries
+
+    if args.H:
+        capacity = int(HISTORY_HOURS * 3600 / args.I) + 1
+        histories = {inv_data.name: SampleHistory(capacity)
+                     for session in sessions for unit, inv_data in session.targets}
+        start_history_server(histories, HISTORY_HOST, args.H)
+        sinks.append(worker("history", write_history, histories, policy=args.Q))
+
+    # Archive every sample to columnar files for offline analysis
+
+    archive = None
+    if args.Z:
+        if pyarrow is None:
+            logging.error("The sample archive (-Z) needs the pyarrow package")
+            rm_pid_file(pid_file)
+            sys.exit(2)
+        archive = SampleArchive(args.Z)
+        sinks.append(worker("archive", write_archive, archive, policy=args.Q))
+    pipeline = Pipeline(sinks, d_b if args.M else None)
+
+    # Poll until stopped - sessions reconnect by themselves after transient faults
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    signal.signal(signal.SIGHUP, lambda signum, frame: config.requested.set())
+    discovery_cache = DiscoveryCache()
+    discovery = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="discovery")
+    scheduler = Scheduler(args.I, args.K)
+    try:
+        if args.A:
+            asyncio.run(run_async(sessions, pipeline, d_b, m_d, discovery_cache, scheduler,
+                                  executor, config, args.G))
+        while not args.A:
+            if config.requested.is_set():
+                apply_settings(config.reload(), scheduler, sessions, sinks, d_b)
+            deadline = scheduler.wait()
+
+            # Read registers - sessions on separate hosts are polled concurrently
+            logging.debug("Reading data - deadline %s", deadline)
+            started = time.monotonic()
+            results = list(executor.map(ModbusSession.poll, sessions))
+            METRICS.observe("getsolar_poll_seconds", time.monotonic() - started)
+            for polled in results:
+                for inv_data in polled:
+                    if m_d.connected_flag:
+
+                        # Once the first read of the inverter registers has been completed - send discovery data to HA
+                        # and again for devices found by a later topology refresh, off the poll thread
+
+                        inv_data.queue_discovery(discovery, m_d, discovery_cache)
+                    pipeline.publish(inv_data.sample())
 #            if energyTime == 6:
 #            modified to write power data to HA faster
-    logging.error("Too many retries")
-    rm_pid_file(pid_file)
-    sys.exit(2)
+    finally:
+        logging.info("Stopping")
+        executor.shutdown(wait=False)
+        discovery.shutdown(wait=False)
+        for session in sessions:
+            for unit, inv_data in session.targets:
+                if inv_data.capture:
+                    inv_data.capture.flush()
+        if not args.A:
+            # run_async closes the pipeline while its Influx writer is still running
+            pipeline.close()
+        d_b.close()
+        if archive is not None:
+            archive.close()
+        rm_pid_file(pid_file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,477 @@
+#!/usr/bin/env python3
+
+# simulator.py v1.1.0 - SunSpec Modbus TCP stand-in for a SolarEdge inverter, meter and battery
+
+"""
+Serves the SolarEdge inverter (40000 block), Meter1 and optionally Battery1 register maps over
+Modbus TCP with synthetic values, so that getsolar can be run, tested and benchmarked without an
+inverter.
+
+The register maps are taken from solaredge_modbus, so the simulator answers exactly the reads
+getsolar makes. Each unit produces a PV curve that follows the (simulated) time of day, a house
+load and the meter flows and lifetime energy counters that result from them. A DC coupled battery
+charges from surplus PV and covers the load when PV falls short. Latency, jitter and faults can
+be injected per request.
+
+  options:
+      -i: address to listen on (default: localhost)
+      -p: port to listen on (default: 5020)
+      -u: modbus units to serve, comma separated (default: 1)
+      -P: peak PV power in W (default: 5000)
+      -L: mean house load in W (default: 800)
+      -N: relative noise on power values (default: 0.05)
+      -B: battery capacity in Wh, 0 for no battery (default: 0)
+      -H: simulated hour of day at start (default: the current time)
+      -X: simulated seconds per real second (default: 1)
+      -l: response latency in ms (default: 0)
+      -j: random extra latency of up to this many ms (default: 0)
+      -e: fraction of requests answered with a Modbus exception (default: 0)
+      -d: fraction of requests left unanswered (default: 0)
+      -c: fraction of requests that close the connection (default: 0)
+      -D: debug logging
+
+  example:
+      ./simulator.py -u 1,2 -X 60 -e 0.01
+      ./getsolar.py -D -i localhost -p 5020 -T localhost:5020:2:second
+"""
+
+import argparse
+import logging
+import math
+import random
+import signal
+import socketserver
+import struct
+import sys
+import threading
+import time
+
+import solaredge_modbus
+
+LISTEN_HOST = 'localhost'
+LISTEN_PORT = 5020
+PEAK_POWER = 5000.0
+MEAN_LOAD = 800.0
+NOISE = 0.05
+SUNRISE = 6.0
+SUNSET = 18.0
+BATTERY_POWER = 5000.0
+BATTERY_SOE = 50.0
+MAX_REGISTERS = 125
+
+# Modbus exception codes
+
+ILLEGAL_FUNCTION = 0x01
+ILLEGAL_ADDRESS = 0x03
+DEVICE_FAILURE = 0x04
+GATEWAY_NO_RESPONSE = 0x0B
+
+DataType = solaredge_modbus.registerDataType
+FORMATS = {
+    DataType.UINT16: ">H",
+    DataType.INT16: ">h",
+    DataType.UINT32: ">I",
+    DataType.ACC32: ">I",
+    DataType.INT32: ">i",
+    DataType.UINT64: ">Q",
+    DataType.FLOAT32: ">f",
+    DataType.SEFLOAT: ">f"
+}
+LIMITS = {
+    DataType.UINT16: (0, 0xfffe),
+    DataType.INT16: (-0x7fff, 0x7fff),
+    DataType.UINT32: (0, 0xfffffffe),
+    DataType.ACC32: (0, 0xffffffff),
+    DataType.INT32: (-0x7fffffff, 0x7fffffff),
+    DataType.UINT64: (0, 0xfffffffffffffffe)
+}
+
+# Scale factor registers - every scaled value is served with these exponents
+
+INVERTER_SCALES = {
+    "current_scale": -2, "voltage_scale": -1, "power_ac_scale": 0, "frequency_scale": -2,
+    "power_apparent_scale": 0, "power_reactive_scale": 0, "power_factor_scale": -2,
+    "energy_total_scale": 0, "current_dc_scale": -2, "voltage_dc_scale": -1,
+    "power_dc_scale": 0, "temperature_scale": -2
+}
+METER_SCALES = {
+    "current_scale": -2, "voltage_scale": -1, "frequency_scale": -2, "power_scale": 0,
+    "power_apparent_scale": 0, "power_reactive_scale": 0, "power_factor_scale": -2,
+    "energy_active_scale": 0, "energy_apparent_scale": 0, "energy_reactive_scale": 0
+}
+
+
+def encode(spec, value, little=False):
+    """
+    Encodes a value for a solaredge_modbus register spec.
+    Returns the start address and the list of 16 bit words
+    """
+    address, length, rtype, dtype, vtype, label, unit, batch = spec
+    # pylint: disable=unused-variable
+    if dtype == DataType.STRING:
+        raw = str(value).encode("utf-8")[:length * 2].ljust(length * 2, b"\0")
+    else:
+        if dtype in LIMITS:
+            low, high = LIMITS[dtype]
+            value = min(high, max(low, int(round(value))))
+        raw = struct.pack(FORMATS[dtype], value)
+    words = [int.from_bytes(raw[i:i + 2], "big") for i in range(0, len(raw), 2)]
+    if little and dtype != DataType.STRING:
+        words.reverse()
+    return address, words
+
+
+class UnitSimulator():
+    """
+    This class is used to simulate one inverter unit its meter and battery.
+    Values are recomputed from the simulated time on each request and the energy counters
+    integrate the power flows between requests
+    """
+    # pylint: disable=too-many-instance-attributes
+    # the simulated plant state is reasonable in this case
+
+    def __init__(self, unit, clock, peak=PEAK_POWER, load=MEAN_LOAD, noise=NOISE, capacity=0.0):
+
+        self.unit = unit
+        self.clock = clock
+        self.peak = peak
+        self.load = load
+        self.noise = noise
+        self.random = random.Random(unit)
+        self.lock = threading.Lock()
+        self.inverter = solaredge_modbus.Inverter(host=LISTEN_HOST, port=LISTEN_PORT, unit=unit)
+        self.meter = solaredge_modbus.Meter(offset=0, parent=self.inverter)
+        self.battery = solaredge_modbus.Battery(offset=0, parent=self.inverter)
+        self.capacity = capacity
+        self.stored = capacity * BATTERY_SOE / 100
+        self.registers = {}
+        self.updated = None
+        self.energy = {"total": 10000000.0, "export": 4000000.0, "import": 2000000.0,
+                       "charge": 500000.0, "discharge": 450000.0}
+
+        self.store(self.inverter, {
+            "c_id": "SunS", "c_did": 1, "c_length": 65,
+            "c_manufacturer": "SolarEdge", "c_model": "SE5000H-SIM",
+            "c_version": "0004.0017.0000", "c_serialnumber": "SIM%08d" % unit,
+            "c_deviceaddress": unit, "c_sunspec_did": 101, "c_sunspec_length": 50
+        })
+        self.store(self.inverter, INVERTER_SCALES)
+        self.store(self.meter, {
+            "c_manufacturer": "WattNode", "c_model": "WNC-3Y-400-MB",
+            "c_option": "Export+Import", "c_version": "31",
+            "c_serialnumber": "SIMMETER%04d" % unit, "c_deviceaddress": 2,
+            "c_sunspec_did": 201, "c_sunspec_length": 105
+        })
+        self.store(self.meter, METER_SCALES)
+
+        # No batteries are present unless one is configured
+        for spec in self.inverter.battery_dids:
+            self.store_spec(spec, 255)
+        if capacity:
+            self.store(self.battery, {
+                "c_manufacturer": "LG", "c_model": "RESU10H-SIM", "c_version": "1.2",
+                "c_serialnumber": "SIMBATT%04d" % unit, "c_deviceaddress": 15,
+                "c_sunspec_did": 802, "rated_energy": capacity,
+                "maximum_charge_continuous_power": BATTERY_POWER,
+                "maximum_discharge_continuous_power": BATTERY_POWER
+            })
+
+    def store_spec(self, spec, value, little=False):
+        """
+        Encodes a value into the register map
+        """
+        address, words = encode(spec, value, little)
+        for offset, word in enumerate(words):
+            self.registers[address + offset] = word
+
+    def store(self, device, values):
+        """
+        Encodes named values of a device into the register map
+        """
+        for name, value in values.items():
+            self.store_spec(device.registers[name], value,
+                            little=device.wordorder == solaredge_modbus.Endian.LITTLE)
+
+    def jitter(self):
+        """
+        Returns a random relative deviation
+        """
+        return self.random.gauss(0, self.noise)
+
+    def update(self):
+        """
+        Recomputes the plant state for the current simulated time
+        """
+        now = self.clock()
+        hour = (now % 86400) / 3600
+        sun = max(0.0, math.sin(math.pi * (hour - SUNRISE) / (SUNSET - SUNRISE))) \
+            if SUNRISE < hour < SUNSET else 0.0
+        production = max(0.0, self.peak * sun * (1 + self.jitter()))
+        load = max(0.0, self.load * (1 + 0.3 * math.sin(2 * math.pi * hour / 24)) *
+                   (1 + self.jitter()))
+        battery = 0.0
+        if self.capacity:
+            if production > load and self.stored < self.capacity:
+                battery = min(production - load, BATTERY_POWER)
+            elif production < load and self.stored > 0:
+                battery = -min(load - production, BATTERY_POWER)
+        power_ac = production - battery
+        grid = power_ac - load
+        if self.updated is not None:
+            hours = max(0.0, now - self.updated) / 3600
+            self.energy["total"] += power_ac * hours
+            self.energy["export"] += max(0.0, grid) * hours
+            self.energy["import"] += max(0.0, -grid) * hours
+            self.energy["charge"] += max(0.0, battery) * hours
+            self.energy["discharge"] += max(0.0, -battery) * hours
+            self.stored = min(self.capacity, max(0.0, self.stored + battery * hours))
+        self.updated = now
+
+        voltage = 240.0 * (1 + self.jitter() / 10)
+        frequency = 50.0 * (1 + self.jitter() / 100)
+        power_dc = power_ac / 0.97
+        self.store(self.inverter, {
+            "current": power_ac / voltage * 100, "l1_current": power_ac / voltage * 100,
+            "l1_voltage": voltage * 10,
+            "power_ac": power_ac, "frequency": frequency * 100,
+            "power_apparent": power_ac / 0.99, "power_reactive": power_ac * 0.1,
+            "power_factor": 9900 if power_ac else 0,
+            "energy_total": self.energy["total"],
+            "current_dc": power_dc / 380 * 100 if power_ac else 0,
+            "voltage_dc": 3800 if power_ac else 0, "power_dc": power_dc,
+            "temperature": (25 + 20 * sun) * 100,
+            "status": 4 if power_ac else 2, "vendor_status": 0
+        })
+        if self.capacity:
+            self.store(self.battery, {
+                "average_temperature": 22 + abs(battery) / 1000,
+                "maximum_temperature": 24 + abs(battery) / 1000,
+                "instantaneous_voltage": 400.0, "instantaneous_current": battery / 400,
+                "instantaneous_power": battery,
+                "lifetime_export_energy_counter": self.energy["discharge"],
+                "lifetime_import_energy_counter": self.energy["charge"],
+                "maximum_energy": self.capacity, "available_energy": self.stored,
+                "soh": 100.0, "soe": 100 * self.stored / self.capacity,
+                "status": 3 if battery > 0 else 4 if battery < 0 else 6
+            })
+        self.store(self.meter, {
+            "current": abs(grid) / voltage * 100, "l1_current": abs(grid) / voltage * 100,
+            "voltage_ln": voltage * 10, "l1n_voltage": voltage * 10,
+            "frequency": frequency * 100, "power": grid, "l1_power": grid,
+            "power_apparent": abs(grid) * 1.02, "l1_power_apparent": abs(grid) * 1.02,
+            "power_reactive": grid * 0.2, "l1_power_reactive": grid * 0.2,
+            "power_factor": 9800, "l1_power_factor": 9800,
+            "export_energy_active": self.energy["export"],
+            "l1_export_energy_active": self.energy["export"],
+            "import_energy_active": self.energy["import"],
+            "l1_import_energy_active": self.energy["import"]
+        })
+
+    def read(self, address, count):
+        """
+        Returns count registers from address, unmapped registers read as zero
+        """
+        with self.lock:
+            self.update()
+            return [self.registers.get(address + i, 0) for i in range(count)]
+
+
+class Simulator():
+    """
+    This class is used to answer Modbus requests for a set of units with injected latency and faults
+    """
+
+    def __init__(self, units, latency=0.0, jitter=0.0, errors=0.0, drops=0.0, closes=0.0):
+
+        self.units = units
+        self.latency = latency
+        self.jitter = jitter
+        self.errors = errors
+        self.drops = drops
+        self.closes = closes
+        self.stats = {"requests": 0, "errors": 0, "drops": 0, "closes": 0}
+        self.lock = threading.Lock()
+
+    def count(self, stat):
+        """
+        Updates a request counter
+        """
+        with self.lock:
+            self.stats[stat] += 1
+
+    def fault(self):
+        """
+        Returns the fault to inject for a request: None, 'error', 'drop' or 'close'
+        """
+        draw = random.random()
+        for fault, rate in (("close", self.closes), ("drop", self.drops), ("error", self.errors)):
+            if draw < rate:
+                self.count(fault + "s")
+                return fault
+            draw -= rate
+        return None
+
+    def delay(self):
+        """
+        Waits for the configured latency and jitter
+        """
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    def respond(self, unit, pdu, fault=None):
+        """
+        Returns the response PDU for a request PDU
+        """
+        self.count("requests")
+        function = pdu[0]
+        if unit not in self.units:
+            return bytes([function | 0x80, GATEWAY_NO_RESPONSE])
+        if fault == "error":
+            return bytes([function | 0x80, DEVICE_FAILURE])
+        if function not in (3, 4) or len(pdu) != 5:
+            return bytes([function | 0x80, ILLEGAL_FUNCTION])
+        address, count = struct.unpack(">HH", pdu[1:5])
+        if not 1 <= count <= MAX_REGISTERS or address + count > 0x10000:
+            return bytes([function | 0x80, ILLEGAL_ADDRESS])
+        words = self.units[unit].read(address, count)
+        return bytes([function, count * 2]) + struct.pack(">%dH" % count, *words)
+
+
+def recv_exact(sock, size):
+    """
+    Reads exactly size bytes from a socket, None if the connection closed
+    """
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+class ModbusHandler(socketserver.BaseRequestHandler):
+    """
+    This class is used to serve Modbus TCP requests on one connection
+    """
+
+    def handle(self):
+        simulator = self.server.simulator
+        logging.info("Connection from %s:%s", *self.client_address[:2])
+        while True:
+            header = recv_exact(self.request, 7)
+            if header is None:
+                break
+            transaction, protocol, length, unit = struct.unpack(">HHHB", header)
+            pdu = recv_exact(self.request, length - 1)
+            if pdu is None:
+                break
+            if protocol != 0:
+                continue
+            fault = simulator.fault()
+            simulator.delay()
+            if fault == "close":
+                logging.debug("Closing connection on request %s", transaction)
+                break
+            if fault == "drop":
+                logging.debug("Dropping request %s", transaction)
+                continue
+            response = simulator.respond(unit, pdu, fault)
+            self.request.sendall(struct.pack(">HHHB", transaction, 0, len(response) + 1, unit) +
+                                 response)
+        logging.info("Connection from %s:%s closed", *self.client_address[:2])
+
+
+class SimulatorServer(socketserver.ThreadingTCPServer):
+    """
+    This class is used to serve each Modbus TCP connection on its own thread
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, simulator):
+
+        super().__init__(address, ModbusHandler)
+        self.simulator = simulator
+
+
+def simulated_clock(start_hour=None, scale=1.0):
+    """
+    Returns a clock giving simulated unix seconds, optionally starting at an hour of day
+    and running scale times faster than real time
+    """
+    started = time.monotonic()
+    origin = time.time()
+    if start_hour is not None:
+        origin = origin - origin % 86400 + start_hour * 3600
+    return lambda: origin + (time.monotonic() - started) * scale
+
+
+def parse_args():
+    """
+        configure valid arguments
+    """
+    parser = argparse.ArgumentParser(
+        description='Simulate a SunSpec solaredge inverter, meter and battery over modbus tcp')
+    parser.add_argument('-i', metavar=' ', default=LISTEN_HOST,
+                        help='address to listen on [default: ' + LISTEN_HOST + ']')
+    parser.add_argument('-p', metavar=' ', type=int, default=LISTEN_PORT,
+                        help='port to listen on [default: ' + str(LISTEN_PORT) + ']')
+    parser.add_argument('-u', metavar=' ', default='1',
+                        help='modbus units to serve, comma separated [default: 1]')
+    parser.add_argument('-P', metavar=' ', type=float, default=PEAK_POWER,
+                        help='peak PV power in W [default: ' + str(PEAK_POWER) + ']')
+    parser.add_argument('-L', metavar=' ', type=float, default=MEAN_LOAD,
+                        help='mean house load in W [default: ' + str(MEAN_LOAD) + ']')
+    parser.add_argument('-N', metavar=' ', type=float, default=NOISE,
+                        help='relative noise on power values [default: ' + str(NOISE) + ']')
+    parser.add_argument('-B', metavar=' ', type=float, default=0.0,
+                        help='battery capacity in Wh, 0 for no battery [default: 0]')
+    parser.add_argument('-H', metavar=' ', type=float,
+                        help='simulated hour of day at start [default: the current time]')
+    parser.add_argument('-X', metavar=' ', type=float, default=1.0,
+                        help='simulated seconds per real second [default: 1]')
+    parser.add_argument('-l', metavar=' ', type=float, default=0.0,
+                        help='response latency in ms [default: 0]')
+    parser.add_argument('-j', metavar=' ', type=float, default=0.0,
+                        help='random extra latency of up to this many ms [default: 0]')
+    parser.add_argument('-e', metavar=' ', type=float, default=0.0,
+                        help='fraction of requests answered with a modbus exception [default: 0]')
+    parser.add_argument('-d', metavar=' ', type=float, default=0.0,
+                        help='fraction of requests left unanswered [default: 0]')
+    parser.add_argument('-c', metavar=' ', type=float, default=0.0,
+                        help='fraction of requests that close the connection [default: 0]')
+    parser.add_argument('-D', action="store_true",
+                        help='debug logging')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Serves the simulated units until interrupted
+    """
+    args = parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.D else logging.INFO,
+                        format='%(asctime)s %(levelname)-8s %(message)s')
+    clock = simulated_clock(args.H, args.X)
+    units = {int(unit): UnitSimulator(int(unit), clock, args.P, args.L, args.N, args.B)
+             for unit in args.u.split(",")}
+    simulator = Simulator(units, args.l / 1000, args.j / 1000, args.e, args.d, args.c)
+    server = SimulatorServer((args.i, args.p), simulator)
+    logging.info("Simulating units %s on %s:%s", ", ".join(str(unit) for unit in units),
+                 args.i, args.p)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logging.info("Served %s requests - %s errors, %s dropped, %s closed",
+                     simulator.stats["requests"], simulator.stats["errors"],
+                     simulator.stats["drops"], simulator.stats["closes"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Tests for register capture and replay
+"""
+
+import getsolar
+
+
+class RecordingBatcher():
+    """
+    Stands in for an InfluxBatcher, keeping the lines written to it
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.failed = 0
+
+    def write_lines(self, lines, **kwargs):
+        self.lines.extend(lines)
+        return True
+
+    def close(self):
+        pass
+
+
+def registers(power_ac, meter_power, energy_total):
+    """
+    Returns the inverter and meter registers of one read, with the scale factors the simulator uses
+    """
+    inv_regs = {"power_ac": power_ac, "power_ac_scale": 0,
+                "energy_total": energy_total, "energy_total_scale": 0,
+                "l1_voltage": 2405, "voltage_scale": -1}
+    meter_regs = {"power": meter_power, "power_scale": 0,
+                  "import_energy_active": 2345, "export_energy_active": 98765,
+                  "energy_active_scale": 0}
+    return inv_regs, meter_regs
+
+
+def test_capture_replays_to_the_same_samples(tmp_path):
+    inv_data = getsolar.InverterData()
+    inv_data.integrator = None
+    capture = getsolar.RegisterCapture("", str(tmp_path))
+    expected = []
+    for second, (power_ac, meter_power) in enumerate([(2405, -120), (2380, 35), (0, 410)]):
+        timestamp = 1800000000000000000 + second * 10**9
+        inv_regs, meter_regs = registers(power_ac, meter_power, 12345678 + second)
+        sample = inv_data.record(timestamp, inv_regs, meter_regs, {},
+                                 inv_data.scale(inv_regs, meter_regs, {}))
+        expected += getsolar.POWER_LINES.lines(sample) + getsolar.ENERGY_LINES.lines(sample)
+        capture.append(timestamp, [
+            ("inverter", "Inverter", getsolar.INVERTER_FIELDS, inv_regs),
+            ("meter", "Meter1", getsolar.METER_FIELDS, meter_regs)])
+    capture.flush()
+    batcher = RecordingBatcher()
+    assert getsolar.replay([str(tmp_path)], batcher, integrate=False) == 3
+    assert batcher.lines == expected
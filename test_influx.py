@@ -0,0 +1,71 @@
+"""
+Tests for the InfluxDB batcher and its write spool
+"""
+
+import getsolar
+
+
+class FailingClient():
+    """
+    Stands in for an InfluxDB client whose server is unreachable
+    """
+
+    def write_points(self, lines, **kwargs):
+        raise ConnectionError("InfluxDB unreachable")
+
+
+class AcceptingClient():
+    """
+    Stands in for an InfluxDB client, keeping the lines it accepts
+    """
+
+    def __init__(self):
+        self.lines = []
+
+    def write_points(self, lines, **kwargs):
+        self.lines.extend(lines)
+        return True
+
+
+def counter(metrics, name):
+    """
+    Returns the sum of a counter over its labels
+    """
+    return sum(value for (metric, labels), value in metrics.values.items() if metric == name)
+
+
+def test_spooled_points_are_not_counted_as_written(monkeypatch, tmp_path):
+    metrics = getsolar.Metrics()
+    monkeypatch.setattr(getsolar, "METRICS", metrics)
+    batcher = getsolar.InfluxBatcher(FailingClient(), "solar", str(tmp_path), 100, 3600)
+    batcher.write_lines(["W Production=1.0 1", "W Production=2.0 2"])
+    batcher.close()
+    assert counter(metrics, "getsolar_influx_points_total") == 0
+    assert counter(metrics, "getsolar_influx_points_spooled_total") == 2
+    assert counter(metrics, "getsolar_influx_write_failures_total") == 1
+    assert batcher.failed == 0
+
+
+def test_accepted_points_are_counted(monkeypatch):
+    metrics = getsolar.Metrics()
+    monkeypatch.setattr(getsolar, "METRICS", metrics)
+    client = AcceptingClient()
+    batcher = getsolar.InfluxBatcher(client, "solar", "", 100, 3600)
+    batcher.write_lines(["W Production=1.0 1", "W Production=2.0 2"])
+    batcher.close()
+    assert client.lines == ["W Production=1.0 1", "W Production=2.0 2"]
+    assert counter(metrics, "getsolar_influx_points_total") == 2
+    assert counter(metrics, "getsolar_influx_points_spooled_total") == 0
+
+
+def test_spool_defers_writes_and_replays_them(monkeypatch, tmp_path):
+    monkeypatch.setattr(getsolar, "SPOOL_RETRY_TIME", 0.0)
+    spool = getsolar.InfluxSpool(FailingClient(), "solar", str(tmp_path))
+    assert spool.write_points(["W Production=1.0 1", "W Production=2.0 2"], "ms") is False
+    assert spool.pending == 2
+    client = AcceptingClient()
+    spool.client = client
+    assert spool.write_points(["W Production=3.0 3"], "ms") is True
+    assert client.lines == ["W Production=1.0 1", "W Production=2.0 2", "W Production=3.0 3"]
+    assert spool.pending == 0
+    assert (tmp_path / "solar.spool").read_text() == ""
@@ -0,0 +1,61 @@
+"""
+Tests for the Sample encoders and aggregators: LineEncoder, Rollup and EnergyIntegrator
+"""
+
+import array
+
+import pytest
+from influxdb.line_protocol import make_lines
+
+import benchmark
+import getsolar
+
+
+def sample(target, timestamp, **fields):
+    """
+    Returns a Sample of the given field values, with every other field NaN
+    """
+    values = array.array('d', getsolar.EMPTY_SAMPLE)
+    for field, value in fields.items():
+        values[getsolar.Field[field]] = value
+    return getsolar.Sample(target, timestamp, values)
+
+
+def test_line_encoder_matches_make_lines():
+    inv_data = getsolar.InverterData("garage, east=2")
+    inv_data.integrator = None
+    built = inv_data.build_sample(
+        1800000000123456789,
+        {"power_ac": 2405.5, "energy_total": 12345678.0},
+        {"power": -120.25, "import_energy_active": 2345.0, "export_energy_active": 987654.0},
+        {"instantaneous_power": -500.0, "soe": 87.5,
+         "lifetime_import_energy_counter": 4000.0, "lifetime_export_energy_counter": 3500.0})
+    lines = getsolar.POWER_LINES.lines(built) + getsolar.ENERGY_LINES.lines(built)
+    expected = make_lines({'points': benchmark.point_dicts(built)},
+                          getsolar.TIME_PRECISION).splitlines()
+    assert sorted(lines) == sorted(expected)
+
+
+def test_rollup_of_constant_power_integrates_to_watt_hours():
+    target = getsolar.InverterData().target
+    rollup = getsolar.Rollup(getsolar.RollupWindow(60, 'W_1m', None, None))
+    points = [rollup.add(sample(target, second * 10**9, power_prod=1200.0))
+              for second in range(61)]
+    assert points[:60] == [None] * 60
+    fields = points[60]['fields']
+    assert fields['Production_Wh'] == pytest.approx(20.0)
+    assert fields['Production_mean'] == 1200.0
+    assert fields['samples'] == 60
+    assert points[60]['time'] == 0
+
+
+def test_energy_integrator_accumulates_on_anchor():
+    integrator = getsolar.EnergyIntegrator(max_gap=10, anchor_time=3600)
+    published = []
+    for second in range(4):
+        values = array.array('d', getsolar.EMPTY_SAMPLE)
+        values[getsolar.Field.power_prod] = 3600.0
+        values[getsolar.Field.energy_prod] = 1000.0
+        integrator.update(second * 10**9, values)
+        published.append(values[getsolar.Field.energy_prod])
+    assert published == pytest.approx([1000.0, 1001.0, 1002.0, 1003.0])
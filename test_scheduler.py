@@ -0,0 +1,41 @@
+"""
+Tests for the poll Scheduler deadline policies
+"""
+
+import time
+
+import getsolar
+
+
+def scheduler(monkeypatch, clock, policy):
+    """
+    Returns a 10 s Scheduler on a fake monotonic clock, with the wall clock on a slot boundary
+    """
+    monkeypatch.setattr(time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(time, "time", lambda: 1800000000.0)
+    return getsolar.Scheduler(10.0, policy)
+
+
+def test_on_time_waits_for_deadline(monkeypatch):
+    clock = [1000.0]
+    sched = scheduler(monkeypatch, clock, 'skip')
+    clock[0] = 1004.0
+    assert sched.next() == (1010.0, 6.0)
+
+
+def test_skip_waits_for_next_slot_after_overrun(monkeypatch):
+    clock = [1000.0]
+    sched = scheduler(monkeypatch, clock, 'skip')
+    clock[0] = 1035.0
+    deadline, delay = sched.next()
+    assert delay == 5.0
+    assert deadline == 1040.0
+    assert sched.missed == 3
+
+
+def test_catch_up_polls_back_to_back(monkeypatch):
+    clock = [1000.0]
+    sched = scheduler(monkeypatch, clock, 'catch-up')
+    clock[0] = 1035.0
+    assert [sched.next() for _ in range(4)] == [
+        (1010.0, 0.0), (1020.0, 0.0), (1030.0, 0.0), (1040.0, 5.0)]